@@ -32,9 +32,11 @@ __all__ = [
     'destinations',
     'exceptions',
     'filters',
+    'imap_response',
     'imap_utf7',
     'logging',
     'message',
+    'oldmail',
     'retrievers',
     'utilities',
 ]
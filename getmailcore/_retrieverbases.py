@@ -40,8 +40,8 @@ except ImportError:
 import poplib
 import imaplib
 import re
-import select
 import base64
+import tempfile
 
 try:
     # do we have a recent pykerberos?
@@ -81,6 +81,34 @@ imaplib.IMAP4.id = imap_id_rfc2971
 # Monkey-patch imaplib to support the ID command (RFC 2971) - end
 ###
 
+# Let imaplib write large literals (i.e. messages) to a file instead of
+# reading them into memory, if the connection's spool_bytes is set.
+_imap4_read = imaplib.IMAP4.read
+def imap_read_spooled(self, size):
+    """Read a literal of size bytes.  Above self.spool_bytes, return a
+    rewound SpooledTemporaryFile holding it instead of a string.  With
+    spool_bytes 0 (message_spool_bytes = 0), every literal is read into
+    memory as imaplib does."""
+    limit = getattr(self, 'spool_bytes', 0)
+    if not limit or size <= limit:
+        return _imap4_read(self, size)
+    spool = tempfile.SpooledTemporaryFile(limit)
+    while size > 0:
+        data = _imap4_read(self, min(size, 65536))
+        if not data:
+            raise self.abort('socket error: EOF')
+        spool.write(data)
+        size -= len(data)
+    spool.seek(0)
+    return spool
+
+imaplib.IMAP4.read = imap_read_spooled
+
+# Older imaplib versions don't know the MOVE (RFC 6851) and ENABLE (RFC 5161)
+# commands
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+
 try:
   import ssl
   SSLError = ssl.SSLError
@@ -88,6 +116,8 @@ except:
   ssl = None
   SSLError = Exception
 import hashlib
+import json
+import threading
 
 __all__ = [
     'IMAPinitMixIn',
@@ -322,6 +352,9 @@ from getmailcore.message import *
 from getmailcore.utilities import *
 from getmailcore.baseclasses import *
 import getmailcore.imap_utf7        # registers imap4-utf-7 codec
+from getmailcore.imap_response import *
+from getmailcore.oldmail import *
+from getmailcore.syncstate import SyncList
 
 NOT_ENVELOPE_RECIPIENT_HEADERS = (
     'to',
@@ -340,6 +373,16 @@ NOT_ENVELOPE_RECIPIENT_HEADERS = (
 # 30 days.
 VANISHED_AGE = (60 * 60 * 24 * 30)
 
+# Messages getheaders() fetches the header fields of at once
+HEADER_BATCH_MESSAGES = 100
+
+# Serializes the imap_sync_state updates of retrievers run with --parallel
+_syncstate_lock = threading.Lock()
+
+# Month names in IMAP dates (RFC 3501 date-month)
+IMAP_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+               'Oct', 'Nov', 'Dec')
+
 # Regex used to remove problematic characters from oldmail filenames
 STRIP_CHAR_RE = r'[/\:;<>|]+'
 
@@ -817,9 +860,17 @@ class RetrieverSkeleton(ConfigurableBase):
       __del__(self)
       initialize(self, options)
       checkconf(self)
+
+    and may provide:
+
+      _getheadersbyid(self, msgids) - return a dictionary of msgid -> header
+                                 for as many of msgids as can be retrieved
+                                 at once.
+
+      _setenvelope(self, msg) - set msg.recipient from its header fields
+                                 (multidrop retrievers).
     '''
     def __init__(self, **args):
-        self.headercache = {}
         self.deleted = {}
         self.set_new_timestamp()
         self.__oldmail_written = False
@@ -843,6 +894,11 @@ class RetrieverSkeleton(ConfigurableBase):
         self.__delivered = {}
         self.deleted = {}
         self.mailbox_selected = False
+        self._prefetched = {}
+        self._msgorder = None
+        self.headercache = {}
+        # Messages go() isn't going to retrieve, though they would be wanted
+        self._skipping = set()
 
     def setup_received(self, sock):
         serveraddr = sock.getpeername()
@@ -897,6 +953,19 @@ class RetrieverSkeleton(ConfigurableBase):
         '''Test whether an oldmail file exists for a specified mailbox.'''
         return os.path.isfile(self._oldmail_filename(mailbox))
 
+    def _open_oldmail(self, mailbox):
+        '''Return the oldmail store for a mailbox, using the configured
+        oldmail_backend.'''
+        filename = self._oldmail_filename(mailbox)
+        logname = '%s:%s' % (self, mailbox or '')
+        backend = self.app_options.get('oldmail_backend') or 'file'
+        if backend == 'sqlite':
+            return OldmailSqlite(filename, self.log, logname,
+                                 self.oldmail_filename + '.sqlite', mailbox)
+        elif backend == 'journal':
+            return OldmailJournal(filename, self.log, logname)
+        return OldmailFile(filename, self.log, logname)
+
     def read_oldmailfile(self, mailbox):
         '''Read contents of an oldmail file.  For POP, mailbox must be
         explicitly None.
@@ -905,74 +974,26 @@ class RetrieverSkeleton(ConfigurableBase):
             'still have %d unflushed oldmail' % len(self.oldmail)
         )
         self.log.trace('mailbox=%s' % mailbox)
-
-        filename = self._oldmail_filename(mailbox)
-        logname = '%s:%s' % (self, mailbox or '')
+        self.oldmail = self._open_oldmail(mailbox)
         try:
-            f = open(filename)
-        except IOError:
-            self.log.moreinfo('no oldmail file for %s%s'
-                              % (logname, os.linesep))
-            return
-
-        for line in f:
-            line = line.strip()
-            if not line or not '\0' in line:
-                # malformed
-                continue
-            try:
-                (msgid, timestamp) = line.split('\0', 1)
-                if msgid.count('/') == 2:
-                    # Was pre-4.22.0 file format, which includes the
-                    # mailbox name in the msgid, in the format
-                    # 'uidvalidity/mailbox/serveruid'.
-                    # Strip it out.
-                    fields = msgid.split('/')
-                    msgid = '/'.join([fields[0], fields[2]])
-                self.oldmail[msgid] = int(timestamp)
-            except ValueError:
-                # malformed
-                self.log.info(
-                    'skipped malformed line "%r" for %s%s'
-                    % (line, logname, os.linesep)
-                )
-        f.close()
-        self.log.moreinfo(
-            'read %i uids for %s%s'
-            % (len(self.oldmail), logname, os.linesep)
-        )
-        self.log.moreinfo('read %i uids in total for %s%s'
-                          % (len(self.oldmail), logname, os.linesep))
+            self.oldmail.load()
+        except IOError as o:
+            raise getmailOperationError('failed reading oldmail for %s:%s (%s)'
+                                        % (self, mailbox or '', o))
 
     def write_oldmailfile(self, mailbox):
         '''Write oldmail info to oldmail file.'''
         self.log.trace('mailbox=%s' % mailbox)
 
-        filename = self._oldmail_filename(mailbox)
         logname = '%s:%s' % (self, mailbox or '')
-
-        oldmailfile = None
-        wrote = 0
-        msgids = frozenset(
-            self.__delivered.keys()
-        ).union(frozenset(self.oldmail.keys()))
         try:
-            oldmailfile = updatefile(filename)
-            for msgid in msgids:
-                self.log.debug('msgid %s ...' % msgid)
-                t = self.oldmail.get(msgid, self.timestamp)
-                self.log.debug(' timestamp %s' % t + os.linesep)
-                oldmailfile.write('%s\0%i%s' % (msgid, t, os.linesep))
-                self.oldmail[msgid] = t
-                wrote += 1
-            oldmailfile.close()
+            self.oldmail.add(self.__delivered, self.timestamp)
+            wrote = self.oldmail.commit()
             self.log.moreinfo('wrote %i uids for %s%s'
                               % (wrote, logname, os.linesep))
         except IOError as o:
             self.log.error('failed writing oldmail file for %s (%s)'
                            % (logname, o) + os.linesep)
-            if oldmailfile:
-                oldmailfile.abort()
         self.__oldmail_written = True
 
     def initialize(self, options):
@@ -980,11 +1001,14 @@ class RetrieverSkeleton(ConfigurableBase):
         # aren't used in initializing the retriever.
         self.log.trace()
         self.checkconf()
-        if 'timeout' in self.conf:
-            socket.setdefaulttimeout(self.conf['timeout'])
-        else:
-            # Explicitly set to None in case it was previously set
-            socket.setdefaulttimeout(None)
+        # The default timeout is process-wide; with getmail --parallel
+        # _settimeout() sets it on our connection only.
+        if threading.current_thread().name == 'MainThread':
+            if 'timeout' in self.conf:
+                socket.setdefaulttimeout(self.conf['timeout'])
+            else:
+                # Explicitly set to None in case it was previously set
+                socket.setdefaulttimeout(None)
 
         # Construct base filename for oldmail files.
         # strip problematic characters from oldmail filename.  Mostly for
@@ -995,11 +1019,22 @@ class RetrieverSkeleton(ConfigurableBase):
         )
         self.oldmail_filename = os.path.join(self.conf['getmaildir'],
                                              oldmail_filename)
+        if (options.get('oldmail_backend') or 'file') not in OLDMAIL_BACKENDS:
+            raise getmailConfigurationError(
+                'unknown oldmail_backend "%s" (must be one of %s)'
+                % (options['oldmail_backend'], ', '.join(OLDMAIL_BACKENDS))
+            )
 
         self.received_from = None
         self.app_options = options
         self.__initialized = True
 
+    def _settimeout(self):
+        '''Set the configured timeout on the connection's socket.'''
+        sock = getattr(self.conn, 'sock', None)
+        if sock is not None:
+            sock.settimeout(self.conf.get('timeout'))
+
     def quit(self):
         if self.mailbox_selected is not False:
             self.write_oldmailfile(self.mailbox_selected)
@@ -1011,8 +1046,9 @@ class RetrieverSkeleton(ConfigurableBase):
         '''
         self._clear_state()
 
-    def delivered(self, msgid):
-        self.__delivered[msgid] = None
+    def delivered(self, *msgids):
+        for msgid in msgids:
+            self.__delivered[msgid] = None
         if self.app_options.get('to_oldmail_on_each_mail',False):
             self.write_oldmailfile(self.mailbox_selected)
             self.__delivered = {}
@@ -1024,11 +1060,100 @@ class RetrieverSkeleton(ConfigurableBase):
             self.headercache[msgid] = self._getheaderbyid(msgid)
         return self.headercache[msgid]
 
+    def getheaders(self, msgid):
+        '''Return a list of (msgid, header) pairs for msgid and the messages
+        after it that go() will want next, as far as their header fields
+        could be fetched together (see _readahead()).
+        '''
+        if not self.__initialized:
+            raise getmailOperationError('not initialized')
+        batch = self._readahead(
+            msgid, max(HEADER_BATCH_MESSAGES,
+                       self.app_options.get('fetch_batch_messages', 1)),
+            self.headercache, maxbytes=0
+        )
+        if msgid not in self.headercache:
+            headers = self._getheadersbyid(batch)
+            if msgid not in headers:
+                # Report the error, if any
+                headers[msgid] = self._getheaderbyid(msgid)
+            for (fetchedid, header) in headers.items():
+                try:
+                    self._setenvelope(header)
+                except getmailConfigurationError:
+                    # Reported when the message is retrieved
+                    pass
+                self.headercache[fetchedid] = header
+        return [(fetchedid, self.headercache[fetchedid]) for fetchedid in batch
+                if fetchedid in self.headercache]
+
+    def _getheadersbyid(self, msgids):
+        return {}
+
+    def _setenvelope(self, msg):
+        pass
+
+    def unchanged_mailboxes(self, mailboxes):
+        '''Return those of mailboxes known to have nothing to do since they
+        were last read, which go() need not select.'''
+        return set()
+
+    def skipping(self, *msgids):
+        '''Tell the retriever go() is not going to retrieve msgids, so they
+        are not fetched ahead.'''
+        self._skipping.update(msgids)
+
     def getmsg(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
         return self._getmsgbyid(msgid)
 
+    def _readahead(self, msgid, maxcount=None, have=None, maxbytes=None):
+        '''Return a list starting with msgid, followed by the messages after
+        it that go() will want next (i.e. not seen before, unless read_all,
+        and not oversized), and which are not in have (by default the
+        messages fetched ahead already).  The list is limited by maxcount
+        and maxbytes, by default the fetch_batch_messages and
+        fetch_batch_bytes options, so that retrievers can fetch several
+        messages at once without holding an unbounded amount of data.
+        '''
+        batch = [msgid]
+        if have is None:
+            have = self._prefetched
+        # Bodies only of messages go() decided about from the header fields
+        bodies = have is self._prefetched
+        if maxcount is None:
+            maxcount = self.app_options.get('fetch_batch_messages', 1)
+        if maxcount < 2:
+            return batch
+        if maxbytes is None:
+            maxbytes = self.app_options.get('fetch_batch_bytes', 0)
+        maxsize = self.app_options.get('max_message_size', 0)
+        read_all = self.app_options.get('read_all', True)
+        if self._msgorder is None:
+            self._msgorder = dict((self[i], i) for i in range(len(self)))
+        total = self.msgsizes.get(msgid, 0)
+        for i in range(self._msgorder.get(msgid, len(self)) + 1, len(self)):
+            if len(batch) >= maxcount:
+                break
+            nextid = self[i]
+            if bodies and self.headercache and nextid not in self.headercache:
+                # go() decides from the header fields first; don't fetch
+                # messages it hasn't seen the header fields of yet
+                break
+            if nextid in have or nextid in self._skipping:
+                continue
+            if not read_all and nextid in self.oldmail:
+                continue
+            size = self.msgsizes.get(nextid, 0)
+            if maxsize and size > maxsize:
+                continue
+            if maxbytes and total + size > maxbytes:
+                break
+            batch.append(nextid)
+            total += size
+        return batch
+
     def getmsgsize(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
@@ -1071,6 +1196,10 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def __init__(self, **args):
         RetrieverSkeleton.__init__(self, **args)
         self.log.trace()
+        # Server advertises PIPELINING (RFC 2449)
+        self.pipelining = False
+        # Message numbers to send DELE for with the next batch of commands
+        self._deletes = []
 
     def select_mailbox(self, mailbox):
         assert mailbox is None, (
@@ -1081,8 +1210,7 @@ class POP3RetrieverBase(RetrieverSkeleton):
 
         self._clear_state()
 
-        if self.oldmail_exists(mailbox):
-            self.read_oldmailfile(mailbox)
+        self.read_oldmailfile(mailbox)
         self.mailbox_selected = mailbox
 
         self._getmsglist()
@@ -1151,13 +1279,14 @@ class POP3RetrieverBase(RetrieverSkeleton):
             # but only if the timestamp for them are old (30 days for now).
             # This is because IMAP users can have one state file but multiple
             # IMAP folders in different configuration rc files.
-            for msgid in list(self.oldmail.keys()):
-                timestamp = self.oldmail[msgid]
-                age = self.timestamp - timestamp
-                if msgid not in self.msgsizes and age > VANISHED_AGE:
-                    self.log.debug('removing vanished old message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
+            # Nothing to do before select_mailbox() read the oldmail state.
+            if self.mailbox_selected is not False:
+                for msgid in self.oldmail.expired(self.timestamp
+                                                  - VANISHED_AGE):
+                    if msgid not in self.msgsizes:
+                        self.log.debug('removing vanished old message id %s'
+                                       % msgid + os.linesep)
+                        del self.oldmail[msgid]
 
         except poplib.error_proto as o:
             raise getmailOperationError(
@@ -1170,18 +1299,113 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def _flagmsgbyid(self, msgid):
         self.log.trace()
         msgnum = self._getmsgnumbyid(msgid)
-        self.conn.dele(msgnum)
+        if self.pipelining:
+            # Deletion only happens at QUIT anyway; send the DELE together
+            # with the next commands instead of waiting for its response.
+            self._deletes.append(msgnum)
+        else:
+            self.conn.dele(msgnum)
         return True
 
+    def _pipeline(self, commands):
+        '''Send several commands at once, then read their responses in
+        order.  commands is a list of (command, multiline) pairs; returns a
+        list of the responses (a (response, file, octets) tuple for
+        multi-line ones, see _getspooled()), or the poplib.error_proto
+        instance for commands the server refused.
+        '''
+        self.log.trace()
+        # One write for all of them
+        self.conn.sock.sendall(b''.join(
+            command.encode(self.conn.encoding) + b'\r\n'
+            for (command, unused) in commands
+        ))
+        results = []
+        for (command, multiline) in commands:
+            try:
+                if multiline:
+                    results.append(self._getspooled())
+                else:
+                    results.append(self.conn._getresp())
+            except poplib.error_proto as o:
+                results.append(o)
+        return results
+
+    def _getspooled(self):
+        '''Read a multi-line response like poplib's _getlongresp(), but
+        write the lines (dot-unstuffed, with native EOL) to a file instead of
+        collecting them in a list.  Small responses stay in memory, larger
+        ones go to disk (see the message_spool_bytes option).  With
+        message_spool_bytes 0, SpooledTemporaryFile never rolls over, so all
+        of them stay in memory.
+
+        Returns (response, file, octets), with the file rewound.
+        '''
+        response = self.conn._getresp()
+        spool = tempfile.SpooledTemporaryFile(
+            self.app_options.get('message_spool_bytes', 0)
+        )
+        octets = 0
+        (line, o) = self.conn._getline()
+        while line != b'.':
+            if line.startswith(b'..'):
+                o -= 1
+                line = line[1:]
+            octets += o
+            spool.write(line + os.linesep.encode())
+            (line, o) = self.conn._getline()
+        spool.seek(0)
+        return (response, spool, octets)
+
+    def _flushdeletes(self, commands=()):
+        '''Send the pending DELE commands, followed by commands (see
+        _pipeline()), and return the responses to the latter.'''
+        deletes = [('DELE %s' % msgnum, False) for msgnum in self._deletes]
+        self._deletes = []
+        results = self._pipeline(deletes + list(commands))
+        for ((command, unused), result) in zip(deletes, results):
+            if isinstance(result, poplib.error_proto):
+                # The message has been delivered already; it just stays on
+                # the server
+                self.log.error('%s failed (%s)' % (command, result)
+                               + os.linesep)
+        return results[len(deletes):]
+
+    def _prefetchmsgs(self, msgids):
+        '''Send RETR for several messages (and any pending DELE) at once, and
+        keep the messages in self._prefetched until getmsg() asks for them.
+
+        For messages the server refused, the error is kept instead.
+        '''
+        self.log.trace()
+        msgnums = [self._getmsgnumbyid(msgid) for msgid in msgids]
+        self.log.debug('retrieving %d messages, deleting %d'
+                       % (len(msgnums), len(self._deletes)) + os.linesep)
+        results = self._flushdeletes([('RETR %s' % msgnum, True)
+                                      for msgnum in msgnums])
+        for (msgid, result) in zip(msgids, results):
+            if isinstance(result, poplib.error_proto):
+                self._prefetched[msgid] = result
+            else:
+                self._prefetched[msgid] = Message(fromspool=result[1])
+
     def _getmsgbyid(self, msgid):
         self.log.debug('msgid %s' % msgid + os.linesep)
         msgnum = self._getmsgnumbyid(msgid)
         self.log.debug('msgnum %i' % msgnum + os.linesep)
         try:
-            response, lines, octets = self.conn.retr(msgnum)
+            if self.pipelining:
+                if msgid not in self._prefetched:
+                    self._prefetchmsgs(self._readahead(msgid))
+                msg = self._prefetched.pop(msgid)
+                if isinstance(msg, poplib.error_proto):
+                    raise msg
+                return msg
+            self.conn._putcmd('RETR %s' % msgnum)
+            response, spool, octets = self._getspooled()
             self.log.debug('RETR response "%s", %d octets'
                            % (response, octets) + os.linesep)
-            msg = Message(fromlines=lines+[b''])
+            msg = Message(fromspool=spool)
             return msg
         except poplib.error_proto as o:
             raise getmailRetrievalError(
@@ -1192,13 +1416,31 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def _getheaderbyid(self, msgid):
         self.log.trace()
         msgnum = self._getmsgnumbyid(msgid)
-        response, headerlist, octets = self.conn.top(msgnum, 0)
         try:
-            parser = Parser.BytesHeaderParser()
-            return parser.parsebytes(os.linesep.encode().join(headerlist))
-        except: #py2
-            parser = Parser.HeaderParser()
-            return parser.parsestr(os.linesep.join(headerlist))
+            headerlist = self.conn.top(msgnum, 0)[1]
+        except poplib.error_proto as o:
+            raise getmailRetrievalError(
+                'failed to retrieve header of msgid %s; server said %s'
+                % (msgid, o)
+            )
+        return Message(fromlines=headerlist)
+
+    def _getheadersbyid(self, msgids):
+        '''With PIPELINING, send TOP for several messages (and any pending
+        DELE) at once.'''
+        self.log.trace()
+        if not self.pipelining or len(msgids) < 2:
+            return {}
+        msgnums = [self._getmsgnumbyid(msgid) for msgid in msgids]
+        self.log.debug('retrieving header fields of %d messages'
+                       % len(msgnums) + os.linesep)
+        results = self._flushdeletes([('TOP %s 0' % msgnum, True)
+                                      for msgnum in msgnums])
+        headers = {}
+        for (msgid, result) in zip(msgids, results):
+            if not isinstance(result, poplib.error_proto):
+                headers[msgid] = Message(fromspool=result[1])
+        return headers
 
     def initialize(self, options):
         self.log.trace()
@@ -1217,6 +1459,7 @@ class POP3RetrieverBase(RetrieverSkeleton):
         RetrieverSkeleton.initialize(self, options)
         try:
             self._connect()
+            self._settimeout()
 
             if self.conf['use_apop']:
                 self.conn.apop(self.conf['username'],
@@ -1230,6 +1473,13 @@ class POP3RetrieverBase(RetrieverSkeleton):
             else:
                 self.conn.user(self.conf['username'])
                 self.conn.pass_(self.conf['password'])
+            self._deletes = []
+            try:
+                self.pipelining = 'PIPELINING' in self.conn.capa()
+            except (poplib.error_proto, AttributeError):
+                # No CAPA (RFC 2449) support, or Python 2
+                self.pipelining = False
+            self.log.debug('pipelining: %s' % self.pipelining + os.linesep)
             self._getmsglist()
             self.log.debug('msgids: %s'
                            % list(sorted(self.msgnum_by_msgid.keys())) + os.linesep)
@@ -1246,6 +1496,7 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def abort(self):
         self.log.trace()
         RetrieverSkeleton.abort(self)
+        self._deletes = []
         if not self.conn:
             return
         try:
@@ -1256,6 +1507,11 @@ class POP3RetrieverBase(RetrieverSkeleton):
         self.conn = None
 
     def quit(self):
+        if self.conn and self._deletes:
+            try:
+                self._flushdeletes()
+            except (poplib.error_proto, socket.error) as o:
+                raise getmailOperationError('POP error (%s)' % o)
         RetrieverSkeleton.quit(self)
         self.log.trace()
         if not self.conn:
@@ -1311,24 +1567,24 @@ class MultidropPOP3RetrieverBase(POP3RetrieverBase):
     def _getmsgbyid(self, msgid):
         self.log.trace()
         msg = POP3RetrieverBase._getmsgbyid(self, msgid)
-        data = {}
-        for (name, val) in msg.headers():
-            name = name.lower()
-            val = val.strip()
-            if name in data:
-                data[name].append(val)
-            else:
-                data[name] = [val]
+        header = self.headercache.get(msgid)
+        if header is not None and header.recipient is not None:
+            msg.recipient = header.recipient
+        else:
+            self._setenvelope(msg)
+        return msg
 
+    def _setenvelope(self, msg):
+        values = [val.strip() for (name, val) in msg.headers()
+                  if name.lower() == self.envrecipname]
         try:
-            line = data[self.envrecipname][self.envrecipnum]
-        except (KeyError, IndexError) as unused:
+            line = values[self.envrecipnum]
+        except IndexError as unused:
             raise getmailConfigurationError(
                 'envelope_recipient specified header missing (%s)'
                 % self.conf['envelope_recipient']
             )
         msg.recipient = address_no_brackets(line.strip())
-        return msg
 
 
 #######################################
@@ -1341,6 +1597,21 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         self.gss_step = 0
         self.gss_vc = None
         self.gssapi = False
+        self.condstore = False
+        self.qresync = False
+        # mailbox -> STATUS entry, for unchanged_mailboxes()
+        self._syncstate = {}
+        # mailbox -> SyncList, kept for the sessions of a getmail run
+        self._synclists = {}
+        # Mailbox STATUS returned by list_mailboxes(), if any
+        self._liststatus = None
+        # mailbox -> (uidvalidity, uidnext) as of the last SELECT or STATUS
+        self._uidnext = {}
+        # folder -> (uidvalidity, uidnext) as last seen while idling
+        self._idleseen = {}
+        self._idlefolders = ()
+        self._idletag = None
+        self.notify = False
 
     def _clear_state(self):
         RetrieverSkeleton._clear_state(self)
@@ -1355,6 +1626,10 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         self.oldmail = {}
         self.__delivered = {}
         self._mboxmaxuid = 1
+        self._flaguids = []
+        # STATUS of the selected mailbox as of SELECT, if listed completely
+        self._selectstatus = None
+        self._partiallisting = False
 
     def checkconf(self):
         RetrieverSkeleton.checkconf(self)
@@ -1441,53 +1716,49 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                           str(resplist)) + os.linesep)
         return resplist
 
-    def _parse_imapattrresponse(self, line):
-        self.log.trace('parsing attributes response line %s' % line
-                       + os.linesep)
-        r = {}
+    def _parse_fetchresponse(self, response):
+        '''parse_fetch_response(), with errors as getmailOperationError.'''
         try:
-            parts = line[line.index(b'(') + 1:line.rindex(b')')].split()
-            while parts:
-                # Flags starts a parenthetical list of valueless flags
-                if parts[0].lower() == b'flags' and parts[1].startswith(b'('):
-                    while parts and not parts[0].endswith(b')'):
-                        del parts[0]
-                    if parts:
-                        # Last one, ends with ")"
-                        del parts[0]
-                    continue
-                if len(parts) == 1:
-                    # Leftover part -- not name, value pair.
-                    raise ValueError
-                name = parts.pop(0).lower()
-                r[tostr(name)] = tostr(parts.pop(0))
-        except (ValueError, IndexError, AttributeError) as o:
+            return parse_fetch_response(response)
+        except ValueError as o:
             raise getmailOperationError(
-                'IMAP error (failed to parse attr response line "%s": %s)'
-                % (line, o)
+                'IMAP error (failed to parse FETCH response: %s)' % o
             )
-        self.log.trace('got %s' % r + os.linesep)
-        return r
 
     def id(self):
         server_id = self.conn.id('name', 'getmail', 'version', '6.0.0')
         return server_id
 
     def list_mailboxes(self):
-        '''List (selectable) IMAP folders in account.'''
+        '''List (selectable) IMAP folders in account.  With imap_sync_state
+        and LIST-STATUS (RFC 5819), their STATUS comes along, for
+        unchanged_mailboxes().'''
         cmd = ('LIST', )
+        if (self.app_options.get('imap_sync_state')
+                and 'LIST-STATUS' in self.conn.capabilities):
+            cmd = ('LIST', '""', '* RETURN (STATUS (%s))'
+                   % ' '.join(self._statusitems()))
+            self.conn.untagged_responses.pop('STATUS', None)
         resplist = self._parse_imapcmdresponse(*cmd)
+        if len(cmd) > 1:
+            self._liststatus = parse_status_responses(
+                self.conn.untagged_responses.pop('STATUS', [])
+            )
         return mailbox_names(
             codecs.decode(x,'imap4-utf-7')
             for x in resplist)
 
     def close_mailbox(self):
+        # Flag the messages collected during the mailbox pass.
+        expunged = self._flagpending()
         # Close current mailbox so deleted mail is expunged.  One getmail
         # user had a buggy IMAP server that didn't do the automatic expunge,
         # so we do it explicitly here if we've deleted any messages.
-        if any(self.deleted):
+        if any(self.deleted) and not expunged:
             self.conn.expunge()
         self.write_oldmailfile(self.mailbox_selected)
+        if self._selectstatus and self.app_options.get('imap_sync_state'):
+            self._savestatus()
         # And clear some state
         self.mailbox_selected = False
         self.mailbox = None
@@ -1501,6 +1772,10 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         self.oldmail = {}
         self.__delivered = {}
         self._mboxmaxuid = 1
+        self._prefetched = {}
+        self._msgorder = None
+        self._flaguids = []
+        self._selectstatus = None
         self.conn.close()
 
     def _fileexpand(self, filename):
@@ -1549,7 +1824,17 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             for line in uidcache.values():
                 print(line, file=C, end="")
 
-    def select_mailbox(self, mailbox):
+    def _mailboxarg(self, mailbox):
+        if (len(mailbox) < 2 or (
+            mailbox[0],mailbox[-1]) != ('"','"')
+            ) and IMAP_ATOM_SPECIAL.search(mailbox):
+            mailbox = self.conn._quote(mailbox)
+        return codecs.encode(mailbox, 'imap4-utf-7')
+
+    def select_mailbox(self, mailbox, new_only=False):
+        '''Select mailbox and list its messages.  With new_only, only the
+        messages that arrived since the mailbox was last selected in this
+        session are listed (e.g. after IDLE).'''
         self.log.trace()
         assert mailbox in self.mailboxes, (
             'mailbox not in config (%s)' % mailbox
@@ -1558,9 +1843,9 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             self.close_mailbox()
 
         self._clear_state()
+        since = self._uidnext.get(mailbox) if new_only else None
 
-        if self.oldmail_exists(mailbox):
-            self.read_oldmailfile(mailbox)
+        self.read_oldmailfile(mailbox)
 
         self.log.debug('selecting mailbox "%s"' % mailbox + os.linesep)
         try:
@@ -1569,20 +1854,8 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 read_only = False
             else:
                 read_only = True
-            if (len(mailbox) < 2 or (
-                mailbox[0],mailbox[-1]) != ('"','"')
-                ) and IMAP_ATOM_SPECIAL.search(mailbox):
-                (status, count) = self.conn.select(
-                    codecs.encode(
-                        self.conn._quote(mailbox),
-                        'imap4-utf-7'),
-                    read_only)
-            else:
-                (status, count) = self.conn.select(
-                    codecs.encode(
-                        mailbox,
-                        'imap4-utf-7'),
-                    read_only)
+            (status, count) = self.conn.select(self._mailboxarg(mailbox),
+                                               read_only)
             if status == 'NO':
                 # Specified mailbox doesn't exist, no permissions, etc.
                 raise getmailMailboxSelectError(mailbox)
@@ -1603,205 +1876,674 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         self.mailbox = mailbox
         self.uidvalidity = uidvalidity
         self._findmaxuid(mailbox, uidvalidity)
+        if since and since[0] == uidvalidity:
+            since = since[1]
+            self.log.debug('listing messages from UID %d on' % since
+                           + os.linesep)
+        else:
+            since = None
+        highestmodseq = self._readselectstatus(mailbox, count, not since)
 
         imap_search = self.conf['imap_search']
+        self._partiallisting = bool(imap_search)
         if imap_search:
-            result, data = self.conn.search(None, imap_search)
-            data = [d for d in data if d is not None]
-            if result == 'OK' and data:
-                msgs = b','.join(data[0].split())
-                if sys.version_info.major > 2:
-                    msgs = msgs.decode()
-                self._getmsglist(msgs)
-        else:
-            self._getmsglist(count, start=self._mboxmaxuid)
+            if since:
+                uids = self._searchuids(imap_search, 'UID', '%d:*' % since)
+            else:
+                uids = self._searchuids(imap_search)
+            self._getmsglist(count, uids=uids,
+                             candidates=not since and self._deletecandidates())
+        elif highestmodseq is None:
+            start = max(self._mboxmaxuid, since or 1)
+            self._partiallisting = start > 1
+            self._getmsglist(count, start=start, candidates=(
+                start > 1 and not since and self._deletecandidates()
+            ))
+        elif not self._syncmsglist(count, highestmodseq, since):
+            # Full list, so the sync state covers the whole mailbox
+            self._getmsglist(count)
+            self._savesyncstate(highestmodseq)
 
         self._savemaxuid(mailbox, uidvalidity)
 
         return count
 
-    def _getmsglist(self, msgcount, start=1):
+    def _readselectstatus(self, mailbox, count, complete):
+        '''Note the UIDNEXT of the SELECT response for new_only listings and,
+        if the mailbox is listed completely, for unchanged_mailboxes() in
+        later sessions.  Returns its HIGHESTMODSEQ, or None.'''
+        self.log.trace()
+        uidnext = self.conn.response('UIDNEXT')[1][-1]
+        highestmodseq = None
+        if self.condstore:
+            # Missing, or NOMODSEQ, if the mailbox has no mod-sequences
+            modseq = self.conn.response('HIGHESTMODSEQ')[1][-1]
+            if modseq and modseq.isdigit():
+                highestmodseq = int(modseq)
+        if not (uidnext and uidnext.isdigit()):
+            return highestmodseq
+        self._uidnext[mailbox] = (self.uidvalidity, int(uidnext))
+        if complete:
+            self._selectstatus = {
+                'uidvalidity' : self.uidvalidity,
+                'uidnext' : int(uidnext),
+                'messages' : count,
+                'highestmodseq' : highestmodseq,
+            }
+        return highestmodseq
+
+    def _searchuids(self, *criteria):
+        '''Return the UIDs of the messages matching the SEARCH criteria, as
+        strings.  With ESEARCH (RFC 4731), the server returns them as
+        compact ranges.'''
+        self.log.trace()
+        esearch = 'ESEARCH' in self.conn.capabilities
+        if esearch:
+            criteria = ('RETURN', '(ALL)') + criteria
+        data = self._parse_imapuidcmdresponse('SEARCH', *criteria)
+        if esearch:
+            data = list(data) + list(self.conn.response('ESEARCH')[1])
+        try:
+            uids = parse_search_response(data)
+        except ValueError as o:
+            raise getmailOperationError(
+                'IMAP error (failed to parse SEARCH response: %s)' % o
+            )
+        self.log.debug('search %s found %d messages' % (criteria, len(uids))
+                       + os.linesep)
+        return [str(uid) for uid in uids]
+
+    def _deletecandidates(self):
+        '''Return the UIDs of the messages delete_after and delete_bigger_than
+        might apply to, as the server finds them, or () if neither is set.
+        They are only a superset; go() decides from the oldmail timestamps
+        and message sizes as usual.'''
+        self.log.trace()
+        criteria = []
+        if self.app_options['delete_after']:
+            # BEFORE compares internal dates in the server's timezone, by
+            # day; two days of slack keep it a superset
+            before = time.localtime(
+                self.timestamp - (self.app_options['delete_after'] - 2) * 86400
+            )
+            criteria.append(('BEFORE', '%d-%s-%d' % (
+                before.tm_mday, IMAP_MONTHS[before.tm_mon - 1], before.tm_year
+            )))
+        if self.app_options['delete_bigger_than']:
+            criteria.append(('LARGER',
+                             str(self.app_options['delete_bigger_than'])))
+        if not criteria:
+            return ()
+        if len(criteria) == 2:
+            criteria.insert(0, ('OR', ))
+        try:
+            return self._searchuids(*sum(criteria, ()))
+        except getmailOperationError as o:
+            self.log.warning('searching for messages to delete failed (%s)'
+                             % o + os.linesep)
+            return ()
+
+    def _getmsglist(self, msgcount, start=1, uids=None, candidates=()):
+        '''List the messages in the selected mailbox: all of them, those from
+        UID start on, or those with the given uids, plus those of candidates
+        which were seen before (so go() can delete them).'''
         self.log.trace()
         oldest = None
+        items = ('(UID)' if self.app_options['skip_imap_fetch_size']
+                 else '(UID RFC822.SIZE)')
         try:
             if msgcount:
                 # Get UIDs and sizes for all messages in mailbox
-                if start > 1:
-                    fetchcmd=['UID', 'FETCH']
-                    fetchcmd.append("%d:*"%start)
+                if uids is not None:
+                    fetchcmds = [('UID', 'FETCH', uidset)
+                                 for uidset in imap_sequence_sets(uids)]
+                elif start > 1:
+                    fetchcmds = [('UID', 'FETCH', '%d:*' % start)]
                 else:
-                    fetchcmd=['FETCH']
-                    fetchcmd.append(isinstance(msgcount,str) and msgcount or '1:%d'%(msgcount))
-                fetchcmd.append(('(UID)' if self.app_options['skip_imap_fetch_size'] else
-                                 '(UID RFC822.SIZE)'))
-                response = self._parse_imapcmdresponse(*fetchcmd)
-                for line in response:
-                    if not line:
-                        # One user had a server that returned a null response
-                        # somehow -- try to just skip.
-                        continue
-                    r = self._parse_imapattrresponse(line)
-
-
-                    # RFC 3501, 6.1.2 states:
-                    # Since any command can return a status update as untagged data, the
-                    # NOOP command can be used as a periodic poll for new messages or
-                    # message status updates during a period of inactivity (this is the
-                    # preferred method to do this).
-                    #
-                    # This means also a FETCH command can contain a status update.
-                    # ProtonMail Bridge does so, a session can look like:
-                    #
-                    # a LOGIN me@domain password
-                    # ...
-                    # a SELECT INBOX
-                    # ...
-                    # a FETCH 1:50000 (UID RFC822.SIZE)
-                    # * 1 FETCH (UID 1 RFC822.SIZE 8938)
-                    # ...
-                    # * 49999 FETCH (UID 50001 RFC822.SIZE 15500)
-                    # * 50000 FETCH (UID 50002 RFC822.SIZE 9614)
-                    # * 51868 FETCH (FLAGS (NonJunk) UID 51958)
-                    # a OK FETCH completed
-                    #
-                    # While fetching, UID 51958 saw an update and gained new flags.
-                    # So we need to check whether FETCH response lines contain the
-                    # requested items.
-                    if 'uid' not in r:
-                        continue
-
-                    if (not self.app_options['skip_imap_fetch_size']) and ('rfc822.size' not in r):
-                        continue
-
-                    # Don't allow / in UIDs we store, as we look for that to
-                    # detect old-style oldmail files.  Can occur with IMAP, at
-                    # least with some servers.
-                    uid = r['uid'].replace('/', '-')
-
-                    try:
-                        nuid = int(uid)
-                        if (nuid > self._mboxmaxuid):
-                            self._mboxmaxuid = nuid
-                            self._mboxmaxuid_changed = True
-                    except ValueError:
-                        # Presumably non-numeric UID, which should be illegal but according to comment above it can happen
-                        pass
-
-                    msgid = '%s/%s' % (self.uidvalidity, uid)
-                    self._mboxuids[msgid] = r['uid']
-                    self._mboxuidorder.append(msgid)
-                    self.msgnum_by_msgid[msgid] = None
-                    self.msgsizes[msgid] = (0 if
-                        self.app_options['skip_imap_fetch_size']
-                                        else int(r['rfc822.size']))
+                    fetchcmds = [('FETCH', '1:%d' % msgcount)]
+                for fetchcmd in fetchcmds:
+                    self._addmsglist(
+                        self._parse_imapcmdresponse(*fetchcmd + (items, )),
+                        start
+                    )
+                candidates = [uid for uid in candidates or ()
+                              if self._msgidbyuid(uid) in self.oldmail
+                              and self._msgidbyuid(uid) not in self.msgsizes]
+                for uidset in imap_sequence_sets(candidates):
+                    self._addmsglist(self._parse_imapcmdresponse(
+                        'UID', 'FETCH', uidset, items
+                    ))
+                if candidates:
+                    # Keep the mailbox order
+                    self._mboxuidorder.sort(key=lambda msgid: (
+                        int(self._mboxuids[msgid])
+                        if self._mboxuids[msgid].isdigit() else 0
+                    ))
 
                 # Figure out what the oldest UID is
                 if start > 1:
                     response = self._parse_imapcmdresponse('FETCH','1','(UID)')
-                    for line in response:
-                        if not line:
+                    for (unused, r) in self._parse_fetchresponse(response):
+                        if r.get('UID') is None:
                             continue
-                        r = self._parse_imapattrresponse(line)
-                        if 'uid' not in r:
-                            continue
-                        uid = r['uid'].replace('/', '-')
+                        uid = str(r['UID']).replace('/', '-')
                         msgid = '%s/%s' % (self.uidvalidity, uid)
                         oldest = msgid
 
-            # Remove messages from state file that are no longer in mailbox,
-            # but only if the timestamp for them are old (30 days for now).
-            # This is because IMAP users can have one state file but multiple
-            # IMAP folders in different configuration rc files.
-            if oldest:
-                (ov,ou) = oldest.split('/')
-            for msgid in list(self.oldmail):
-                timestamp = self.oldmail[msgid]
-                age = self.timestamp - timestamp
-                if msgid not in self.msgsizes and age > VANISHED_AGE:
-                    # Don't delete oldmails that might still be around if we are only doing partial reads of the mailbox
-                    if oldest:
-                        (mv,mu) = msgid.split('/')
-                        if (ov == mv and ou < mu):
-                            continue
-                    self.log.debug('removing vanished old message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
+            self._forgetvanished(oldest)
 
         except imaplib.IMAP4.error as o:
             raise getmailOperationError('IMAP error (%s)' % o)
         self.gotmsglist = True
 
+    def _addmsglist(self, response, start=1):
+        '''Add the messages in a FETCH (UID RFC822.SIZE) response.'''
+        # One user had a server that returned a null response
+        # somehow -- parse_fetch_response() skips those.
+        for (unused, r) in self._parse_fetchresponse(response):
+
+            # RFC 3501, 6.1.2 states:
+            # Since any command can return a status update as untagged data, the
+            # NOOP command can be used as a periodic poll for new messages or
+            # message status updates during a period of inactivity (this is the
+            # preferred method to do this).
+            #
+            # This means also a FETCH command can contain a status update.
+            # ProtonMail Bridge does so, a session can look like:
+            #
+            # a LOGIN me@domain password
+            # ...
+            # a SELECT INBOX
+            # ...
+            # a FETCH 1:50000 (UID RFC822.SIZE)
+            # * 1 FETCH (UID 1 RFC822.SIZE 8938)
+            # ...
+            # * 49999 FETCH (UID 50001 RFC822.SIZE 15500)
+            # * 50000 FETCH (UID 50002 RFC822.SIZE 9614)
+            # * 51868 FETCH (FLAGS (NonJunk) UID 51958)
+            # a OK FETCH completed
+            #
+            # While fetching, UID 51958 saw an update and gained new flags.
+            # So we need to check whether FETCH response lines contain the
+            # requested items.
+            if r.get('UID') is None:
+                continue
+
+            if (not self.app_options['skip_imap_fetch_size']
+                    and not isinstance(r.get('RFC822.SIZE'), int)):
+                continue
+
+            if start > 1 and isinstance(r['UID'], int) and r['UID'] < start:
+                # "start:*" includes the last message in any case
+                continue
+
+            self._addmsg(str(r['UID']), (0 if
+                self.app_options['skip_imap_fetch_size']
+                                else r['RFC822.SIZE']))
+
+    def _msgidbyuid(self, uid):
+        # Don't allow / in UIDs we store, as we look for that to
+        # detect old-style oldmail files.  Can occur with IMAP, at
+        # least with some servers.
+        return '%s/%s' % (self.uidvalidity, uid.replace('/', '-'))
+
+    def _addmsg(self, uid, size):
+        '''Add a message to the list of messages in the selected mailbox.'''
+        msgid = self._msgidbyuid(uid)
+        try:
+            nuid = int(uid)
+            if (nuid > self._mboxmaxuid):
+                self._mboxmaxuid = nuid
+                self._mboxmaxuid_changed = True
+        except ValueError:
+            # Presumably non-numeric UID, which should be illegal but according to comment above it can happen
+            pass
+        self._mboxuids[msgid] = uid
+        self._mboxuidorder.append(msgid)
+        self.msgnum_by_msgid[msgid] = None
+        self.msgsizes[msgid] = size
+
+    def _forgetvanished(self, oldest=None):
+        # Remove messages from state file that are no longer in mailbox,
+        # but only if the timestamp for them are old (30 days for now).
+        # This is because IMAP users can have one state file but multiple
+        # IMAP folders in different configuration rc files.
+        if oldest:
+            (ov,ou) = oldest.split('/')
+        for msgid in self.oldmail.expired(self.timestamp - VANISHED_AGE):
+            if msgid not in self.msgsizes:
+                # Don't delete oldmails that might still be around if we are only doing partial reads of the mailbox
+                if oldest:
+                    (mv,mu) = msgid.split('/')
+                    if (ov == mv and ou < mu):
+                        continue
+                self.log.debug('removing vanished old message id %s' % msgid
+                               + os.linesep)
+                del self.oldmail[msgid]
+
+    def _syncfilename(self, kind, mailbox=None):
+        '''Return the imap_sync_state file of the given kind, named like the
+        oldmail file of the account ('status') or of a mailbox ('list').'''
+        return '%s-%s%s' % (
+            self._fileexpand(self.app_options['imap_sync_state']), kind,
+            os.path.basename(self._oldmail_filename(mailbox))[len('oldmail'):]
+        )
+
+    def _synclist(self, load=True):
+        '''Return the SyncList of the selected mailbox.  It is kept between
+        the sessions of a getmail run (e.g. with --idle) and read from its
+        file again only if another run changed it.'''
+        synclist = self._synclists.get(self.mailbox)
+        if synclist is None:
+            synclist = SyncList(self._syncfilename('list', self.mailbox),
+                                self.log, '%s:%s' % (self, self.mailbox))
+            self._synclists[self.mailbox] = synclist
+        elif not synclist.changed_on_disk():
+            return synclist
+        if load:
+            synclist.load()
+        return synclist
+
+    def _commitsynclist(self, synclist):
+        try:
+            with _syncstate_lock:
+                wrote = synclist.commit()
+        except (IOError, OSError) as o:
+            self.log.error('failed writing sync state file %s (%s)'
+                           % (synclist.filename, o) + os.linesep)
+            # Written again completely by the next commit
+            synclist.pending = None
+            return
+        self.log.debug('wrote %d lines of sync state for %s (modseq %s, '
+                       '%d uids)' % (wrote, self.mailbox, synclist.modseq,
+                                     len(synclist)) + os.linesep)
+
+    def _readsyncstate(self):
+        filename = self._syncfilename('status')
+        try:
+            with open(filename) as f:
+                state = json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError as o:
+            self.log.warning('ignoring malformed sync state file %s (%s)'
+                             % (filename, o) + os.linesep)
+            return {}
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+    def _savesyncstate(self, highestmodseq):
+        '''Record the message list of the selected mailbox, valid as of
+        highestmodseq, for the next session's _syncmsglist().'''
+        self.log.trace()
+        uids = [self._mboxuids[msgid] for msgid in self._mboxuidorder]
+        if not self.uidvalidity or not all(uid.isdigit() for uid in uids):
+            return
+        skip_size = self.app_options['skip_imap_fetch_size']
+        synclist = self._synclist(load=False)
+        synclist.reset(self.uidvalidity, highestmodseq, [
+            (int(self._mboxuids[msgid]),
+             None if skip_size else self.msgsizes[msgid])
+            for msgid in self._mboxuidorder
+        ])
+        self._commitsynclist(synclist)
+
+    def _writesyncstate(self, mailbox, entry):
+        '''Set the STATUS entry of mailbox in the account's sync state file,
+        or remove it if entry is None.'''
+        if entry is None:
+            self._syncstate.pop(mailbox, None)
+        else:
+            self._syncstate[mailbox] = entry
+        filename = self._syncfilename('status')
+        with _syncstate_lock:
+            # Re-read the file, in case another session updated other
+            # mailboxes
+            state = self._readsyncstate()
+            if entry is not None:
+                state[mailbox] = entry
+            elif mailbox in state:
+                del state[mailbox]
+            else:
+                return
+            statefile = None
+            try:
+                statefile = updatefile(filename)
+                json.dump(state, statefile, separators=(',', ':'))
+                statefile.close()
+            except IOError as o:
+                self.log.error('failed writing sync state file %s (%s)'
+                               % (filename, o) + os.linesep)
+                if statefile:
+                    statefile.abort()
+
+    def _savestatus(self):
+        '''Record the STATUS of the selected mailbox as of SELECT, if the pass
+        over it left nothing to do until it changes (or deletions are due),
+        for unchanged_mailboxes().'''
+        self.log.trace()
+        entry = dict(self._selectstatus)
+        remaining = [msgid for msgid in self._mboxuidorder
+                     if not self.deleted.get(msgid)]
+        bigger = self.app_options['delete_bigger_than']
+        if (self.app_options['read_all']
+                # Without mod-sequences, flag changes can't be seen
+                or (self.conf['imap_search']
+                    and entry['highestmodseq'] is None)
+                or any(msgid not in self.oldmail for msgid in remaining)
+                or (self.app_options['delete'] and remaining)
+                or (bigger and any(self.msgsizes[msgid] > bigger
+                                   for msgid in remaining))):
+            entry = None
+        elif self.app_options['delete_after']:
+            if self._partiallisting:
+                # Seen messages outside the listing may be due as well
+                timestamps = list(self.oldmail.values())
+            else:
+                timestamps = [self.oldmail[msgid] for msgid in remaining]
+            entry['due'] = (
+                min(timestamps) + self.app_options['delete_after'] * 86400
+                if timestamps else None
+            )
+        if self._syncstate.get(self.mailbox) != entry:
+            self._writesyncstate(self.mailbox, entry)
+
+    def unchanged_mailboxes(self, mailboxes):
+        '''Return the mailboxes whose STATUS (UIDVALIDITY, UIDNEXT, MESSAGES
+        and, with CONDSTORE, HIGHESTMODSEQ) is as recorded after the last
+        pass over them, and which have no deletions due, so they need not be
+        selected at all.  Needs imap_sync_state.  The server is asked with a
+        single LIST-STATUS command (RFC 5819), or pipelined STATUS commands.
+        '''
+        self.log.trace()
+        statuses = self._liststatus
+        self._liststatus = None
+        if not self.app_options.get('imap_sync_state'):
+            return set()
+        known = {}
+        for mailbox in mailboxes:
+            entry = self._syncstate.get(mailbox)
+            if entry and not (entry.get('due')
+                              and entry['due'] <= self.timestamp):
+                known[mailbox] = entry
+        if not known:
+            return set()
+        items = self._statusitems()
+        if statuses is None:
+            statuses = self._mailboxstatus(known, items)
+        unchanged = set()
+        for (mailbox, entry) in known.items():
+            status = statuses.get('INBOX' if mailbox.upper() == 'INBOX'
+                                  else mailbox)
+            if status and all(str(status.get(item))
+                              == str(entry.get(item.lower()))
+                              for item in items):
+                unchanged.add(mailbox)
+                self._uidnext[mailbox] = (entry['uidvalidity'],
+                                          entry['uidnext'])
+        self.log.debug('unchanged mailboxes: %s' % sorted(unchanged)
+                       + os.linesep)
+        return unchanged
+
+    def _statusitems(self):
+        items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+        if self.condstore:
+            items.append('HIGHESTMODSEQ')
+        return items
+
+    def _mailboxstatus(self, mailboxes, items):
+        '''Return the STATUS items of mailboxes, as parse_status_responses()
+        does.'''
+        self.log.trace()
+        self.conn.untagged_responses.pop('STATUS', None)
+        try:
+            if len(mailboxes) > 1 and 'LIST-STATUS' in self.conn.capabilities:
+                self.conn._simple_command('LIST', '""', '*', 'RETURN',
+                                          '(STATUS (%s))' % ' '.join(items))
+                self.conn.untagged_responses.pop('LIST', None)
+            else:
+                tags = [self.conn._command('STATUS', self._mailboxarg(mailbox),
+                                           '(%s)' % ' '.join(items))
+                        for mailbox in mailboxes]
+                for tag in tags:
+                    try:
+                        self.conn._command_complete('STATUS', tag)
+                    except imaplib.IMAP4.abort:
+                        raise
+                    except imaplib.IMAP4.error as o:
+                        # e.g. a mailbox that was removed
+                        self.log.debug('STATUS failed (%s)' % o + os.linesep)
+        except imaplib.IMAP4.abort as o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        except imaplib.IMAP4.error as o:
+            self.log.warning('LIST-STATUS failed (%s)' % o + os.linesep)
+        return parse_status_responses(
+            self.conn.untagged_responses.pop('STATUS', [])
+        )
+
+    def _fetchchanges(self, synclist):
+        '''Apply the changes since the HIGHESTMODSEQ of synclist to it: the
+        messages from FETCH CHANGEDSINCE, less those reported VANISHED.
+
+        Returns False if the responses can't be parsed.
+        '''
+        self.log.trace()
+        skip_size = self.app_options['skip_imap_fetch_size']
+        modseq = synclist.modseq
+        self.log.debug('fetching changes since modseq %d' % modseq
+                       + os.linesep)
+        self.conn.untagged_responses.pop('VANISHED', None)
+        response = self._parse_imapuidcmdresponse(
+            'FETCH', '1:*', '(UID)' if skip_size else '(UID RFC822.SIZE)',
+            '(CHANGEDSINCE %d%s)'
+            % (modseq, ' VANISHED' if self.qresync else '')
+        )
+        added = {}
+        vanished = []
+        try:
+            for (_msgnum, items) in parse_fetch_response(response):
+                uid = items.get('UID')
+                size = None if skip_size else items.get('RFC822.SIZE')
+                # Skip unsolicited responses, i.e. flag updates
+                if isinstance(uid, int) and (skip_size
+                                             or isinstance(size, int)):
+                    added[uid] = size
+            for line in self.conn.response('VANISHED')[1]:
+                if line:
+                    # "(EARLIER) 1:5,7"
+                    vanished.extend(parse_sequence_set(
+                        tostr(line).split()[-1]))
+        except ValueError as o:
+            self.log.warning('failed to parse changes since modseq %d '
+                             '(%s), fetching message list' % (modseq, o)
+                             + os.linesep)
+            return False
+        for uid in sorted(added):
+            synclist.add(uid, added[uid])
+        for (first, last) in vanished:
+            if last - first < len(synclist):
+                uids = range(first, last + 1)
+            else:
+                uids = [uid for uid in synclist.sizes if first <= uid <= last]
+            for uid in uids:
+                synclist.remove(uid)
+        return True
+
+    def _syncmsglist(self, msgcount, highestmodseq, since=None):
+        '''Build the message list from the state saved by an earlier session,
+        asking the server only for the messages changed or expunged since
+        (CONDSTORE/QRESYNC, RFC 7162).  With since, only the messages from
+        that UID on are listed.
+
+        Returns False if there is no usable state and the full list has to
+        be fetched instead.
+        '''
+        self.log.trace()
+        synclist = self._synclist()
+        if (synclist.uidvalidity != self.uidvalidity
+                or synclist.modseq is None
+                or (synclist.unsized
+                    and not self.app_options['skip_imap_fetch_size'])):
+            return False
+
+        changed = (synclist.modseq != highestmodseq
+                   or msgcount != len(synclist))
+        if changed and not self._fetchchanges(synclist):
+            return False
+        if len(synclist) != msgcount:
+            # Messages were expunged and the server (without QRESYNC) didn't
+            # tell us which ones
+            self.log.debug('sync state has %d messages, mailbox %d, '
+                           'fetching message list'
+                           % (len(synclist), msgcount) + os.linesep)
+            return False
+
+        sizes = synclist.sizes
+        if since:
+            self._partiallisting = True
+            uids = sorted(uid for uid in sizes if uid >= since)
+        else:
+            uids = sorted(sizes)
+        for uid in uids:
+            self._addmsg(str(uid), sizes[uid] or 0)
+        if not since:
+            self._forgetvanished()
+        self.gotmsglist = True
+        if changed:
+            synclist.set_modseq(highestmodseq)
+            self._commitsynclist(synclist)
+        return True
+
     def __getitem__(self, i):
         return self._mboxuidorder[i]
 
     def _flagmsgbyid(self, msgid):
         self.log.trace()
+        uid = self._getmboxuidbymsgid(msgid)
+        # Flagging is done for all messages at once by _flagpending() when
+        # the mailbox is closed.
+        self.log.debug('will delete message "%s"' % uid + os.linesep)
+        self._flaguids.append(uid)
+        flag = self.conf.get('imap_on_delete',None) or r'(\Deleted \Seen)'
+        return 'Deleted' in flag
+
+    def _flagpending(self):
+        '''Copy/move and flag the messages collected by _flagmsgbyid(), using
+        one command per UID sequence set instead of one per message.
+
+        Returns True if the messages flagged for deletion have already been
+        expunged (with UID MOVE or UID EXPUNGE).
+        '''
+        self.log.trace()
+        uids = self._flaguids
+        self._flaguids = []
+        if not uids:
+            return False
+        flag = self.conf.get('imap_on_delete',None) or r'(\Deleted \Seen)'
+        capabilities = self.conn.capabilities
+        gmail = 'X-GM-EXT-1' in capabilities
+        expunged = 'Deleted' in flag and 'UIDPLUS' in capabilities
+        # GMail handles folders as labels, so keep copying there
+        move = ('Deleted' in flag and 'MOVE' in capabilities and not gmail
+                and self.conf['move_on_delete'])
         try:
-            uid = self._getmboxuidbymsgid(msgid)
-            #self._selectmailbox(mailbox)
-            # Delete message
-            if self.conf['move_on_delete']:
-                self.log.debug('copying message to folder "%s"'
-                               % self.conf['move_on_delete'] + os.linesep)
-                response = self._parse_imapuidcmdresponse(
-                    'COPY', uid, self.conf['move_on_delete']
-                )
-            self.log.debug('deleting message "%s"' % uid + os.linesep)
+            for uidset in imap_sequence_sets(uids):
+                if self.conf['move_on_delete']:
+                    if move:
+                        self.log.debug('moving messages %s to folder "%s"'
+                                       % (uidset, self.conf['move_on_delete'])
+                                       + os.linesep)
+                        self._parse_imapuidcmdresponse(
+                            'MOVE', uidset, self.conf['move_on_delete']
+                        )
+                        continue
+                    self.log.debug('copying messages %s to folder "%s"'
+                                   % (uidset, self.conf['move_on_delete'])
+                                   + os.linesep)
+                    self._parse_imapuidcmdresponse(
+                        'COPY', uidset, self.conf['move_on_delete']
+                    )
+                self.log.debug('deleting messages %s' % uidset + os.linesep)
 
-            # On GMail you need to remove LABELS before deleting
-            if 'X-GM-EXT-1' in self.conn.capabilities:
-                self._parse_imapuidcmdresponse('STORE', uid,'X-GM-LABELS', '()')
+                # On GMail you need to remove LABELS before deleting
+                if gmail:
+                    self._parse_imapuidcmdresponse('STORE', uidset,
+                                                   'X-GM-LABELS', '()')
 
-            flag = self.conf.get('imap_on_delete',None) or r'(\Deleted \Seen)'
-            response = self._parse_imapuidcmdresponse(
-                'STORE', uid, 'FLAGS', flag
-            )
-            return 'Deleted' in flag
+                self._parse_imapuidcmdresponse('STORE', uidset, 'FLAGS', flag)
+                if expunged:
+                    # Only expunge our own messages
+                    self._parse_imapuidcmdresponse('EXPUNGE', uidset)
         except imaplib.IMAP4.error as o:
             raise getmailOperationError('IMAP error (%s)' % o)
+        return bool(expunged or move)
+
+    def _gmailitems(self):
+        '''Return the Gmail metadata FETCH items to request along with the
+        message, if the server supports Google's IMAP extensions.'''
+        if 'X-GM-EXT-1' in self.conn.capabilities:
+            return ' X-GM-LABELS X-GM-THRID X-GM-MSGID'
+        return ''
 
-    def _getmsgpartbyid(self, msgid, part):
+    def _getmsgpartbyid(self, msgid, part, items=None):
         self.log.trace()
         try:
             uid = self._getmboxuidbymsgid(msgid)
-            # Retrieve message
-            self.log.debug('retrieving body for message "%s"' % uid
-                           + os.linesep)
-            try:
-                response = self._parse_imapuidcmdresponse('FETCH', uid, part)
-            except (imaplib.IMAP4.error, getmailOperationError) as o:
-                # server gave a negative/NO response, most likely.  Bad server,
-                # no doughnut.
-                raise getmailRetrievalError(
-                    'failed to retrieve msgid %s; server said %s'
-                    % (msgid, o)
-                )
-            # Response is really ugly:
-            #
-            # [
-            #   (
-            #       '1 (UID 1 RFC822 {704}',
-            #       'message text here with CRLF EOL'
-            #   ),
-            #   ')',
-            #   <maybe more>
-            # ]
+            if items is not None:
+                self.log.debug('using prefetched body for message "%s"' % uid
+                               + os.linesep)
+            else:
+                # Retrieve message
+                self.log.debug('retrieving body for message "%s"' % uid
+                               + os.linesep)
+                try:
+                    response = self._parse_imapuidcmdresponse('FETCH', uid,
+                                                              part)
+                except (imaplib.IMAP4.error, getmailOperationError) as o:
+                    # server gave a negative/NO response, most likely.  Bad
+                    # server, no doughnut.
+                    raise getmailRetrievalError(
+                        'failed to retrieve msgid %s; server said %s'
+                        % (msgid, o)
+                    )
+                # Response is really ugly:
+                #
+                # [
+                #   (
+                #       '1 (UID 1 RFC822 {704}',
+                #       'message text here with CRLF EOL'
+                #   ),
+                #   ')',
+                #   <maybe more>
+                # ]
+                #
+                # so leave it to the parser, and take the first response
+                # that has the message in it.
+                try:
+                    fetched = parse_fetch_response(response)
+                except ValueError as o:
+                    raise getmailRetrievalError(
+                        'failed to parse response for msgid %s (%s)'
+                        % (msgid, o)
+                    )
+                items = {}
+                for (unused, fetcheditems) in fetched:
+                    if fetch_body(fetcheditems) is not None:
+                        items = fetcheditems
+                        break
 
             # MSExchange is broken -- if a message is badly formatted enough
             # (virus, spam, trojan), it can completely fail to return the
             # message when requested.
-            try:
-                try:
-                    sbody = response[0][1]
-                except Exception as o:
-                    sbody = None
-                if not sbody:
-                    raise getmailRetrievalError('bad message from server!')
+            sbody = fetch_body(items)
+            if not sbody:
+                raise getmailRetrievalError('bad message from server!')
+            if isinstance(sbody, bytes):
                 msg = Message(fromstring=sbody)
-            except TypeError as o:
-                # response[0] is None instead of a message tuple
-                raise getmailRetrievalError('failed to retrieve msgid %s'
-                                            % msgid)
+            else:
+                # Spooled to a file by imap_read_spooled()
+                msg = Message(fromspool=sbody)
 
             # record mailbox retrieved from in a header
             if self.conf['record_mailbox']:
@@ -1810,7 +2552,7 @@ class IMAPRetrieverBase(RetrieverSkeleton):
 
             # google extensions: apply labels, etc
             if 'X-GM-EXT-1' in self.conn.capabilities:
-                metadata = self._getgmailmetadata(uid, msg)
+                metadata = self._getgmailmetadata(items)
                 for (header, value) in metadata.items():
                     msg.add_header(header, value)
 
@@ -1819,62 +2561,99 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         except imaplib.IMAP4.error as o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
-    def _getgmailmetadata(self, uid, msg):
+    def _getgmailmetadata(self, items):
         """
-        Add Gmail labels and other metadata which Google exposes through an
-        IMAP extension to headers in the message.
+        Return Gmail labels and other metadata which Google exposes through an
+        IMAP extension as header fields to add to the message.  The metadata
+        is fetched together with the message, see _gmailitems().
 
         See https://developers.google.com/google-apps/gmail/imap_extensions
         """
-        try:
-            # ['976 (X-GM-THRID 1410134259107225671 X-GM-MSGID '
-            #   '1410134259107225671 X-GM-LABELS (labels space '
-            #   'separated) UID 167669)']
-            response = self._parse_imapuidcmdresponse('FETCH', uid,
-                '(X-GM-LABELS X-GM-THRID X-GM-MSGID)')
-        except imaplib.IMAP4.error as o:
-            self.log.warning('Could not fetch google imap extensions: %s' % o)
-            return {}
-
-        if not response or not response[0]:
-            return {}
-
-        ext = re.search(
-            b'X-GM-THRID (?P<THRID>\\d+) X-GM-MSGID (?P<MSGID>\\d+)'
-            b' X-GM-LABELS \\((?P<LABELS>.*)\\) UID',
-            response[0]
-        )
-        if not ext:
+        # {'X-GM-THRID': 1410134259107225671,
+        #  'X-GM-MSGID': 1410134259107225671,
+        #  'X-GM-LABELS': ['labels', 'space', 'separated'], ...}
+        metadata = {}
+        labels = items.get('X-GM-LABELS')
+        if labels and isinstance(labels, list):
+            metadata['X-GMAIL-LABELS'] = ' '.join(imap_quote(label)
+                                                  for label in labels)
+        for item in ('THRID', 'MSGID'):
+            if items.get('X-GM-%s' % item):
+                metadata['X-GMAIL-%s' % item] = str(items['X-GM-%s' % item])
+        if not metadata:
             self.log.warning(
                 'Could not parse google imap extensions. Server said: %s'
-                % repr(response))
-            return {}
+                % repr(dict((name, value) for (name, value) in items.items()
+                            if name.startswith('X-GM-'))))
+        return metadata
 
+    def _fetchbatch(self, msgids, part):
+        '''Retrieve part of several messages with a single UID FETCH command,
+        and return a dictionary of msgid -> parsed response items.
 
-        results = ext.groupdict()
-        metadata = {}
-        for item in ('LABELS', 'THRID', 'MSGID'):
-            if results.get(item):
-                metadata['X-GMAIL-%s' % item] = results[item]
-
-        return metadata
+        Errors are not fatal here; any message missing from the result is
+        simply requested again by itself, which reports the error properly.
+        '''
+        self.log.trace()
+        uids = dict((self._getmboxuidbymsgid(msgid), msgid)
+                    for msgid in msgids)
+        self.log.debug('retrieving %s for %d messages' % (part, len(uids))
+                       + os.linesep)
+        try:
+            response = self._parse_imapuidcmdresponse(
+                'FETCH', ','.join(uids), '(UID %s)' % part.strip('()')
+            )
+            fetched = parse_fetch_response(response)
+        except (imaplib.IMAP4.error, getmailOperationError, ValueError) as o:
+            self.log.debug('batch retrieval failed (%s)' % o + os.linesep)
+            return {}
+        result = {}
+        for (unused, items) in fetched:
+            msgid = uids.get(str(items.get('UID')))
+            if msgid and fetch_body(items):
+                result[msgid] = items
+        return result
+
+    def _prefetchmsgs(self, msgids, part):
+        '''Retrieve several messages with a single UID FETCH command and keep
+        their parsed responses in self._prefetched until getmsg() asks for
+        them.
+        '''
+        if len(msgids) < 2:
+            return
+        self._prefetched.update(self._fetchbatch(msgids, part))
 
     def _getmsgbyid(self, msgid):
         self.log.trace()
         if self.conf.get('use_peek', True):
-            part = '(BODY.PEEK[])'
+            part = '(BODY.PEEK[]%s)' % self._gmailitems()
+            # Only prefetch when peeking, so that messages go() ends up not
+            # retrieving (i.e. max_bytes_per_session) don't get marked \Seen
+            if msgid not in self._prefetched:
+                self._prefetchmsgs(self._readahead(msgid), part)
         else:
-            part = '(RFC822)'
-        return self._getmsgpartbyid(msgid, part)
+            part = '(RFC822%s)' % self._gmailitems()
+        return self._getmsgpartbyid(msgid, part,
+                                    self._prefetched.pop(msgid, None))
 
     def _getheaderbyid(self, msgid):
         self.log.trace()
         if self.conf.get('use_peek', True):
-            part = '(BODY.PEEK[header])'
+            part = '(BODY.PEEK[header]%s)' % self._gmailitems()
         else:
-            part = '(RFC822[header])'
+            part = '(RFC822[header]%s)' % self._gmailitems()
         return self._getmsgpartbyid(msgid, part)
 
+    def _getheadersbyid(self, msgids):
+        self.log.trace()
+        if len(msgids) < 2:
+            return {}
+        # Fetching the header fields never sets \Seen
+        part = '(BODY.PEEK[HEADER]%s)' % self._gmailitems()
+        return dict((msgid, self._getmsgpartbyid(msgid, part, items))
+                    for (msgid, items)
+                    in self._fetchbatch(msgids, part).items())
+
     def initialize(self, options):
         self.log.trace()
         self.mailboxes = self.conf.get('mailboxes', ('INBOX', ))
@@ -1894,6 +2673,9 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         try:
             self.log.trace('trying self._connect()' + os.linesep)
             self._connect()
+            self._settimeout()
+            self.conn.spool_bytes = self.app_options.get('message_spool_bytes',
+                                                         0)
             try:
                 self.log.trace('logging in' + os.linesep)
                 if self.conf['use_kerberos'] and HAVE_KERBEROS_GSS:
@@ -1950,6 +2732,7 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             else:
                 self.conn.capabilities = tuple(tostr(dat[-1]).upper().split())
 
+            self.notify = False
             if 'IDLE' in self.conn.capabilities:
                 self.supports_idle = True
                 imaplib.Commands['IDLE'] = ('AUTH', 'SELECTED')
@@ -1957,6 +2740,10 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             if 'ID' in self.conn.capabilities:
                 self.supports_id = True
 
+            if self.app_options.get('imap_sync_state'):
+                self._syncstate = self._readsyncstate()
+                self.enable_condstore()
+
             if self.supports_id and self.conf['imap_id_extension']:
                 self.id()
 
@@ -1967,6 +2754,27 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         except imaplib.IMAP4.error as o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
+    def enable_condstore(self):
+        '''Have the server report mod-sequences (RFC 7162), so select_mailbox()
+        can list just the changes since the sync state was saved.'''
+        capabilities = self.conn.capabilities
+        self.condstore = 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities
+        if not self.condstore:
+            self.log.info('server supports neither CONDSTORE nor QRESYNC, '
+                          'listing changed mailboxes in full' + os.linesep)
+            return
+        if 'QRESYNC' in capabilities and 'ENABLE' in capabilities:
+            try:
+                typ = self.conn._simple_command('ENABLE', 'QRESYNC')[0]
+                self.qresync = (typ == 'OK')
+            except imaplib.IMAP4.error as o:
+                self.log.debug('ENABLE QRESYNC failed (%s)' % o + os.linesep)
+        elif 'ENABLE' in capabilities:
+            try:
+                self.conn._simple_command('ENABLE', 'CONDSTORE')
+            except imaplib.IMAP4.error as o:
+                self.log.debug('ENABLE CONDSTORE failed (%s)' % o + os.linesep)
+
     def abort(self):
         self.log.trace()
         RetrieverSkeleton.abort(self)
@@ -1978,72 +2786,100 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             pass
         self.conn = None
 
-    def go_idle(self, folder, timeout=300):
-        """Initiates IMAP's IDLE mode if the server supports it
-
-        Waits until state of current mailbox changes, and then returns. Returns
-        True if the connection still seems to be up, False otherwise.
+    def idle_start(self, folders):
+        """Enter IDLE mode on the first of folders without waiting.  The other
+        folders are watched through NOTIFY (RFC 5465) if the server supports
+        it, and checked with STATUS in any case.  The caller waits for the
+        connection's socket to become readable (or for its IDLE timeout), and
+        then calls idle_done().
 
-        May throw getmailOperationError if the server refuses the IDLE setup
-        (e.g. if the server does not support IDLE)
-
-        Default timeout is 5 minutes.
+        Returns the folders that already have new messages, in which case
+        IDLE is not entered.
         """
-
         if not self.supports_idle:
-            self.log.warning('IDLE not supported, so not idling\n')
             raise getmailOperationError(
                 'IMAP4 IDLE requested, but not supported by server'
             )
-
-        # Based on current imaplib IDLE patch: http://bugs.python.org/issue11245
+        changed = [folder for folder in folders[1:]
+                   if self._idlestatus(folder)]
         self.conn.untagged_responses = {}
-        self.conn.select(folder)
-        tag = self.conn._command('IDLE')
-        data = self.conn._get_response() # read continuation response
+        status = self.conn.select(self._mailboxarg(folders[0]))[0]
+        if status != 'OK':
+            raise getmailMailboxSelectError(folders[0])
+        uidvalidity = tostr(self.conn.response('UIDVALIDITY')[1][0] or b'') or None
+        uidnext = self.conn.response('UIDNEXT')[1][-1]
+        if (uidnext and uidnext.isdigit()
+                and self._idlechanged(folders[0], (uidvalidity, int(uidnext)))):
+            changed.insert(0, folders[0])
+        if changed:
+            return changed
+
+        if len(folders) > 1 and not self.notify and 'NOTIFY' in self.conn.capabilities:
+            imaplib.Commands.setdefault('NOTIFY', ('AUTH', 'SELECTED'))
+            try:
+                typ = self.conn._simple_command(
+                    'NOTIFY', 'SET', '(selected MessageNew MessageExpunge)',
+                    '(mailboxes (%s) MessageNew MessageExpunge)'
+                    % ' '.join(tostr(self._mailboxarg(folder))
+                               for folder in folders[1:])
+                )[0]
+                self.notify = (typ == 'OK')
+            except imaplib.IMAP4.error as o:
+                self.log.debug('NOTIFY failed (%s)' % o + os.linesep)
 
+        self._idlefolders = folders
+        self._idletag = self.conn._command('IDLE')
+        data = self.conn._get_response() # read continuation response
         if data is not None:
             raise getmailOperationError(
                 'IMAP4 IDLE requested, but server refused IDLE request: %s'
                 % data
             )
-
         self.log.debug('Entering IDLE mode (server says "%s")\n'
                        % self.conn.continuation_response)
+        return []
 
-        try:
-            aborted = None
-            (readable, unused, _) = select.select([self.conn.sock], [], [], timeout)
-        except KeyboardInterrupt as o:
-            # Delay raising this until we've stopped IDLE mode
-            aborted = o
-
-        if aborted is not None:
-            self.log.debug('IDLE mode cancelled\n')
-        elif readable:
-            # The socket has data waiting; server has updated status
-            self.log.info('IDLE message received\n')
-        else:
-            self.log.debug('IDLE timeout (%ds)\n' % timeout)
+    def idle_done(self):
+        """Leave IDLE mode entered with idle_start().
 
-        try:
-            self.conn.untagged_responses = {}
-            self.conn.send(b'DONE\r\n')
-            self.conn._command_complete('IDLE', tag)
-        except imaplib.IMAP4.error as o:
-            return False
-        except BrokenPipeError as o:
-            # The underlying connection closed during IDLE
-            self.log.info('BrokenPipeError after IDLE\n')
-            return False
-        except TimeoutError as o:
-            self.log.info('TimeoutError after IDLE\n')
+        Returns the folders with new messages.
+        """
+        folders = self._idlefolders
+        self.conn.untagged_responses = {}
+        self.conn.send(b'DONE\r\n')
+        self.conn._command_complete('IDLE', self._idletag)
+        changed = []
+        if ('EXISTS' in self.conn.untagged_responses
+                or 'RECENT' in self.conn.untagged_responses):
+            changed.append(folders[0])
+        changed.extend(folder for folder in folders[1:]
+                       if self._idlestatus(folder))
+        self.log.debug('IDLE done, new messages in %s' % changed
+                       + os.linesep)
+        return changed
+
+    def _idlestatus(self, folder):
+        # Unsolicited STATUS responses (NOTIFY) would be returned too
+        self.conn.untagged_responses.pop('STATUS', None)
+        (status, data) = self.conn.status(self._mailboxarg(folder),
+                                          '(UIDNEXT UIDVALIDITY)')
+        if status != 'OK':
+            raise getmailMailboxSelectError(folder)
+        line = tostr(data[-1] or b'')
+        uidnext = re.search(r'UIDNEXT (\d+)', line, re.IGNORECASE)
+        uidvalidity = re.search(r'UIDVALIDITY (\d+)', line, re.IGNORECASE)
+        if not uidnext:
             return False
+        return self._idlechanged(folder, (uidvalidity and uidvalidity.group(1),
+                                          int(uidnext.group(1))))
 
-        if aborted:
-            raise aborted
-
-        return True
+    def _idlechanged(self, folder, state):
+        # state is (uidvalidity, uidnext); it changes when messages arrive.
+        # Nothing is new if select_mailbox() has listed up to there already.
+        seen = self._idleseen.get(folder, self._uidnext.get(folder))
+        self._idleseen[folder] = state
+        return seen is not None and state not in (seen,
+                                                  self._uidnext.get(folder))
 
     def quit(self):
         self.log.trace()
@@ -2101,22 +2937,27 @@ class MultidropIMAPRetrieverBase(IMAPRetrieverBase):
     def _getmsgbyid(self, msgid):
         self.log.trace()
         msg = IMAPRetrieverBase._getmsgbyid(self, msgid)
-        data = {}
+        header = self.headercache.get(msgid)
+        if header is not None and header.recipient is not None:
+            msg.recipient = header.recipient
+        else:
+            self._setenvelope(msg)
+        return msg
+
+    def _setenvelope(self, msg):
+        # Only the envelope recipient header fields need decoding
+        values = []
         for (name, encoded_value) in msg.headers():
-            name = name.lower()
+            if name.lower() != self.envrecipname:
+                continue
             for (val, encoding) in decode_header(encoded_value):
-                val = val.strip()
-                if name in data:
-                    data[name].append(val)
-                else:
-                    data[name] = [val]
+                values.append(val.strip())
 
         try:
-            line = data[self.envrecipname][self.envrecipnum]
-        except (KeyError, IndexError) as unused:
+            line = values[self.envrecipnum]
+        except IndexError as unused:
             raise getmailConfigurationError(
                 'envelope_recipient specified header missing (%s)'
                 % self.conf['envelope_recipient']
             )
         msg.recipient = address_no_brackets(line.strip())
-        return msg
@@ -15,7 +15,7 @@ import codecs
 from collections import namedtuple
 import tempfile
 import errno
-from threading import Condition
+from threading import Condition, current_thread
 import socket
 
 from argparse import Namespace
@@ -442,26 +442,46 @@ class ForkingBase(object):
                 'got child pid %d, not %d'
                 % (self.__child_pid, childpid)
             )
-        if os.WIFSTOPPED(self.__child_status):
+        return self._child_exitcode(self.__child_pid, self.__child_status)
+
+    def _poll_for_child(self, childpid):
+        '''Like _wait_for_child(), for threads other than the main thread
+        (getmail --parallel), which cannot handle SIGCHLD.'''
+        deadline = time.time() + (socket.getdefaulttimeout() or 60)
+        delay = 0.001
+        while True:
+            (pid, status) = os.waitpid(childpid, os.WNOHANG)
+            if pid:
+                return self._child_exitcode(pid, status)
+            if time.time() > deadline:
+                raise getmailOperationError('waiting child pid %d timed out'
+                                            % childpid)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def _child_exitcode(self, pid, status):
+        if os.WIFSTOPPED(status):
             raise getmailOperationError(
                 'child pid %d stopped by signal %d'
-                % (self.__child_pid, os.WSTOPSIG(self.__child_status))
+                % (pid, os.WSTOPSIG(status))
             )
-        if os.WIFSIGNALED(self.__child_status):
+        if os.WIFSIGNALED(status):
             raise getmailOperationError(
                 'child pid %d killed by signal %d'
-                % (self.__child_pid, os.WTERMSIG(self.__child_status))
+                % (pid, os.WTERMSIG(status))
             )
-        if not os.WIFEXITED(self.__child_status):
+        if not os.WIFEXITED(status):
             raise getmailOperationError('child pid %d failed to exit'
-                                        % self.__child_pid)
-        exitcode = os.WEXITSTATUS(self.__child_status)
+                                        % pid)
+        exitcode = os.WEXITSTATUS(status)
         return exitcode
 
     def _pipemail(self, msg, delivered_to, received, unixfrom, stdout, stderr):
         # Write out message
         msgfile = TemporaryFile23()
-        msgfile.write(msg.flatten(delivered_to, received, include_from=unixfrom))
+        for chunk in msg.flatten_iter(delivered_to, received,
+                                      include_from=unixfrom):
+            msgfile.write(chunk)
         msgfile.flush()
         os.fsync(msgfile.fileno())
         # Rewind
@@ -484,9 +504,13 @@ class ForkingBase(object):
         child.stderr = TemporaryFile23()
         child.childpid = os.fork()
         if child.childpid != 0: # here (in the parent)
-            self._prepare_child()
-            self.log.trace('spawned child %d\n' % child.childpid)
-            child.exitcode = self._wait_for_child(child.childpid)
+            if current_thread().name != 'MainThread':
+                self.log.trace('spawned child %d\n' % child.childpid)
+                child.exitcode = self._poll_for_child(child.childpid)
+            else:
+                self._prepare_child()
+                self.log.trace('spawned child %d\n' % child.childpid)
+                child.exitcode = self._wait_for_child(child.childpid)
             child.stderr.seek(0)
             child.err = child.stderr.read().strip().decode()
             child.stdout.seek(0)
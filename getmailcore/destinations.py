@@ -19,6 +19,7 @@ import sys
 import os
 import re
 import smtplib
+import threading
 import types
 
 try:
@@ -51,6 +52,55 @@ def exit_with(stderr,errmsg):
     os.fsync(stderr.fileno())
     os._exit(127)
 
+# Idle LMTP connections by (host, port), shared by all MDA_lmtp destinations
+_lmtp_idle = {}
+_lmtp_lock = threading.Lock()
+# Bytes per BDAT command, and sent at once
+_LMTP_CHUNK = 1 << 16
+
+_lmtp_eol = re.compile(br'\r?\n')
+_lmtp_dot = re.compile(br'^\.', re.MULTILINE)
+
+def _lmtp_crlf(chunk):
+    return _lmtp_eol.sub(b'\r\n', chunk)
+
+def _lmtp_dotstuff(chunk):
+    # flatten_iter() chunks always start at the beginning of a line
+    return _lmtp_dot.sub(b'..', chunk)
+
+class _LMTPCommands(object):
+    '''Commands of one LMTP transaction, sent together with PIPELINING.
+
+    replies holds the replies to the commands, in order; None for those
+    not read yet.
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.pipelining = server.has_extn('pipelining')
+        self.pending = []
+        self.replies = []
+
+    def flush(self, wait=True):
+        self.server.send(b''.join(self.pending))
+        del self.pending[:]
+        if wait:
+            for (i, reply) in enumerate(self.replies):
+                if reply is None:
+                    self.replies[i] = self.server.getreply()
+
+    def send(self, data, wait=False):
+        self.pending.append(data)
+        if wait:
+            self.flush()
+        elif sum(len(data) for data in self.pending) >= _LMTP_CHUNK:
+            self.flush(wait=False)
+
+    def command(self, line, data=b''):
+        # Without PIPELINING, wait for each reply in turn
+        self.replies.append(None)
+        self.send(line.encode('utf-8') + b'\r\n' + data,
+                  wait=not self.pipelining)
+
 #######################################
 class DeliverySkeleton(ConfigurableBase):
     '''Base class for implementing message-delivery classes.
@@ -83,6 +133,11 @@ class DeliverySkeleton(ConfigurableBase):
                         and deliver it, returning a string describing the
                         result.
 
+    Destinations which can make a batch of deliveries durable at once (group
+    commit) override commit() and rollback(); with set_batching(True),
+    deliveries are only safe after commit().  Destinations which keep
+    something open between messages release it in close().
+
     See the Maildir class for a good, simple example.
     '''
     def __init__(self, **args):
@@ -97,6 +152,7 @@ class DeliverySkeleton(ConfigurableBase):
         self.received_with = None
         self.received_by = None
         self.retriever = None
+        self.batching = False
         self.log.trace('done\n')
 
     def retriever_info(self, retriever):
@@ -111,7 +167,29 @@ class DeliverySkeleton(ConfigurableBase):
         msg.received_from = self.received_from
         msg.received_with = self.received_with
         msg.received_by = self.received_by
-        return self._deliver_message(msg, delivered_to, received)
+        result = self._deliver_message(msg, delivered_to, received)
+        if not self.batching:
+            self.commit()
+        return result
+
+    def set_batching(self, batching):
+        '''With batching, deliver_message() leaves committing the deliveries
+        to the caller.'''
+        self.batching = batching
+
+    def commit(self):
+        '''Make the deliveries since the last commit() durable.'''
+        pass
+
+    def rollback(self):
+        '''Drop the deliveries since the last commit(), as far as they
+        aren't durable yet.'''
+        pass
+
+    def close(self):
+        '''Release what the destination keeps between messages; called at
+        the end of a session.'''
+        pass
 
     def some_security(self):
         if ((os.geteuid() == 0 or os.getegid() == 0)
@@ -141,6 +219,8 @@ class Maildir(DeliverySkeleton, ForkingBase):
         self.log.trace()
         self.hostname = localhostname()
         self.dcount = 0
+        # (tmp, new) file names of the deliveries not committed yet
+        self._pending = []
         try:
             self.conf['filemode'] = int(self.conf['filemode'], 8)
         except ValueError as o:
@@ -171,7 +251,7 @@ class Maildir(DeliverySkeleton, ForkingBase):
                         'refuse to deliver mail as GID 0'
                     )
             f = deliver_maildir(
-                self.conf['path'], msg.flatten(delivered_to, received),
+                self.conf['path'], msg.flatten_iter(delivered_to, received),
                 self.hostname, self.dcount, self.conf['filemode']
             )
             stdout.write(f.encode())
@@ -200,6 +280,27 @@ class Maildir(DeliverySkeleton, ForkingBase):
                         'refuse to deliver mail as GID 0'
                     )
 
+        if uid is None and (os.name != 'posix'
+                            or (os.geteuid() != 0 and os.getegid() != 0)):
+            # No user switch needed, so no child process either.  The
+            # message goes to tmp/ now, and to new/ on commit().  If it went
+            # to another Maildir already, the file written there is linked
+            # while still in tmp/ or new/.
+            key = ('Maildir', delivered_to, received, self.conf['filemode'])
+            try:
+                files = maildir_tmpfile(
+                    self.conf['path'], msg.flatten_iter(delivered_to, received),
+                    self.hostname, self.dcount, self.conf['filemode'],
+                    linkfrom=msg.copies(key)
+                )
+            except (IOError, OSError) as o:
+                raise getmailDeliveryError('maildir delivery failed (%s)' % o)
+            msg.add_copy(key, files)
+            self._pending.append(files)
+            self.dcount += 1
+            self.log.debug('maildir file %s' % files[1])
+            return self
+
         try:
             child = self.forkchild(
                 lambda o,e: self.__deliver_message_maildir(
@@ -217,6 +318,24 @@ class Maildir(DeliverySkeleton, ForkingBase):
         self.log.debug('maildir file %s' % child.out)
         return self
 
+    def commit(self):
+        self.log.trace()
+        (pending, self._pending) = (self._pending, [])
+        if pending:
+            maildir_commit(pending)
+
+    def rollback(self):
+        self.log.trace()
+        (pending, self._pending) = (self._pending, [])
+        for (fname_tmp, unused) in pending:
+            try:
+                os.unlink(fname_tmp)
+            except OSError:
+                pass
+
+# Mboxrd destinations holding their mbox open, by real path
+_mbox_writers = {}
+
 #######################################
 class Mboxrd(DeliverySkeleton, ForkingBase):
     '''mboxrd destination with fcntl-style locking.
@@ -243,6 +362,10 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
         if self.conf['locktype'] not in ('lockf', 'flock'):
             raise getmailConfigurationError('unknown mbox lock type: %s'
                                             % self.conf['locktype'])
+        # The mbox file, open and locked, while a batch of in-process
+        # deliveries is pending, and its status from before the batch
+        self._mbox = None
+        self._status_old = None
 
     def __str__(self):
         self.log.trace()
@@ -251,6 +374,84 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('Mboxrd(%s)\n' % self._confstring())
 
+    def __open_mbox(self):
+        '''Open and lock the mbox file, and check that it is one.  Returns
+        the file, positioned at the end, and its status from before.
+        '''
+        if not os.path.exists(self.conf['path']):
+            raise getmailDeliveryError('mboxrd does not exist (%s)'
+                                       % self.conf['path'])
+        if not os.path.isfile(self.conf['path']):
+            raise getmailDeliveryError('not an mboxrd file (%s)'
+                                       % self.conf['path'])
+
+        # Open mbox file, refusing to create it if it doesn't exist
+        fd = os.open(self.conf['path'], os.O_RDWR)
+        try:
+            f = os.fdopen(fd, 'br+')
+        except ValueError: # py2
+            f = os.fdopen(fd, 'r+')
+        lock_file(f, self.conf['locktype'])
+        # Only now the size is what a rollback may truncate to
+        status_old = os.fstat(fd)
+        # Check if it _is_ an mbox file.  mbox files must start with "From "
+        # in their first line, or are 0-length files.
+        f.seek(0, 0)
+        first_line = f.readline()
+        if first_line and not first_line.startswith(b'From '):
+            # Not an mbox file; abort here
+            unlock_file(f, self.conf['locktype'])
+            f.close()
+            raise getmailDeliveryError('not an mboxrd file (%s)'
+                                       % self.conf['path'])
+        # Seek to end
+        f.seek(0, 2)
+        return (f, status_old)
+
+    def __close_mbox(self, truncate=False):
+        (f, status_old) = (self._mbox, self._status_old)
+        self._mbox = None
+        self._status_old = None
+        _mbox_writers.pop(os.path.realpath(self.conf['path']), None)
+        try:
+            if truncate:
+                # Drop the whole batch
+                os.ftruncate(f.fileno(), status_old.st_size)
+                return
+            os.fsync(f.fileno())
+            status_new = os.fstat(f.fileno())
+            # Reset atime
+            try:
+                os.utime(self.conf['path'], (status_old.st_atime,
+                                             status_new.st_mtime))
+            except OSError:
+                self.log.debug('failed to update mtime/atime of mbox\n')
+        except (IOError, OSError) as o:
+            if not truncate:
+                try:
+                    os.ftruncate(f.fileno(), status_old.st_size)
+                except (IOError, OSError):
+                    pass
+            raise getmailDeliveryError(
+                'failure writing messages to mbox file "%s" (%s)'
+                % (self.conf['path'], o)
+            )
+        finally:
+            try:
+                unlock_file(f, self.conf['locktype'])
+            finally:
+                f.close()
+
+    def commit(self):
+        self.log.trace()
+        if self._mbox is not None:
+            self.__close_mbox()
+
+    def rollback(self):
+        self.log.trace()
+        if self._mbox is not None:
+            self.__close_mbox(truncate=True)
+
     def __deliver_message_mbox(self, uid, gid, msg, delivered_to, received,
                                stdout, stderr):
         '''Delivery method run in separate child process.
@@ -268,36 +469,15 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
                         'refuse to deliver mail as GID 0'
                     )
 
-            if not os.path.exists(self.conf['path']):
-                raise getmailDeliveryError('mboxrd does not exist (%s)'
-                                           % self.conf['path'])
-            if not os.path.isfile(self.conf['path']):
-                raise getmailDeliveryError('not an mboxrd file (%s)'
-                                           % self.conf['path'])
-
-            # Open mbox file, refusing to create it if it doesn't exist
-            fd = os.open(self.conf['path'], os.O_RDWR)
-            status_old = os.fstat(fd)
-            try:
-                f = os.fdopen(fd, 'br+')
-            except ValueError: # py2
-                f = os.fdopen(fd, 'r+')
-            lock_file(f, self.conf['locktype'])
-            # Check if it _is_ an mbox file.  mbox files must start with "From "
-            # in their first line, or are 0-length files.
-            f.seek(0, 0)
-            first_line = f.readline()
-            if first_line and not first_line.startswith(b'From '):
-                # Not an mbox file; abort here
-                unlock_file(f, self.conf['locktype'])
-                raise getmailDeliveryError('not an mboxrd file (%s)'
-                                           % self.conf['path'])
-            # Seek to end
-            f.seek(0, 2)
+            (f, status_old) = self.__open_mbox()
+            fd = f.fileno()
             try:
                 # Write out message plus blank line with native EOL
-                f.write(msg.flatten(delivered_to, received, include_from=True,
-                                    mangle_from=True) + os.linesep.encode())
+                for chunk in msg.flatten_iter(delivered_to, received,
+                                              include_from=True,
+                                              mangle_from=True):
+                    f.write(chunk)
+                f.write(os.linesep.encode())
                 f.flush()
                 os.fsync(fd)
                 status_new = os.fstat(fd)
@@ -358,6 +538,43 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
                     'refuse to deliver mail as GID 0'
                 )
 
+        if (uid is None and threading.current_thread().name == 'MainThread'
+                and (os.name != 'posix'
+                     or (os.geteuid() != 0 and os.getegid() != 0))):
+            # No user switch needed, so no child process either.  The mbox
+            # stays open and locked until commit().  fcntl locks do not
+            # exclude other threads, hence the main thread only.
+            if self._mbox is None:
+                writer = _mbox_writers.get(os.path.realpath(self.conf['path']))
+                if writer is not None:
+                    # Another destination of ours has this mbox open
+                    writer.commit()
+                (self._mbox, self._status_old) = self.__open_mbox()
+                _mbox_writers[os.path.realpath(self.conf['path'])] = self
+            # Unbuffered, so a failed write leaves nothing behind to be
+            # flushed later
+            fd = self._mbox.fileno()
+            start = os.lseek(fd, 0, os.SEEK_END)
+            try:
+                # Write out message plus blank line with native EOL
+                for chunk in msg.flatten_iter(delivered_to, received,
+                                              include_from=True,
+                                              mangle_from=True):
+                    while chunk:
+                        chunk = chunk[os.write(fd, chunk):]
+                os.write(fd, os.linesep.encode())
+            except (IOError, OSError) as o:
+                try:
+                    # Drop this message, keep the earlier ones of the batch
+                    os.ftruncate(fd, start)
+                except (IOError, OSError):
+                    pass
+                raise getmailDeliveryError(
+                    'failure writing message to mbox file "%s" (%s)'
+                    % (self.conf['path'], o)
+                )
+            return self
+
         try:
             child = self.forkchild(
                 lambda o,e: self.__deliver_message_mbox(
@@ -694,7 +911,13 @@ class MDA_external(DeliverySkeleton, ForkingBase):
 
 
 class MDA_lmtp(DeliverySkeleton):
-    """LMTP server destination."""
+    """LMTP server destination.
+
+    Messages are sent as flattened by getmail, with PIPELINING and CHUNKING
+    (BDAT) if the server advertises them.  Connections are kept open for
+    further messages until the end of the session, and shared by all
+    MDA_lmtp destinations delivering to the same server.
+    """
     _confitems = (
         ConfInstance(name='configparser', required=False),
         ConfString(name='host', required=True),
@@ -709,15 +932,39 @@ class MDA_lmtp(DeliverySkeleton):
                 'MDA_lmtp in config: that was implemented only for python 3'
             )
         self.log.trace()
-        self.__connect()
+        self.__release(self.__acquire())
 
     def __connect(self):
         try:
-            self.server = smtplib.LMTP(self.conf['host'], self.conf['port'])
-        except smtplib.SMTPException as err:
+            server = smtplib.LMTP(self.conf['host'], self.conf['port'])
+        except (smtplib.SMTPException, OSError) as err:
             raise getmailConfigurationError(
-                'Failed to connect to server'
+                'Failed to connect to server (%s)' % err
             )
+        return server
+
+    def __acquire(self):
+        with _lmtp_lock:
+            idle = _lmtp_idle.get((self.conf['host'], self.conf['port']))
+            if idle:
+                return idle.pop()
+        return self.__connect()
+
+    def __release(self, server):
+        with _lmtp_lock:
+            _lmtp_idle.setdefault((self.conf['host'], self.conf['port']),
+                                  []).append(server)
+
+    def close(self):
+        '''QUIT the idle connections to the server.'''
+        self.log.trace()
+        with _lmtp_lock:
+            idle = _lmtp_idle.pop((self.conf['host'], self.conf['port']), [])
+        for server in idle:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
 
     def __str__(self):
         self.log.trace()
@@ -731,45 +978,156 @@ class MDA_lmtp(DeliverySkeleton):
     def showconf(self):
         self.log.info('%s(%s)' % (type(self).__name__, self._confstring()))
 
-    def __send(self, msg, sender, recipient, __retrying=False):
-        try:
-            rcpt = self.server.send_message(msg, sender, recipient)
-        except smtplib.SMTPServerDisconnected as err:
-            if __retrying:
-                raise
+    def __send_bdat(self, commands, chunks):
+        # Send the message right away; BDAT without valid recipients is
+        # just refused.  The replies to BDAT LAST are read by the caller.
+        data = []
+        for chunk in chunks:
+            data.append(_lmtp_crlf(chunk))
+            if sum(len(chunk) for chunk in data) >= _LMTP_CHUNK:
+                data = b''.join(data)
+                commands.command('BDAT %d' % len(data), data)
+                data = []
+        data = b''.join(data)
+        commands.send(b'BDAT %d LAST\r\n' % len(data) + data)
+
+    def __send_data(self, commands, chunks):
+        # After the DATA reply: the dot-stuffed message and its end
+        last = b''
+        for chunk in chunks:
+            chunk = _lmtp_dotstuff(_lmtp_crlf(chunk))
+            if chunk:
+                commands.send(chunk)
+                last = chunk
+        if not last.endswith(b'\r\n'):
+            commands.send(b'\r\n')
+        commands.send(b'.\r\n', wait=True)
+
+    def __transaction(self, server, chunks, sender, recipients):
+        '''Run one LMTP transaction for the message in chunks.
+
+        Return a dictionary of the recipients which were refused, with their
+        (status, error) pairs, like smtplib's send_message().  Raise
+        smtplib.SMTPException if the transaction failed as a whole; the
+        connection must not be reused then.
+        '''
+        server.ehlo_or_helo_if_needed()
+        chunking = server.has_extn('chunking')
+        commands = _LMTPCommands(server)
+        options = ' BODY=8BITMIME' if server.has_extn('8bitmime') else ''
+        commands.command('MAIL FROM:%s%s'
+                         % (smtplib.quoteaddr(sender), options))
+        for recipient in recipients:
+            commands.command('RCPT TO:%s' % smtplib.quoteaddr(recipient))
+        if chunking:
+            self.__send_bdat(commands, chunks)
+        else:
+            commands.command('DATA')
+        commands.flush()
+        replies = commands.replies
+        (mail, rcpts, body) = (replies[0], replies[1:len(recipients) + 1],
+                               replies[len(recipients) + 1:])
+        refused = {}
+        accepted = []
+        for (recipient, (status, error)) in zip(recipients, rcpts):
+            if 200 <= status <= 299:
+                accepted.append(recipient)
             else:
-                self.log.info('Lost connection to LMTP server, reconnecting')
-                self.__connect()
-                return self.__send(msg, sender, recipient, __retrying=True)
-        except smtplib.SMTPRecipientsRefused as err:
-            rcpt = err.recipients
+                refused[recipient] = (status, error)
+        failed = [reply for reply in body if not 200 <= reply[0] <= 399]
+        if not 200 <= mail[0] <= 299 or (accepted and failed):
+            raise smtplib.SMTPResponseException(
+                *(failed[0] if failed and accepted else mail)
+            )
+        if not accepted:
+            # BDAT LAST or DATA was refused, with a single reply
+            if chunking:
+                server.getreply()
+            # End the transaction before the connection is used again; if
+            # that fails, __send() reconnects for the next message
+            try:
+                if not 200 <= server.rset()[0] <= 299:
+                    server.close()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            return refused
+        if not chunking:
+            self.__send_data(commands, chunks)
+        # LMTP: one reply to the end of the message per accepted recipient
+        for recipient in accepted:
+            (status, error) = server.getreply()
+            if not 200 <= status <= 299:
+                refused[recipient] = (status, error)
+        return refused
+
+    def __send(self, msg, delivered_to, received, recipients):
+        server = self.__acquire()
+        try:
+            try:
+                rcpt = self.__transaction(
+                    server, msg.flatten_iter(delivered_to, received),
+                    msg.sender, recipients
+                )
+            except smtplib.SMTPServerDisconnected as err:
+                self.log.info('Lost connection to LMTP server, reconnecting'
+                              + os.linesep)
+                server.close()
+                server = self.__connect()
+                rcpt = self.__transaction(
+                    server, msg.flatten_iter(delivered_to, received),
+                    msg.sender, recipients
+                )
         except smtplib.SMTPException as err:
+            server.close()
             raise getmailDeliveryError(
                 'LMTP error: %s: %s' % (type(err).__name__, err)
             )
-
+        except BaseException:
+            server.close()
+            raise
+        self.__release(server)
         return rcpt
 
+    def __recipients(self, msg):
+        recipient = self.conf['override'] or msg.recipient
+        if recipient:
+            return [recipient]
+        # Like smtplib's send_message(), from the header fields
+        resent = msg.get_all('Resent-Date')
+        prefix = 'Resent-' if resent and len(resent) == 1 else ''
+        fields = [str(field) for name in ('To', 'Bcc', 'Cc')
+                  for field in msg.get_all(prefix + name, [])]
+        return [address for (name, address) in Utils.getaddresses(fields)
+                if address]
+
     def _deliver_message(self, msg, delivered_to, received):
         self.log.trace()
-        recipient = self.conf.get('override', msg.recipient)
-        rcpt = self.__send(msg.content(), msg.sender, recipient)
-
-        if recipient in rcpt:
-            status, error = rcpt[recipient]
-            fb_recipient = self.conf['fallback']
-            if 500 <= status <= 599 and fb_recipient:
-                fb_rcpt = self.__send(msg.content(), msg.sender, fb_recipient)
-                if fb_recipient in fb_rcpt:
-                    raise getmailDeliveryError(
-                        'Cannot deliver to intended or fallback target: %d %s'
-                        % fb_rcpt[fb_recipient]
-                    )
-            else:
+        recipients = self.__recipients(msg)
+        if not recipients:
+            raise getmailDeliveryError('No recipient for LMTP delivery')
+        rcpt = self.__send(msg, delivered_to, received, recipients)
+
+        fb_recipient = self.conf['fallback']
+        permanent = [r for r in rcpt if 500 <= rcpt[r][0] <= 599]
+        if fb_recipient and permanent:
+            fb_rcpt = self.__send(msg, delivered_to, received, [fb_recipient])
+            if fb_recipient in fb_rcpt:
                 raise getmailDeliveryError(
-                    'Cannot deliver to intended target: %d %s'
-                    % rcpt[recipient]
+                    'Cannot deliver to intended or fallback target: %d %s'
+                    % fb_rcpt[fb_recipient]
                 )
+            for recipient in permanent:
+                del rcpt[recipient]
+        if rcpt and len(rcpt) == len(recipients):
+            raise getmailDeliveryError(
+                'Cannot deliver to intended target: %d %s'
+                % rcpt[recipients[0]]
+            )
+        for recipient in rcpt:
+            # Delivered to the others already; retrying would duplicate it
+            self.log.warning('LMTP delivery to %s failed: %d %s%s'
+                             % ((recipient, ) + rcpt[recipient]
+                                + (os.linesep, )))
         return str(self)
 
 
@@ -844,6 +1202,23 @@ class MultiDestinationBase(DeliverySkeleton):
         for destination in self._destinations:
             destination.retriever_info(retriever)
 
+    def set_batching(self, batching):
+        DeliverySkeleton.set_batching(self, batching)
+        for destination in self._destinations:
+            destination.set_batching(batching)
+
+    def commit(self):
+        for destination in self._destinations:
+            destination.commit()
+
+    def rollback(self):
+        for destination in self._destinations:
+            destination.rollback()
+
+    def close(self):
+        for destination in self._destinations:
+            destination.close()
+
 #######################################
 class MultiDestination(MultiDestinationBase):
     '''Send messages to one or more other destination objects unconditionally.
@@ -898,6 +1273,79 @@ class MultiDestination(MultiDestinationBase):
             dest.deliver_message(msg, delivered_to, received)
         return self
 
+#######################################
+class _AddressRouter(object):
+    '''Find the MultiSorter "locals" patterns matching an address, without
+    searching the address with each pattern in turn.
+
+    Patterns are searched for, i.e. "bob@example.org" also matches
+    "jimbob@example.org.uk", with the dot matching any character.  For an
+    ASCII address with a single @, a plain pattern like that can only match
+    if its @ is at the @ of the address, and the part of it after the last
+    dot before the @ ends the local part.  Plain patterns are indexed by that
+    part, and only the ones found are searched.  The other patterns are
+    combined into alternations of a few at a time, so that a group of them
+    can be skipped with a single search.
+    '''
+    _plain = re.compile(r"^[A-Za-z0-9_.%=!#&'/`~-]*@[A-Za-z0-9_.-]*$")
+    # Patterns which can't be combined (backreferences, conditionals, global
+    # flags), as their group numbers would change
+    _single = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+    _group = 16
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.plain = []
+        # local part tail -> indexes of plain patterns
+        self.tails = {}
+        self.groups = []
+        others = []
+        for (i, pattern) in enumerate(patterns):
+            if self._plain.match(pattern.pattern):
+                local = pattern.pattern.split('@', 1)[0]
+                tail = local.rsplit('.', 1)[-1].lower()
+                self.tails.setdefault(tail, []).append(i)
+                self.plain.append(i)
+            elif self._single.search(pattern.pattern):
+                self.groups.append((None, [i]))
+            else:
+                others.append(i)
+        self.lengths = sorted(set(len(tail) for tail in self.tails))
+        for start in range(0, len(others), self._group):
+            members = others[start:start + self._group]
+            try:
+                combined = re.compile(
+                    '|'.join('(?:%s)' % patterns[i].pattern for i in members),
+                    re.IGNORECASE
+                )
+            except re.error:
+                # E.g. the same group name in two of them
+                self.groups.extend((None, [i]) for i in members)
+                continue
+            self.groups.append((combined, members))
+
+    def matches(self, address):
+        '''Return the indexes of the patterns matching address, in order.
+        '''
+        if address.count('@') == 1 and not re.search(r'[^\x00-\x7f]',
+                                                     address):
+            local = address.split('@', 1)[0].lower()
+            candidates = []
+            for length in self.lengths:
+                if length > len(local):
+                    break
+                candidates.extend(
+                    self.tails.get(local[len(local) - length:], ())
+                )
+        else:
+            candidates = self.plain
+        found = [i for i in candidates if self.patterns[i].search(address)]
+        for (combined, members) in self.groups:
+            if combined is None or combined.search(address):
+                found.extend(i for i in members
+                             if self.patterns[i].search(address))
+        return sorted(found)
+
 #######################################
 class MultiSorterBase(MultiDestinationBase):
     '''Base class for multiple destinations with address matching.
@@ -932,6 +1380,8 @@ class MultiSorterBase(MultiDestinationBase):
                 self._destinations.append(dest)
         except re.error as o:
             raise getmailConfigurationError('invalid regular expression %s' % o)
+        self.router = _AddressRouter([pattern for (pattern, unused)
+                                      in self.targets])
 
     def _confstring(self):
         '''
@@ -1005,14 +1455,13 @@ class MultiSorter(MultiSorterBase):
                 'MultiSorter recipient matching requires a retriever (message '
                 'source) that preserves the message envelope'
             )
-        for (pattern, dest) in self.targets:
-            self.log.debug('checking recipient %s against pattern %s\n'
-                           % (msg.recipient, pattern.pattern))
-            if pattern.search(msg.recipient):
-                self.log.debug('recipient %s matched target %s\n'
-                               % (msg.recipient, dest))
-                dest.deliver_message(msg, delivered_to, received)
-                matched.append(str(dest))
+        hits = self.router.matches(msg.recipient) if self.targets else []
+        for i in hits:
+            (pattern, dest) = self.targets[i]
+            self.log.debug('recipient %s matched pattern %s, target %s\n'
+                           % (msg.recipient, pattern.pattern, dest))
+            dest.deliver_message(msg, delivered_to, received)
+            matched.append(str(dest))
         if not matched:
             if self.targets:
                 self.log.debug('recipient %s not matched; using default %s\n'
@@ -1078,19 +1527,17 @@ class MultiGuesser(MultiSorterBase):
             else:
                 self.log.debug('no addresses found, continuing\n')
 
-        for (pattern, dest) in self.targets:
-            for addr in header_addrs:
-                self.log.debug('checking address %s against pattern %s\n'
-                               % (addr, pattern.pattern))
-                if pattern.search(addr):
-                    self.log.debug('address %s matched target %s\n'
-                                   % (addr, dest))
-                    dest.deliver_message(msg, delivered_to, received)
-                    matched.append(str(dest))
-                    # Only deliver once to each destination; this one matched,
-                    # so we don't need to check any remaining addresses against
-                    # this pattern
-                    break
+        # Only deliver once for each pattern matching any of the addresses
+        hits = {}
+        for addr in header_addrs:
+            for i in self.router.matches(addr):
+                hits.setdefault(i, addr)
+        for i in sorted(hits):
+            (pattern, dest) = self.targets[i]
+            self.log.debug('address %s matched pattern %s, target %s\n'
+                           % (hits[i], pattern.pattern, dest))
+            dest.deliver_message(msg, delivered_to, received)
+            matched.append(str(dest))
         if not matched:
             if self.targets:
                 self.log.debug('no addresses matched; using default %s\n'
@@ -6,11 +6,29 @@
 
 Currently implemented:
 
+  Filter_external (run the message through an external program)
+  Filter_classifier (add the output of an external program as header fields)
+  Filter_TMDA (run the message through tmda-filter)
+  Filter_python (call a Python function in the getmail process)
 '''
 
 import os
+import sys
+import io
+import time
+import fcntl
+import errno
+import select
 import tempfile
+import threading
+import subprocess
 import types
+from argparse import Namespace
+try:
+    import importlib.util
+    imp = None
+except ImportError: #py2
+    import imp
 
 from getmailcore.exceptions import *
 from getmailcore.message import *
@@ -22,9 +40,21 @@ __all__ = [
     'Filter_external',
     'Filter_classifier',
     'Filter_TMDA',
+    'Filter_python',
 ]
 
 
+#######################################
+def _import_file(path):
+    '''Load the Python file path as a module.'''
+    name = os.path.splitext(os.path.basename(path))[0]
+    if imp: #py2
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
 #######################################
 class FilterSkeleton(ConfigurableBase):
     '''Base class for implementing message-filtering classes.
@@ -60,8 +90,14 @@ class FilterSkeleton(ConfigurableBase):
                                    representing the message in filtered form, or
                                    None on error or when dropping the message.
 
+    Filters with headers_only set provide filter_headers() instead; see
+    there.
+
     See the Filter_external class for a good (though not simple) example.
     '''
+    # Decides about messages from their header fields before retrieval
+    headers_only = False
+
     def __init__(self, **args):
         ConfigurableBase.__init__(self, **args)
         try:
@@ -77,6 +113,8 @@ class FilterSkeleton(ConfigurableBase):
         msg.received_from = retriever.received_from
         msg.received_with = retriever.received_with
         msg.received_by = retriever.received_by
+        # Before filtering, as a filter may change msg itself
+        numheaders = len(msg.headers())
         exitcode, newmsg, err = self._filter_message(msg)
         if exitcode in self.exitcodes_drop:
             # Drop message
@@ -96,13 +134,13 @@ class FilterSkeleton(ConfigurableBase):
                 )
 
         # Check the filter was sane
-        if len(newmsg.headers()) < len(msg.headers()):
+        if len(newmsg.headers()) < numheaders:
             if not self.conf.get('ignore_header_shrinkage', False):
                 # Warn user
                 self.log.warning(
                     'Warning: filter %s returned fewer headers (%d) than '
                         'supplied (%d)\n'
-                    % (self, len(newmsg.headers()), len(msg.headers()))
+                    % (self, len(newmsg.headers()), numheaders)
                 )
 
         # Copy attributes from original message
@@ -110,6 +148,34 @@ class FilterSkeleton(ConfigurableBase):
 
         return newmsg
 
+    def filter_headers(self, msg, retriever):
+        '''Decide about a message before it is retrieved, msg holding only
+        its header fields.  Return 'drop' to not retrieve it and handle it
+        like a message a filter dropped, 'skip' to leave it for later, or
+        None to retrieve it.  Changes to msg are discarded.'''
+        raise NotImplementedError('virtual')
+
+    def close(self):
+        '''Release what the filter keeps between messages; called at the
+        end of a session.'''
+        pass
+
+    def _init_exitcodes(self):
+        try:
+            self.exitcodes_keep = [int(i) for i in self.conf['exitcodes_keep']
+                                   if 0 <= int(i) <= 255]
+            self.exitcodes_drop = [int(i) for i in self.conf['exitcodes_drop']
+                                   if 0 <= int(i) <= 255]
+            if not self.exitcodes_keep:
+                raise getmailConfigurationError('exitcodes_keep set empty')
+            if frozenset(self.exitcodes_keep).intersection(
+                frozenset(self.exitcodes_drop)
+            ):
+                raise getmailConfigurationError('exitcode sets intersect')
+        except ValueError as o:
+            raise getmailConfigurationError('invalid exit code specified (%s)'
+                                            % o)
+
     def some_security(self):
         if (os.geteuid() == 0 and not self.conf['allow_root_commands']
                 and self.conf['user'] == None):
@@ -173,6 +239,24 @@ class Filter_external(FilterSkeleton, ForkingBase):
 
       ignore_stderr (boolean, optional) - if set, getmail will not consider the
             program writing to stderr to be an error.  The default is False.
+
+      persistent (boolean, optional) - if set, the command is started once
+            per session and passed one message after the other over its
+            stdin and stdout, see below.  The default is False.
+
+      persistent_timeout (integer, optional) - seconds a persistent command
+            may take for one message before it is killed.  The default is 60.
+
+    A persistent command reads requests from stdin, each a line with the
+    length of the message in bytes (in decimal), followed by the message.
+    For each request, it writes a reply to stdout: a line with its exit code,
+    the length of its output and the length of its error text (three decimal
+    numbers separated by spaces), followed by the output and the error text.
+    The output, exit code and error text are what the command would write to
+    stdout, exit with and write to stderr without persistent.  The per-message
+    replacements in arguments are not available.  If the command exits, it
+    is restarted for the next message.  Messages filtered at the same time
+    (the filter_workers option) each get an instance of the command.
     '''
     _confitems = (
         ConfFile(name='path'),
@@ -187,6 +271,8 @@ class Filter_external(FilterSkeleton, ForkingBase):
         ConfBool(name='allow_root_commands', required=False, default=False),
         ConfBool(name='ignore_header_shrinkage', required=False, default=False),
         ConfBool(name='ignore_stderr', required=False, default=False),
+        ConfBool(name='persistent', required=False, default=False),
+        ConfInt(name='persistent_timeout', required=False, default=60),
         ConfInstance(name='configparser', required=False),
     )
 
@@ -202,20 +288,16 @@ class Filter_external(FilterSkeleton, ForkingBase):
                 'incorrect arguments format; see documentation (%s)'
                 % self.conf['arguments']
             )
-        try:
-            self.exitcodes_keep = [int(i) for i in self.conf['exitcodes_keep']
-                                   if 0 <= int(i) <= 255]
-            self.exitcodes_drop = [int(i) for i in self.conf['exitcodes_drop']
-                                   if 0 <= int(i) <= 255]
-            if not self.exitcodes_keep:
-                raise getmailConfigurationError('exitcodes_keep set empty')
-            if frozenset(self.exitcodes_keep).intersection(
-                frozenset(self.exitcodes_drop)
-            ):
-                raise getmailConfigurationError('exitcode sets intersect')
-        except ValueError as o:
-            raise getmailConfigurationError('invalid exit code specified (%s)'
-                                            % o)
+        if self.conf['persistent'] and [arg for arg in self.conf['arguments']
+                                        if '%(' in arg]:
+            raise getmailConfigurationError(
+                'persistent filter arguments cannot use per-message '
+                'replacements (%s)' % (self.conf['arguments'], )
+            )
+        # The idle persistent commands
+        self.coprocesses = []
+        self.coprocess_lock = threading.Lock()
+        self._init_exitcodes()
 
     def __str__(self):
         self.log.trace()
@@ -247,9 +329,152 @@ class Filter_external(FilterSkeleton, ForkingBase):
                               % (self.conf['command'], o))
             os._exit(127)
 
+    def __start_coprocess(self):
+        args = [self.conf['path']]
+        for arg in self.conf['arguments']:
+            args.append(expand_user_vars(arg))
+        self.log.debug('starting persistent filter %s with args %s\n'
+                       % (self.conf['command'], args))
+        # Look up the names here; the child only changes its UID/GID
+        (uid, gid, preexec_fn) = (None, None, None)
+        if self.conf['user']:
+            uid = uid_of_user(self.conf['user'])
+        if self.conf['group']:
+            gid = gid_of_group(self.conf['group'])
+        if uid or gid:
+            preexec_fn = lambda: change_uidgid(None, uid, gid)
+        try:
+            proc = subprocess.Popen(
+                args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True, preexec_fn=preexec_fn  # noqa: PLW1509
+            )
+        except Exception as o:
+            raise getmailFilterError('exec of filter %s failed (%s)'
+                                     % (self.conf['command'], o))
+        fd = proc.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        return proc
+
+    def __stop_coprocess(self, proc, kill=False):
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if kill or proc.poll() is None:
+            deadline = time.time() + (0 if kill else 5)
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+            if proc.poll() is None:
+                proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        self.log.debug('persistent filter %s %d exited %s\n'
+                       % (self.conf['command'], proc.pid, proc.returncode))
+
+    def __exchange(self, proc, request):
+        '''Send one request to the persistent command and return the
+        reply as (exitcode, output, error text).  Raises EOFError if the
+        command exited before replying.'''
+        (infd, outfd) = (proc.stdin.fileno(), proc.stdout.fileno())
+        deadline = time.time() + self.conf['persistent_timeout']
+        sent = 0
+        reply = bytearray()
+        size = None
+        while sent < len(request) or size is None or len(reply) < size:
+            wait = deadline - time.time()
+            if wait <= 0:
+                raise getmailFilterError(
+                    'filter %s timed out after %d seconds'
+                    % (self, self.conf['persistent_timeout'])
+                )
+            (readable, writable) = select.select(
+                [outfd], [infd] if sent < len(request) else [], [], wait
+            )[:2]
+            if writable:
+                try:
+                    sent += os.write(infd, request[sent:sent + 65536])
+                except OSError as o:
+                    if o.errno == errno.EPIPE:
+                        raise EOFError
+                    if o.errno != errno.EAGAIN:
+                        raise
+            if readable:
+                data = os.read(outfd, 65536)
+                if not data:
+                    raise EOFError
+                reply += data
+            if size is None and b'\n' in reply:
+                end = reply.index(b'\n')
+                line = bytes(reply[:end])
+                del reply[:end + 1]
+                try:
+                    (exitcode, outlen, errlen) = [int(i)
+                                                  for i in line.split()]
+                    if min(exitcode, outlen, errlen) < 0:
+                        raise ValueError(line)
+                except ValueError:
+                    raise getmailFilterError(
+                        'filter %s sent a malformed reply (%r)'
+                        % (self, line[:80])
+                    )
+                size = outlen + errlen
+        if len(reply) > size:
+            raise getmailFilterError('filter %s sent more than its reply'
+                                     % self)
+        return (exitcode, bytes(reply[:outlen]),
+                bytes(reply[outlen:]).strip().decode('utf-8', 'replace'))
+
+    def _filter_message_persistent(self, msg):
+        self.log.trace()
+        self.some_security()
+        data = msg.flatten(False, False, include_from=self.conf['unixfrom'])
+        request = ('%d\n' % len(data)).encode() + data
+        # One command per message being filtered at the same time
+        with self.coprocess_lock:
+            proc = self.coprocesses.pop() if self.coprocesses else None
+        for attempt in (1, 2):
+            if proc is None:
+                proc = self.__start_coprocess()
+            try:
+                (exitcode, out, err) = self.__exchange(proc, request)
+                break
+            except EOFError:
+                self.__stop_coprocess(proc, kill=True)
+                if attempt == 2:
+                    raise getmailFilterError(
+                        'filter %s %d exited without a reply'
+                        % (self, proc.pid)
+                    )
+                self.log.info('filter %s %d exited without a reply, '
+                              'restarting\n' % (self, proc.pid))
+                proc = None
+            except Exception:
+                # Out of step with the command, which gets restarted
+                self.__stop_coprocess(proc, kill=True)
+                raise
+        with self.coprocess_lock:
+            self.coprocesses.append(proc)
+        child = Namespace()
+        child.childpid = proc.pid
+        child.exitcode = exitcode
+        child.stdout = io.BytesIO(out)
+        child.err = err
+        return child
+
+    def close(self):
+        self.log.trace()
+        with self.coprocess_lock:
+            (coprocesses, self.coprocesses) = (self.coprocesses, [])
+        for proc in coprocesses:
+            self.__stop_coprocess(proc)
+
     def _filter_message_common(self, msg):
         self.log.trace()
 
+        if self.conf['persistent']:
+            return self._filter_message_persistent(msg)
+
         msginfo = self.get_msginfo(msg)
 
         self.some_security()
@@ -395,3 +620,145 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
         self.log.debug('command %s %d exited %d\n' % (
             self.conf['command'], child.childpid, child.exitcode))
         return (child.exitcode, msg, child.err)
+
+#######################################
+class Filter_python(FilterSkeleton):
+    '''Filter which calls a Python function in the getmail process, so no
+    program has to be started for each message.
+
+    Parameters:
+
+      callable - the function, as "module:name".  module is the name of an
+                 importable module, or the path to a Python file.
+
+      arguments - a valid Python tuple of strings to be passed to the
+                  function after the message.
+
+      exitcodes_keep, exitcodes_drop, ignore_header_shrinkage - as for
+                  Filter_external.
+
+      headers_only - (boolean) call the function with the header fields of
+                  each message before it is retrieved, instead of with the
+                  whole message afterwards.  Messages it drops are never
+                  retrieved.  Defaults to False.
+
+      exitcodes_skip - with headers_only, exit codes which mean to leave the
+                  message on the server for now, without retrieving it or
+                  marking it as seen.  Defaults to ().
+
+    The function is called with the getmailcore.message.Message, whose
+    header fields can be read and changed (get_all(), add_header(),
+    remove_header()) without parsing the body.  It returns None to keep the
+    message, another Message to replace it, an exit code, or a tuple of an
+    exit code and a Message.  Exit codes mean the same as for
+    Filter_external; None or a message mean 0.  An exception is a filter
+    error.  With the filter_workers option, the function may be called for
+    several messages at the same time.
+    '''
+    _confitems = (
+        ConfString(name='callable'),
+        ConfTupleOfStrings(name='arguments', required=False, default="()"),
+        ConfTupleOfStrings(name='exitcodes_keep', required=False,
+                           default="(0, )"),
+        ConfTupleOfStrings(name='exitcodes_drop', required=False,
+                           default="(99, 100)"),
+        ConfBool(name='ignore_header_shrinkage', required=False, default=False),
+        ConfBool(name='headers_only', required=False, default=False),
+        ConfTupleOfStrings(name='exitcodes_skip', required=False,
+                           default="()"),
+        ConfInstance(name='configparser', required=False),
+    )
+
+    def initialize(self):
+        self.log.trace()
+        self.headers_only = self.conf['headers_only']
+        (module, name) = self.conf['callable'].rpartition(':')[::2]
+        if not module or not name:
+            raise getmailConfigurationError(
+                'callable must be "module:name" (%s)' % self.conf['callable']
+            )
+        if not isinstance(self.conf['arguments'],tuple):
+            raise getmailConfigurationError(
+                'incorrect arguments format; see documentation (%s)'
+                % self.conf['arguments']
+            )
+        self.conf['ignore_stderr'] = False
+        self._init_exitcodes()
+        try:
+            self.exitcodes_skip = [int(i) for i in self.conf['exitcodes_skip']
+                                   if 0 <= int(i) <= 255]
+        except ValueError as o:
+            raise getmailConfigurationError('invalid exit code specified (%s)'
+                                            % o)
+        if frozenset(self.exitcodes_skip).intersection(
+            frozenset(self.exitcodes_keep + self.exitcodes_drop)
+        ):
+            raise getmailConfigurationError('exitcode sets intersect')
+        try:
+            if module.endswith('.py') or os.sep in module:
+                module = _import_file(expand_user_vars(module))
+            else:
+                __import__(module)
+                module = sys.modules[module]
+            self.function = getattr(module, name)
+        except Exception as o:
+            raise getmailConfigurationError(
+                'cannot load filter function %s (%s)'
+                % (self.conf['callable'], o)
+            )
+        if not callable(self.function):
+            raise getmailConfigurationError('%s is not callable'
+                                            % self.conf['callable'])
+
+    def __str__(self):
+        self.log.trace()
+        return 'Filter_python %s' % self.conf['callable']
+
+    def showconf(self):
+        self.log.trace()
+        self.log.info('Filter_python(%s)\n' % self._confstring())
+
+    def _filter_message(self, msg):
+        self.log.trace()
+        try:
+            result = self.function(msg, *self.conf['arguments'])
+        except Exception as o:
+            raise getmailFilterError('filter %s failed (%s: %s)'
+                                     % (self, o.__class__.__name__, o))
+        if isinstance(result, tuple):
+            if len(result) != 2:
+                raise getmailFilterError('filter %s returned %r'
+                                         % (self, result))
+            (exitcode, newmsg) = result
+        elif isinstance(result, Message):
+            (exitcode, newmsg) = (0, result)
+        elif result is None:
+            (exitcode, newmsg) = (0, msg)
+        else:
+            (exitcode, newmsg) = (result, msg)
+        if (isinstance(exitcode, bool) or not isinstance(exitcode, int)
+                or not isinstance(newmsg, Message)):
+            raise getmailFilterError('filter %s returned %r'
+                                     % (self, result))
+        self.log.debug('function %s returned %d\n'
+                       % (self.conf['callable'], exitcode))
+        return (exitcode, newmsg, '')
+
+    def filter_headers(self, msg, retriever):
+        self.log.trace()
+        msg.received_from = retriever.received_from
+        msg.received_with = retriever.received_with
+        msg.received_by = retriever.received_by
+        exitcode = self._filter_message(msg)[0]
+        if exitcode in self.exitcodes_drop:
+            self.log.debug('filter %s returned %d; dropping message\n'
+                           % (self, exitcode))
+            return 'drop'
+        elif exitcode in self.exitcodes_skip:
+            self.log.debug('filter %s returned %d; skipping message\n'
+                           % (self, exitcode))
+            return 'skip'
+        elif exitcode not in self.exitcodes_keep:
+            raise getmailFilterError('filter %s returned %d\n'
+                                     % (self, exitcode))
+        return None
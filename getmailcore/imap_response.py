@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# docs/COPYING 2a + DRY: https://github.com/getmail6/getmail6
+# Please refer to the git history regarding who changed what and when in this file.
+
+'''Parser for IMAP FETCH responses, and helpers for IMAP sequence sets.
+
+imaplib only splits server responses into lines and literals.  A FETCH
+response for a message with a literal comes back as a (prefix, literal)
+tuple followed by the rest of the line, i.e.
+
+    [(b'1 (UID 7 X-GM-LABELS (foo "\\\\Inbox") BODY[] {704}', b'...'), b')']
+
+The functions here turn that into (message number, items) pairs, where
+items is a dictionary of upper-case data item names and typed values:
+
+  number              -> int
+  atom, quoted string -> str
+  NIL                 -> None
+  literal             -> bytes (whatever imaplib returned for it; a file
+                         for large literals spooled to disk)
+  parenthesized list  -> list
+'''
+
+import codecs
+import re
+
+import getmailcore.imap_utf7        # registers imap4-utf-7 codec
+
+__all__ = [
+    'fetch_body',
+    'imap_quote',
+    'imap_sequence_sets',
+    'parse_fetch_response',
+    'parse_search_response',
+    'parse_sequence_set',
+    'parse_status_responses',
+]
+
+# One token per match; the literal marker {n} is always the last thing in a
+# segment, the literal itself follows the segment.
+_TOKEN_RE = re.compile(
+    br'[ \t\r\n]*(?:'
+    br'(?P<open>\()'
+    br'|(?P<close>\))'
+    br'|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    br'|\{(?P<literal>\d+)\+?\}[ \t\r\n]*$'
+    br'|(?P<atom>(?:[^\s()"{\[\]]|\[[^\]]*\])+)'
+    br')'
+)
+_ESCAPED_RE = re.compile(br'\\(.)')
+_ATOM_SAFE_RE = re.compile(r'^[^\x00-\x20\x7f()"{%*\\\]]+$')
+_NOLITERAL = object()
+# Quoted strings, literals and sections, which _simple_items() can't parse
+_SPECIAL_RE = re.compile(br'["{\[]')
+# STATUS response data: mailbox name (none if it was a literal) and items
+_STATUS_RE = re.compile(
+    br'^\s*(?:"((?:[^"\\]|\\.)*)"|([^\s(]+))?\s*\((.*)\)\s*$'
+)
+# Item names and list members (i.e. flags) seen before, by their raw bytes
+_NAMES = {}
+_FLAGS = {}
+_CACHED = 1000
+
+#######################################
+def _atom(value):
+    if value.isdigit() and (value[:1] != b'0' or len(value) == 1):
+        return int(value)
+    if value.upper() == b'NIL':
+        return None
+    return value.decode('utf-8', 'replace')
+
+#######################################
+def _parse_segments(segments):
+    '''Parse a list of (text, literal) segments making up one response into
+    a list of values.'''
+    stack = [[]]
+    current = stack[-1]
+    for (text, literal) in segments:
+        pos = 0
+        end = len(text)
+        while pos < end:
+            m = _TOKEN_RE.match(text, pos)
+            if m is None or m.end() == pos:
+                if not text[pos:].strip():
+                    break
+                raise ValueError('unparseable data at "%r"' % text[pos:pos + 40])
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'atom':
+                current.append(_atom(m.group('atom')))
+            elif kind == 'open':
+                stack.append([])
+                current = stack[-1]
+            elif kind == 'close':
+                if len(stack) == 1:
+                    raise ValueError('unbalanced parentheses')
+                value = stack.pop()
+                current = stack[-1]
+                current.append(value)
+            elif kind == 'quoted':
+                current.append(_ESCAPED_RE.sub(br'\1', m.group('quoted'))
+                               .decode('utf-8', 'replace'))
+            # literal marker: the literal follows the text
+        if literal is not _NOLITERAL:
+            current.append(literal)
+    if len(stack) != 1:
+        raise ValueError('unbalanced parentheses')
+    return current
+
+#######################################
+def _items(values):
+    '''Turn [msgnum, [name, value, name, value, ...]] into (msgnum, dict).'''
+    if len(values) != 2 or not isinstance(values[1], list):
+        raise ValueError('not a FETCH response: %r' % values)
+    (msgnum, pairs) = values
+    if len(pairs) % 2:
+        raise ValueError('odd number of FETCH items: %r' % pairs)
+    items = {}
+    for i in range(0, len(pairs), 2):
+        items[str(pairs[i]).upper()] = pairs[i + 1]
+    return (msgnum, items)
+
+#######################################
+def _simple_items(text):
+    '''Parse a complete response made of atoms and unnested lists only,
+    like "1 (UID 7 RFC822.SIZE 704 FLAGS (\\Seen))", which is what message
+    lists consist of.  Working on the whitespace-separated words is several
+    times faster than the general tokenizer.
+
+    Returns (msgnum, dict), or None if text needs the general tokenizer
+    (text must not contain any of _SPECIAL_RE).
+    '''
+    tokens = text.split()
+    n = len(tokens)
+    if (n < 3 or not tokens[0].isdigit() or tokens[1][:1] != b'('
+            or tokens[-1][-1:] != b')'):
+        return None
+    tokens[1] = tokens[1][1:]
+    tokens[-1] = tokens[-1][:-1]
+    items = {}
+    i = 1
+    while i < n - 1:
+        name = _NAMES.get(tokens[i])
+        if name is None:
+            name = tokens[i].decode('utf-8', 'replace').upper()
+            if len(_NAMES) < _CACHED:
+                _NAMES[tokens[i]] = name
+        value = tokens[i + 1]
+        if value.isdigit() and (value[:1] != b'0' or len(value) == 1):
+            # _atom() inlined for the common case
+            items[name] = int(value)
+            i += 2
+            continue
+        if value[:1] == b'(':
+            j = i + 1
+            while tokens[j][-1:] != b')':
+                j += 1
+                if j == n:
+                    return None
+            values = tokens[i + 1:j + 1]
+            values[0] = values[0][1:]
+            values[-1] = values[-1][:-1]
+            i = j + 1
+        else:
+            values = None
+            i += 2
+        for word in values or (value, ):
+            if b'(' in word or b')' in word:
+                return None
+        if values is None:
+            items[name] = _atom(value)
+        else:
+            items[name] = [_flag(word) for word in values if word]
+    if i != n:
+        return None
+    return (_atom(tokens[0]), items)
+
+#######################################
+def _flag(word):
+    value = _FLAGS.get(word)
+    if value is None:
+        value = _atom(word)
+        if len(_FLAGS) < _CACHED:
+            _FLAGS[word] = value
+    return value
+
+#######################################
+def parse_fetch_response(response):
+    '''Parse the data list imaplib returns for a FETCH or UID FETCH command
+    into a list of (message number, items dictionary) pairs, in the order
+    the server sent them.  Unsolicited FETCH responses (e.g. flag updates)
+    are included; callers pick the ones they asked for.
+
+    Raises ValueError on malformed responses.
+    '''
+    results = []
+    segments = None
+    for item in response:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            (text, literal) = item
+        else:
+            (text, literal) = (item, _NOLITERAL)
+            if _SPECIAL_RE.search(text) is None:
+                # Without a literal, a response is complete on one line
+                simple = _simple_items(text)
+                if simple is not None:
+                    if segments:
+                        results.append(_items(_parse_segments(segments)))
+                    segments = None
+                    results.append(simple)
+                    continue
+        # Data following a literal continues the same response; a new
+        # response starts with the message number.
+        if segments is None or text[:1].isdigit():
+            if segments:
+                results.append(_items(_parse_segments(segments)))
+            segments = []
+        segments.append((text, literal))
+    if segments:
+        results.append(_items(_parse_segments(segments)))
+    return results
+
+#######################################
+def fetch_body(items):
+    '''Return the message (or message part) contents from parsed FETCH items,
+    or None if the response didn't include any.'''
+    for (name, value) in items.items():
+        if not (name.startswith('BODY[') or name.startswith('RFC822')):
+            continue
+        if value is None or isinstance(value, (int, list)):
+            continue
+        if isinstance(value, str):
+            # Servers may send small contents as a quoted string
+            value = value.encode('utf-8')
+        return value
+    return None
+
+#######################################
+def imap_quote(value):
+    '''Return value as an IMAP atom if possible, otherwise as a quoted
+    string.'''
+    value = str(value)
+    if _ATOM_SAFE_RE.match(value):
+        return value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+#######################################
+def imap_sequence_sets(uids, maxlen=4000):
+    '''Return a list of compressed sequence sets (i.e. "1:500,502,510:900")
+    covering uids, each at most about maxlen characters long, so that
+    commands using them stay within the line length servers accept.
+    '''
+    ranges = []
+    others = []
+    for uid in sorted(set(int(uid) for uid in uids if str(uid).isdigit())):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    for uid in uids:
+        if not str(uid).isdigit() and uid not in others:
+            others.append(uid)
+    sets = []
+    parts = []
+    length = 0
+    for part in ([str(first) if first == last else '%d:%d' % (first, last)
+                  for (first, last) in ranges] + others):
+        if parts and length + len(part) >= maxlen:
+            sets.append(','.join(parts))
+            parts = []
+            length = 0
+        parts.append(part)
+        length += len(part) + 1
+    if parts:
+        sets.append(','.join(parts))
+    return sets
+
+#######################################
+def parse_sequence_set(text):
+    '''Parse a sequence set like "1:500,502" (as in VANISHED responses)
+    into a list of (first, last) pairs of ints.
+
+    Raises ValueError on malformed input.
+    '''
+    ranges = []
+    for part in str(text).strip().split(','):
+        (first, sep, last) = part.partition(':')
+        (first, last) = (int(first), int(last if sep else first))
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+#######################################
+def parse_search_response(data):
+    '''Return the numbers (UIDs, for UID SEARCH) in SEARCH response lines
+    like b'4 18 21', or the ALL result of ESEARCH (RFC 4731) response lines
+    like b'(TAG "A1") UID ALL 4:18,21' or b'UID ALL 4:18,21' (the correlator
+    is optional), as a list of ints.
+
+    Raises ValueError on malformed input.
+    '''
+    numbers = []
+    for line in data:
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode('ascii', 'replace')
+        line = line.strip()
+        if line.startswith('('):
+            # Search correlator, (TAG "A1")
+            line = line[line.find(')') + 1:]
+        words = line.split()
+        if not words:
+            continue
+        if words[0].isdigit():
+            numbers.extend(int(word) for word in words)
+            continue
+        if words[0].upper() == 'UID':
+            words = words[1:]
+        # ESEARCH return data is pairs of item name and value
+        for (name, value) in zip(words[::2], words[1::2]):
+            if name.upper() == 'ALL':
+                for (first, last) in parse_sequence_set(value):
+                    numbers.extend(range(first, last + 1))
+    return numbers
+
+#######################################
+def parse_status_responses(data):
+    '''Return a dictionary of mailbox name -> items from the data of STATUS
+    responses like b'"Sent Items" (MESSAGES 2 UIDNEXT 7)'.  Names are
+    decoded from modified UTF-7, with INBOX in upper case; items are a
+    dictionary of upper-case item names and values (ints for numbers).
+    Lines which can't be parsed are skipped.
+    '''
+    statuses = {}
+    name = None
+    for line in data:
+        if isinstance(line, tuple):
+            # Mailbox name sent as a literal; the items follow
+            name = line[1]
+            continue
+        match = line and _STATUS_RE.match(line)
+        if not match:
+            name = None
+            continue
+        if match.group(1) is not None:
+            name = _ESCAPED_RE.sub(br'\1', match.group(1))
+        elif match.group(2) is not None:
+            name = match.group(2)
+        if name is None:
+            continue
+        words = match.group(3).split()
+        items = {}
+        for (item, value) in zip(words[::2], words[1::2]):
+            items[item.decode('ascii', 'replace').upper()] = (
+                int(value) if value.isdigit()
+                else value.decode('ascii', 'replace')
+            )
+        name = codecs.decode(name, 'imap4-utf-7')
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        statuses[name] = items
+        name = None
+    return statuses
@@ -11,8 +11,10 @@ a certain level to one fd, and other messages of higher levels to a different fd
 '''
 
 import sys
+import os
 import os.path
 import traceback
+import threading
 
 from getmailcore.constants import *
 
@@ -29,6 +31,14 @@ class _Logger(object):
         '''Create a logger.'''
         self.handlers = []
         self.newline = False
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        if hasattr(os, 'register_at_fork'):
+            # A forked child must not inherit the lock held by another thread
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.RLock()
 
     def __call__(self):
         return self
@@ -53,10 +63,36 @@ class _Logger(object):
         '''
         self.handlers = []
 
+    def buffer(self):
+        '''Hold back the messages logged by the calling thread until flush()
+        is called, so the output of accounts processed at the same time
+        (getmail --parallel) doesn't get mixed up.
+        '''
+        self._local.buffer = []
+
+    def flush(self):
+        '''Output the messages held back since buffer() was called.'''
+        buffered = getattr(self._local, 'buffer', None)
+        self._local.buffer = None
+        if buffered:
+            with self._lock:
+                for (msglevel, msgtxt) in buffered:
+                    self._write(msglevel, msgtxt)
+
     def log(self, msglevel, msgtxt):
         '''Log a message of level <msglevel> containing text <msgtxt>.'''
         if sys.version_info.major > 2 and isinstance(msgtxt,bytes):
             msgtxt = msgtxt.decode()
+        buffered = getattr(self._local, 'buffer', None)
+        if buffered is not None:
+            if (not self.handlers or [handler for handler in self.handlers
+                    if handler['minlevel'] <= msglevel <= handler['maxlevel']]):
+                buffered.append((msglevel, msgtxt))
+            return
+        with self._lock:
+            self._write(msglevel, msgtxt)
+
+    def _write(self, msglevel, msgtxt):
         for handler in self.handlers:
             if msglevel < handler['minlevel'] or msglevel > handler['maxlevel']:
                 continue
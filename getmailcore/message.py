@@ -11,6 +11,7 @@ import sys
 import os
 import time
 import re
+import itertools
 import email
 try: #py2
     import email.Errors as Errors
@@ -22,7 +23,7 @@ except ImportError:
     import email.errors as Errors
     import email.utils as Utils
     import email.parser as Parser
-    from email.generator import Generator
+    from email.generator import Generator, BytesGenerator
     from email.header import Header
 
 
@@ -45,6 +46,124 @@ message_attributes = (
 )
 
 _NL = os.linesep.encode()
+# The empty line ending the header block
+_HEADER_END_RE = re.compile(br'\A\r?\n|\n\r?\n')
+_EOL_RE = re.compile(b'\r\n|\r|\n')
+_FROMLINE_RE = re.compile(b'^(>*From )', re.MULTILINE)
+# Size of the pieces flatten_iter() returns the raw body in
+_BODY_CHUNK = 1 << 20
+
+#######################################
+def _parser():
+    try:
+        return Parser.BytesParser()
+    except: #py2
+        return Parser.Parser()
+
+#######################################
+def _parsebytes(s, headersonly=False):
+    parser = _parser()
+    try:
+        parse = parser.parsebytes
+    except AttributeError: #py2
+        parse = parser.parsestr
+    return parse(s, headersonly)
+
+#######################################
+def _mangle_from(s):
+    # do mboxrd-style "From " line quoting (add one '>')
+    return _FROMLINE_RE.sub(b'>\\1', s)
+
+#######################################
+def _raw_pieces(raw, start):
+    '''Yield the raw message from offset start on, in pieces of about
+    _BODY_CHUNK bytes ending at line ends.  raw is a string or a file.'''
+    if not isinstance(raw, bytes):
+        raw.seek(start)
+        while True:
+            chunk = raw.read(_BODY_CHUNK)
+            if not chunk:
+                break
+            yield chunk + raw.readline()
+        return
+    end = len(raw)
+    while start < end:
+        stop = raw.find(b'\n', start + _BODY_CHUNK)
+        stop = end if stop == -1 else stop + 1
+        yield raw[start:stop]
+        start = stop
+
+#######################################
+def _body_chunks(raw, start, mangle_from=False):
+    '''Yield the raw message from offset start on in pieces ending at line
+    ends, with native EOL.'''
+    for chunk in _raw_pieces(raw, start):
+        if _NL == b'\n':
+            chunk = chunk.replace(b'\r\n', b'\n')
+            if b'\r' in chunk:
+                chunk = chunk.replace(b'\r', b'\n')
+        else:
+            chunk = _EOL_RE.sub(_NL, chunk)
+        if mangle_from:
+            chunk = _mangle_from(chunk)
+        yield chunk
+
+#######################################
+class _Chunks(object):
+    '''File-like target for the email generator.  Collects what is written
+    in pieces of about _BODY_CHUNK bytes ending at line ends, mboxrd-quoted
+    piece by piece if mangle_from, so the message never needs to be in
+    memory as one string.  All pieces are still held until the generator
+    is done: only the raw body (see _body_chunks()) is streamed.'''
+    def __init__(self, mangle_from):
+        self.mangle_from = mangle_from
+        self.chunks = []
+        self.buf = bytearray()
+
+    def write(self, s):
+        # The generator writes the body of a part in one go, so cut up
+        # long writes instead of buffering them
+        start = 0
+        while len(self.buf) + len(s) - start >= _BODY_CHUNK:
+            stop = s.find(b'\n',
+                          start + max(0, _BODY_CHUNK - len(self.buf) - 1))
+            if stop == -1:
+                break
+            chunk = s[start:stop + 1]
+            if self.buf:
+                chunk = bytes(self.buf) + chunk
+                self.buf = bytearray()
+            self.__emit(chunk)
+            start = stop + 1
+        if start < len(s):
+            self.buf += s[start:]
+
+    def __emit(self, chunk):
+        if self.mangle_from:
+            chunk = _mangle_from(chunk)
+        self.chunks.append(chunk)
+
+    def close(self):
+        if self.buf:
+            self.__emit(bytes(self.buf))
+            self.buf = bytearray()
+        return self.chunks
+
+#######################################
+def _generate(msg, mangle_from):
+    '''Return the email.Message() msg as a list of pieces with native EOL.
+    '''
+    try: #py3
+        policy = msg.policy.clone(linesep=os.linesep)
+    except AttributeError: #py2
+        bmsg = msg.as_string()
+        bmsg = _NL.join(bmsg.splitlines() + [b''])
+        if mangle_from:
+            bmsg = _mangle_from(bmsg)
+        return [bmsg]
+    out = _Chunks(mangle_from)
+    BytesGenerator(out, mangle_from_=False, policy=policy).flatten(msg)
+    return out.close()
 
 #######################################
 def corrupt_message(why, fromlines=None, fromstring=None):
@@ -81,10 +200,26 @@ class Message(object):
     '''Message class for getmail.  Does sanity-checking on attribute accesses
     and provides some convenient interfaces to an underlying email.Message()
     object.
+
+    Messages retrieved from a server are parsed lazily: only the header block
+    is parsed until content() asks for the whole email.Message(), and as long
+    as it doesn't, flatten() writes the (possibly modified) header fields
+    followed by the raw body, untouched except for line endings.  The raw
+    message can also be kept in a file (fromspool), so that it doesn't have
+    to be held in memory at all.
+
+    What the email generator makes of the message for flatten() is kept until
+    the message is changed, so delivering it to several destinations
+    generates it only once.  Destinations writing files can record them with
+    add_copy(), for the next one to link instead of writing its own.
     '''
     __slots__ = (
         '__msg',
+        '__hdrs',
         '__raw',
+        '__body',
+        '__generated',
+        '__copies',
         #'log',
         'sender',
         'received_by',
@@ -92,43 +227,36 @@ class Message(object):
         'received_with',
         'recipient',
     )
-    def __init__(self, fromlines=None, fromstring=None, fromfile=None):
+    def __init__(self, fromlines=None, fromstring=None, fromfile=None,
+                 fromspool=None):
         #self.log = Logger()
         self.recipient = None
         self.received_by = None
         self.received_from = None
         self.received_with = None
         self.__raw = None
-        try:
-            parser = Parser.BytesParser()
-            parsestr = parser.parsebytes
-        except: #py2
-            parser = Parser.Parser()
-            parsestr = parser.parsestr
-
+        self.__msg = None
+        self.__hdrs = None
+        self.__body = None
+        # mangle_from -> pieces generated by _generate(), which hold the
+        # whole message if it was parsed
+        self.__generated = {}
+        self.__copies = {}
 
         # Message is instantiated with fromlines for POP3, fromstring for
         # IMAP (both of which can be badly-corrupted or invalid, i.e. spam,
         # MS worms, etc).  It's instantiated with fromfile for the output
-        # of filters, etc, which should be saner.
-        if fromlines:
-            try:
-                self.__msg = parsestr(_NL.join(fromlines))
-                #_msg = ucparse(parsestr,_NL.join(["über".encode('latin-1'),"Höhen".encode('latin-1')]))
-                #type(_msg) #<class 'email.message.Message'>
-            except (Errors.MessageError,UnicodeDecodeError) as o:
-                self.__msg = corrupt_message(o, fromlines=fromlines)
+        # of filters, etc, which should be saner.  fromspool is a seekable
+        # file with the raw message as retrieved, for POP3 as well.
+        if fromspool:
+            self.__raw = fromspool
+        elif fromlines:
             self.__raw = _NL.join(fromlines)
         elif fromstring:
-            try:
-                self.__msg = parsestr(fromstring)
-                #_msg = ucparse(parsestr,"über\nHöhen".encode('latin-1'))
-            except (Errors.MessageError,UnicodeDecodeError) as o:
-                self.__msg = corrupt_message(o, fromstring=fromstring)
             self.__raw = fromstring
         elif fromfile:
             try:
-                self.__msg = parser.parse(fromfile)
+                self.__msg = _parser().parse(fromfile)
                 #from io import BytesIO
                 #fromfile=BytesIO(_NL.join(["über".encode('latin-1'),"Höhen".encode('latin-1')]))
                 #_msg = ucparse(parser.parse,fromfile)
@@ -141,11 +269,66 @@ class Message(object):
             # Can't happen?
             raise SystemExit('Message() called with wrong arguments')
 
-        self.sender = address_no_brackets(self.__msg['Return-Path']
-                                          or self.__msg['Sender']
+        hdrs = self.__headers()
+        self.sender = address_no_brackets(hdrs['Return-Path']
+                                          or hdrs['Sender']
                                           or 'unknown')
 
+    def __headers(self):
+        '''Return the email.Message() holding the header fields; the
+        header-only one unless the whole message has been parsed.'''
+        if self.__msg is not None:
+            return self.__msg
+        if self.__hdrs is None:
+            if isinstance(self.__raw, bytes):
+                m = _HEADER_END_RE.search(self.__raw)
+                if m:
+                    (head, self.__body) = (self.__raw[:m.start()], m.end())
+                else:
+                    (head, self.__body) = (self.__raw, len(self.__raw))
+            else:
+                lines = []
+                self.__raw.seek(0)
+                for line in iter(self.__raw.readline, b''):
+                    if not line.strip(b'\r\n'):
+                        break
+                    lines.append(line)
+                (head, self.__body) = (b''.join(lines), self.__raw.tell())
+            try:
+                hdrs = _parsebytes(head, headersonly=True)
+            except (Errors.MessageError,UnicodeDecodeError):
+                hdrs = None
+            if hdrs is None or hdrs.get_payload():
+                # Broken header block; let the full parse deal with it
+                return self.content()
+            self.__hdrs = hdrs
+        return self.__hdrs
+
+    def __rawbytes(self):
+        if isinstance(self.__raw, bytes):
+            return self.__raw
+        self.__raw.seek(0)
+        return self.__raw.read()
+
+    def __changed(self):
+        '''Forget the generated message and the copies of it.'''
+        self.__generated = {}
+        self.__copies = {}
+
     def content(self):
+        # The caller may change the email.Message() returned
+        self.__changed()
+        if self.__msg is None:
+            try:
+                self.__msg = _parsebytes(self.__rawbytes())
+                #_msg = ucparse(parsestr,"über\nHöhen".encode('latin-1'))
+            except (Errors.MessageError,UnicodeDecodeError) as o:
+                self.__msg = corrupt_message(o, fromstring=self.__rawbytes())
+            else:
+                if self.__hdrs is not None:
+                    # Keep header fields added or removed so far
+                    self.__msg._headers = list(self.__hdrs._headers)
+            self.__hdrs = None
         return self.__msg
 
     def copyattrs(self, othermsg):
@@ -165,6 +348,20 @@ class Message(object):
         quotes "From ", not ">From " (i.e. it uses mboxo format instead of
         mboxrd).  So we don't use its mangling, and do it by hand instead.
         '''
+        return b''.join(self.flatten_iter(delivered_to, received, mangle_from,
+                                          include_from))
+
+    def flatten_iter(self, delivered_to, received, mangle_from=False,
+                     include_from=False):
+        '''Like flatten(), but return an iterator over chunks of the
+        message, so it can be written out without another copy of it in
+        memory.
+
+        Only the raw body of a message that was not parsed is streamed from
+        the retrieved message.  A parsed message (e.g. after a filter
+        changed its body) is generated in full, and the generated pieces
+        are kept for the other destinations until the message changes.
+        '''
         if include_from:
             # Mbox-style From line, not rfc822 From: header field.
             fromline = 'From %s %s' % (mbox_from_escape(self.sender),
@@ -174,7 +371,9 @@ class Message(object):
         # Write the Return-Path: header
         rpline = format_header('Return-Path', '<%s>' % self.sender)
         # Remove previous Return-Path: header fields.
-        del self.__msg['Return-Path']
+        if self.__headers()['Return-Path'] is not None:
+            del self.__headers()['Return-Path']
+            self.__changed()
         if delivered_to:
             dtline = format_header('Delivered-To', self.recipient or 'unknown')
         else:
@@ -193,37 +392,57 @@ class Message(object):
             rcvline = format_header('Received', rcvd)
         else:
             rcvline = ''
+        prefix = (fromline+rpline+dtline+rcvline).encode('ASCII',errors="replace")
         # From_ handled above, always tell the generator not to include it
+        msg = self.__msg
+        if msg is None:
+            # Only the header fields need to go through the generator
+            msg = self.__hdrs
         try:
-            try: #py3
-                bmsg = self.__msg.as_bytes(
-                    policy=self.__msg.policy.clone(linesep=os.linesep))
-            except AttributeError: #py2
-                bmsg = self.__msg.as_string()
-                bmsg = _NL.join(bmsg.splitlines() + [b''])
-            if mangle_from:
-                # do mboxrd-style "From " line quoting (add one '>')
-                RE_FROMLINE = re.compile(b'^(>*From )', re.MULTILINE)
-                bmsg = RE_FROMLINE.sub(b'>\\1', bmsg)
-
-            return ((fromline+rpline+dtline+rcvline).encode('ASCII',errors="replace")+bmsg)
-
+            if mangle_from not in self.__generated:
+                self.__generated[mangle_from] = _generate(msg, mangle_from)
+            chunks = [prefix] + self.__generated[mangle_from]
         except (TypeError,UnicodeEncodeError) as o:
             if self.__raw is None:
                 # Argh -- a filter took a correctly-formatted message
                 # and returned a badly-misformatted one?
                 raise getmailDeliveryError('failed to parse retrieved message '
                                            'and could not recover (%s)' % o)
-            self.__msg = corrupt_message(o, fromstring=self.__raw)
-            return self.flatten(delivered_to, received, mangle_from, include_from)
+            self.__msg = corrupt_message(o, fromstring=self.__rawbytes())
+            self.__hdrs = None
+            self.__changed()
+            return self.flatten_iter(delivered_to, received, mangle_from,
+                                     include_from)
+        if msg is self.__hdrs:
+            chunks = itertools.chain(chunks, _body_chunks(
+                self.__raw, self.__body, mangle_from))
+        return chunks
+
+    def __copykey(self, key):
+        return (key, self.sender, self.recipient, self.received_from,
+                self.received_by, self.received_with)
+
+    def copies(self, key):
+        '''Return the file names recorded with add_copy() under key since
+        the message was last changed, most recent first.'''
+        return self.__copies.get(self.__copykey(key), [])
 
+    def add_copy(self, key, filenames):
+        '''Record files holding the message as flattened by flatten_iter().
+        key must stand for the arguments to flatten_iter() and anything
+        else making the files differ; the message attributes going into
+        the added header fields are taken care of.'''
+        copies = self.__copies.setdefault(self.__copykey(key), [])
+        copies[:0] = filenames
 
     def add_header(self, name, content):
+        self.__changed()
         content_rstriped = content.rstrip()
         try:
-            self.__msg[name] = Header(content_rstriped)
+            self.__headers()[name] = Header(content_rstriped)
         except (UnicodeDecodeError, LookupError):
-            for chs in self.__msg.get_charsets():
+            # The charsets are those of the body parts, too
+            for chs in self.content().get_charsets():
                 if chs is None:
                     continue
                 try:
@@ -234,10 +453,11 @@ class Message(object):
             self.__msg[name] = Header(content_rstriped,'utf-8',errors="replace")
 
     def remove_header(self, name):
-        del self.__msg[name]
+        self.__changed()
+        del self.__headers()[name]
 
     def headers(self):
-        return self.__msg._headers
+        return self.__headers()._headers
 
     def get_all(self, name, failobj=None):
-        return self.__msg.get_all(name, failobj)
+        return self.__headers().get_all(name, failobj)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+# docs/COPYING 2a + DRY: https://github.com/getmail6/getmail6
+# Please refer to the git history regarding who changed what and when in this file.
+
+'''Storage backends for the oldmail state, i.e. which messages of a mailbox
+have been seen before, and when.
+
+Each store behaves like a dictionary of msgid -> timestamp for one mailbox
+(or the whole account, for POP3), with these additional methods:
+
+  load()           read (or open) the existing state
+  add(msgids, t)   record msgids as seen at timestamp t, unless already known
+  expired(before)  return the msgids first seen before timestamp `before`
+  commit()         make the changes persistent, return the number of
+                   entries written
+
+OldmailFile     - the traditional oldmail file, one "msgid\\0timestamp" line
+                  per message, completely rewritten on each commit.
+OldmailJournal  - the same file format, but a commit only appends the new
+                  lines.  The file is rewritten (compacted) only if entries
+                  were removed, or it contains duplicate or broken lines.
+OldmailSqlite   - one SQLite database per account, indexed per mailbox, so
+                  nothing has to be read up front.  The oldmail file of a
+                  mailbox is imported the first time the mailbox is used.
+'''
+
+import os
+import sqlite3
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from getmailcore.utilities import updatefile
+
+__all__ = [
+    'OLDMAIL_BACKENDS',
+    'OldmailFile',
+    'OldmailJournal',
+    'OldmailSqlite',
+]
+
+OLDMAIL_BACKENDS = ('file', 'journal', 'sqlite')
+
+#######################################
+def _read_oldmail(f, log, logname):
+    '''Yield (msgid, timestamp) pairs from an open oldmail file.'''
+    for line in f:
+        line = line.strip()
+        if not line or not '\0' in line:
+            # malformed
+            continue
+        try:
+            (msgid, timestamp) = line.split('\0', 1)
+            if msgid.count('/') == 2:
+                # Was pre-4.22.0 file format, which includes the
+                # mailbox name in the msgid, in the format
+                # 'uidvalidity/mailbox/serveruid'.
+                # Strip it out.
+                fields = msgid.split('/')
+                msgid = '/'.join([fields[0], fields[2]])
+            yield (msgid, int(timestamp))
+        except ValueError:
+            # malformed
+            log.info(
+                'skipped malformed line "%r" for %s%s'
+                % (line, logname, os.linesep)
+            )
+
+#######################################
+class OldmailFile(dict):
+    '''Oldmail state kept in memory, and written out completely on each
+    commit.
+    '''
+    def __init__(self, filename, log, logname):
+        dict.__init__(self)
+        self.filename = filename
+        self.log = log
+        self.logname = logname
+        # Non-empty lines in the file as read
+        self.lines = 0
+        # File ends with a partial line (i.e. a crash while appending)
+        self.torn = False
+
+    def load(self):
+        try:
+            f = open(self.filename)
+        except IOError:
+            self.log.moreinfo('no oldmail file for %s%s'
+                              % (self.logname, os.linesep))
+            return
+        with f:
+            for (msgid, timestamp) in _read_oldmail(self._lines(f), self.log,
+                                                    self.logname):
+                self[msgid] = timestamp
+        self.log.moreinfo('read %i uids for %s%s'
+                          % (len(self), self.logname, os.linesep))
+
+    def _lines(self, f):
+        for line in f:
+            if line.strip():
+                self.lines += 1
+            self.torn = not line.endswith('\n')
+            yield line
+
+    def add(self, msgids, timestamp):
+        for msgid in msgids:
+            if msgid not in self:
+                self[msgid] = timestamp
+
+    def expired(self, before):
+        return [msgid for (msgid, timestamp) in self.items()
+                if timestamp < before]
+
+    def commit(self):
+        oldmailfile = None
+        try:
+            oldmailfile = updatefile(self.filename)
+            for (msgid, timestamp) in self.items():
+                oldmailfile.write('%s\0%i%s' % (msgid, timestamp, os.linesep))
+            oldmailfile.close()
+        except IOError:
+            if oldmailfile:
+                oldmailfile.abort()
+            raise
+        self.lines = len(self)
+        self.torn = False
+        return len(self)
+
+#######################################
+class OldmailJournal(OldmailFile):
+    '''Oldmail file that is appended to on commit, and only rewritten when
+    necessary.
+    '''
+    def __init__(self, filename, log, logname):
+        OldmailFile.__init__(self, filename, log, logname)
+        self.pending = []
+        self.compact = False
+
+    def __delitem__(self, msgid):
+        OldmailFile.__delitem__(self, msgid)
+        self.compact = True
+
+    def add(self, msgids, timestamp):
+        for msgid in msgids:
+            if msgid not in self:
+                self[msgid] = timestamp
+                self.pending.append(msgid)
+
+    def commit(self):
+        if (self.compact or self.torn or self.lines != len(self) - len(self.pending)
+                or not os.path.isfile(self.filename)):
+            self.log.debug('compacting oldmail file for %s%s'
+                           % (self.logname, os.linesep))
+            wrote = OldmailFile.commit(self)
+            self.pending = []
+            self.compact = False
+            return wrote
+        if not self.pending:
+            return 0
+        with open(self.filename, 'a') as f:
+            for msgid in self.pending:
+                f.write('%s\0%i%s' % (msgid, self[msgid], os.linesep))
+            f.flush()
+            os.fsync(f.fileno())
+        wrote = len(self.pending)
+        self.lines += wrote
+        self.pending = []
+        return wrote
+
+#######################################
+class OldmailSqlite(MutableMapping):
+    '''Oldmail state of one mailbox in an SQLite database shared by all
+    mailboxes of the account.  Changes are kept in memory until commit(), so
+    the database is only locked briefly.
+    '''
+    def __init__(self, filename, log, logname, dbname, mailbox):
+        self.filename = filename
+        self.log = log
+        self.logname = logname
+        self.dbname = dbname
+        self.mailbox = mailbox or ''
+        self.db = None
+        self.added = {}
+        self.deleted = set()
+
+    def load(self):
+        try:
+            self.db = sqlite3.connect(self.dbname, timeout=60,
+                                      isolation_level=None)
+            self.db.execute('CREATE TABLE IF NOT EXISTS oldmail ('
+                            'mailbox TEXT NOT NULL, msgid TEXT NOT NULL, '
+                            'timestamp INTEGER NOT NULL, '
+                            'PRIMARY KEY (mailbox, msgid))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS imported ('
+                            'mailbox TEXT PRIMARY KEY)')
+            if self.db.execute('SELECT 1 FROM imported WHERE mailbox = ?',
+                               (self.mailbox, )).fetchone():
+                return
+            # First use of this mailbox; take over its oldmail file
+            oldmail = {}
+            try:
+                with open(self.filename) as f:
+                    for (msgid, timestamp) in _read_oldmail(f, self.log,
+                                                            self.logname):
+                        oldmail[msgid] = timestamp
+            except IOError:
+                pass
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO oldmail VALUES (?, ?, ?)',
+                    [(self.mailbox, msgid, timestamp)
+                     for (msgid, timestamp) in oldmail.items()]
+                )
+                self.db.execute('INSERT OR IGNORE INTO imported VALUES (?)',
+                                (self.mailbox, ))
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+            self.log.moreinfo('imported %i uids for %s%s'
+                              % (len(oldmail), self.logname, os.linesep))
+        except sqlite3.Error as o:
+            raise IOError('%s, opening oldmail database "%s"'
+                          % (o, self.dbname))
+
+    def __getitem__(self, msgid):
+        if msgid in self.added:
+            return self.added[msgid]
+        if msgid in self.deleted:
+            raise KeyError(msgid)
+        row = self.db.execute(
+            'SELECT timestamp FROM oldmail WHERE mailbox = ? AND msgid = ?',
+            (self.mailbox, msgid)
+        ).fetchone()
+        if row is None:
+            raise KeyError(msgid)
+        return row[0]
+
+    def __setitem__(self, msgid, timestamp):
+        self.deleted.discard(msgid)
+        self.added[msgid] = timestamp
+
+    def __delitem__(self, msgid):
+        self[msgid]
+        self.added.pop(msgid, None)
+        self.deleted.add(msgid)
+
+    def _stored(self):
+        return [row[0] for row in self.db.execute(
+            'SELECT msgid FROM oldmail WHERE mailbox = ?', (self.mailbox, )
+        )]
+
+    def __iter__(self):
+        msgids = [msgid for msgid in self._stored()
+                  if msgid not in self.deleted and msgid not in self.added]
+        return iter(msgids + list(self.added))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def add(self, msgids, timestamp):
+        for msgid in msgids:
+            if msgid not in self:
+                self[msgid] = timestamp
+
+    def expired(self, before):
+        msgids = [row[0] for row in self.db.execute(
+            'SELECT msgid FROM oldmail WHERE mailbox = ? AND timestamp < ?',
+            (self.mailbox, before)
+        ) if row[0] not in self.deleted and row[0] not in self.added]
+        return msgids + [msgid for (msgid, timestamp) in self.added.items()
+                         if timestamp < before]
+
+    def commit(self):
+        if not (self.added or self.deleted):
+            return 0
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(
+                    'DELETE FROM oldmail WHERE mailbox = ? AND msgid = ?',
+                    [(self.mailbox, msgid) for msgid in self.deleted]
+                )
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO oldmail VALUES (?, ?, ?)',
+                    [(self.mailbox, msgid, timestamp)
+                     for (msgid, timestamp) in self.added.items()]
+                )
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as o:
+            raise IOError('%s, updating oldmail database "%s"'
+                          % (o, self.dbname))
+        wrote = len(self.added)
+        self.added = {}
+        self.deleted = set()
+        return wrote
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# docs/COPYING 2a + DRY: https://github.com/getmail6/getmail6
+# Please refer to the git history regarding who changed what and when in this file.
+
+'''Message list of an IMAP mailbox as of a HIGHESTMODSEQ (RFC 7162), kept
+between sessions for imap_sync_state.
+
+The list is kept in a journal file per account and mailbox, with lines
+
+  uidvalidity <n>    start of the list (a new UIDVALIDITY or a full listing)
+  modseq <n>         the list is valid as of this HIGHESTMODSEQ
+  +<uid> [<size>]    message added (without size with skip_imap_fetch_size)
+  -<uid>             message expunged
+
+A commit only appends the changes since the last one.  The file is rewritten
+(compacted) when it holds many more lines than messages, ends with a partial
+line, or was changed by someone else since it was read or written.
+'''
+
+import os
+
+from getmailcore.utilities import updatefile
+
+__all__ = [
+    'SyncList',
+]
+
+# Compact the journal when it has this many more lines than messages
+_COMPACT_SLACK = 1000
+
+def _addline(uid, size):
+    if size is None:
+        return '+%d' % uid
+    return '+%d %d' % (uid, size)
+
+#######################################
+class SyncList(object):
+    '''UID -> size (or None) of the messages of one mailbox, with the
+    UIDVALIDITY and HIGHESTMODSEQ it is valid for.
+    '''
+    def __init__(self, filename, log, logname):
+        self.filename = filename
+        self.log = log
+        self.logname = logname
+        self.uidvalidity = None
+        self.modseq = None
+        self.sizes = {}
+        # Messages without size
+        self.unsized = 0
+        # Lines to append on commit; None to rewrite the file
+        self.pending = []
+        self.lines = 0
+        # (inode, size, mtime) of the file as last read or written
+        self.stat = None
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def _filestat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def changed_on_disk(self):
+        '''Return True if the file isn't as last read or written.'''
+        return self._filestat() != self.stat
+
+    def _set(self, uid, size):
+        self._pop(uid)
+        self.sizes[uid] = size
+        if size is None:
+            self.unsized += 1
+
+    def _pop(self, uid):
+        if uid in self.sizes and self.sizes.pop(uid) is None:
+            self.unsized -= 1
+
+    def load(self):
+        self.uidvalidity = None
+        self.modseq = None
+        self.sizes = {}
+        self.unsized = 0
+        self.pending = []
+        self.lines = 0
+        try:
+            f = open(self.filename)
+        except IOError:
+            self.stat = None
+            return
+        torn = False
+        with f:
+            for line in f:
+                self.lines += 1
+                if not line.endswith('\n'):
+                    # Partly written by an interrupted commit
+                    torn = True
+                    break
+                try:
+                    self._replay(line.split())
+                except (IndexError, ValueError):
+                    self.log.info('skipped malformed line "%r" for %s%s'
+                                  % (line, self.logname, os.linesep))
+                    torn = True
+        self.stat = self._filestat()
+        if torn:
+            self.pending = None
+        self.log.moreinfo('read sync state of %i messages for %s%s'
+                          % (len(self.sizes), self.logname, os.linesep))
+
+    def _replay(self, words):
+        if words[0] == 'uidvalidity':
+            self.uidvalidity = words[1]
+            self.modseq = None
+            self.sizes = {}
+            self.unsized = 0
+        elif words[0] == 'modseq':
+            self.modseq = int(words[1])
+        elif words[0].startswith('+'):
+            self._set(int(words[0][1:]),
+                      int(words[1]) if len(words) > 1 else None)
+        elif words[0].startswith('-'):
+            self._pop(int(words[0][1:]))
+        else:
+            raise ValueError(words[0])
+
+    def _append(self, line):
+        if self.pending is not None:
+            self.pending.append(line)
+
+    def reset(self, uidvalidity, modseq, sizes):
+        '''Replace the list, e.g. from a full listing of the mailbox, with
+        the (uid, size) pairs of sizes.'''
+        self.uidvalidity = uidvalidity
+        self.modseq = modseq
+        self.sizes = {}
+        self.unsized = 0
+        for (uid, size) in sizes:
+            self._set(uid, size)
+        self.pending = None
+
+    def add(self, uid, size):
+        if self.sizes.get(uid, -1) != size:
+            self._set(uid, size)
+            self._append(_addline(uid, size))
+
+    def remove(self, uid):
+        if uid in self.sizes:
+            self._pop(uid)
+            self._append('-%d' % uid)
+
+    def set_modseq(self, modseq):
+        if modseq != self.modseq:
+            self.modseq = modseq
+            self._append('modseq %d' % modseq)
+
+    def commit(self):
+        '''Write the changes; returns the number of lines written.'''
+        if self.pending == []:
+            return 0
+        if (self.pending is None or self.changed_on_disk()
+                or self.lines + len(self.pending)
+                   > 2 * len(self.sizes) + _COMPACT_SLACK):
+            return self._rewrite()
+        with open(self.filename, 'a') as f:
+            for line in self.pending:
+                f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        wrote = len(self.pending)
+        self.lines += wrote
+        self.pending = []
+        self.stat = self._filestat()
+        return wrote
+
+    def _rewrite(self):
+        self.log.debug('compacting sync state for %s%s'
+                       % (self.logname, os.linesep))
+        lines = ['uidvalidity %s' % self.uidvalidity]
+        if self.modseq is not None:
+            lines.append('modseq %d' % self.modseq)
+        lines.extend(_addline(uid, size)
+                     for (uid, size) in sorted(self.sizes.items()))
+        syncfile = None
+        try:
+            syncfile = updatefile(self.filename)
+            for line in lines:
+                syncfile.write(line + '\n')
+            syncfile.close()
+        except IOError:
+            if syncfile:
+                syncfile.abort()
+            raise
+        self.lines = len(lines)
+        self.pending = []
+        self.stat = self._filestat()
+        return len(lines)
@@ -19,6 +19,7 @@ import pwd
 import grp
 import getpass
 import subprocess
+import tempfile
 import sys
 try:
     import secrets
@@ -42,14 +43,18 @@ __all__ = [
     'deliver_maildir',
     'eval_bool',
     'expand_user_vars',
+    'fsync_dir',
     'is_maildir',
     'localhostname',
     'lock_file',
     'logfile',
+    'maildir_commit',
+    'maildir_tmpfile',
     'mbox_from_escape',
     'safe_open',
     'unlock_file',
     'gid_of_uid',
+    'gid_of_group',
     'uid_of_user',
     'updatefile',
     'get_password',
@@ -146,7 +151,6 @@ class updatefile(object):
     def __init__(self, filename):
         self.closed = False
         self.filename = filename
-        self.tmpname = filename + '.tmp.%d' % os.getpid()
         # If the target is a symlink, the rename-on-close semantics of this
         # class would break the symlink, replacing it with the new file.
         # Instead, follow the symlink here, and replace the target file on
@@ -154,10 +158,17 @@ class updatefile(object):
         while os.path.islink(filename):
             filename = os.path.join(os.path.dirname(filename),
                                     os.readlink(filename))
+        # A unique name in the same directory, so that threads of one process
+        # (--parallel) don't share it and the rename stays atomic
         try:
-            f = safe_open(self.tmpname, 'w')
-        except IOError as msg:
-            raise IOError('%s, opening output file "%s"' % (msg, self.tmpname))
+            (fd, self.tmpname) = tempfile.mkstemp(
+                prefix=os.path.basename(self.filename) + '.tmp.',
+                dir=os.path.dirname(self.filename) or os.curdir
+            )
+            f = os.fdopen(fd, 'w')
+        except (IOError, OSError) as msg:
+            raise IOError('%s, opening output file for "%s"'
+                          % (msg, self.filename))
         self.file = f
         self.write = f.write
         self.flush = f.flush
@@ -169,7 +180,8 @@ class updatefile(object):
         try:
             if hasattr(self, 'file'):
                 self.file.close()
-        except IOError:
+                os.unlink(self.tmpname)
+        except (IOError, OSError):
             pass
         self.closed = True
 
@@ -278,13 +290,39 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0o600):
     http://cr.yp.to/proto/maildir.html and
     http://qmail.org/man/man5/maildir.html for details.
     '''
+    # Set a 24-hour alarm for this delivery
+    try:
+        signal.signal(signal.SIGALRM, alarm_handler)
+        alarm = signal.alarm
+    except ValueError:
+        # Signals only work in the main thread (getmail --parallel)
+        alarm = lambda unused: None
+    alarm(24 * 60 * 60)
+
+    try:
+        (fname_tmp, fname_new) = maildir_tmpfile(maildirpath, data, hostname,
+                                                 dcount, filemode)
+        maildir_commit([(fname_tmp, fname_new)])
+    finally:
+        # Cancel alarm
+        if alarm is signal.alarm:
+            alarm(0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+    return os.path.basename(fname_new)
+
+#######################################
+def maildir_tmpfile(maildirpath, data, hostname, dcount=None, filemode=0o600,
+                    linkfrom=()):
+    '''Write a message to a new file in maildirpath/tmp/ and fsync it; the
+    first half of deliver_maildir().  data is the message, or an iterable of
+    pieces of it.  Instead of writing it, the first of the files in linkfrom
+    which can be hard-linked is used, if any.  Returns the (tmp, new) file
+    names to pass to maildir_commit().
+    '''
     if not is_maildir(maildirpath):
         raise getmailDeliveryError('not a Maildir (%s)' % maildirpath)
 
-    # Set a 24-hour alarm for this delivery
-    signal.signal(signal.SIGALRM, alarm_handler)
-    signal.alarm(24 * 60 * 60)
-
     info = {
         'deliverycount' : dcount,
         'hostname' : hostname.replace('/', '\\057').replace(
@@ -326,11 +364,15 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0o600):
         # Found an unused filename
         break
     else:
-        signal.alarm(0)
         raise getmailDeliveryError('failed to allocate file in maildir')
 
-    # Get user & group of maildir
-    s_maildir = os.stat(maildirpath)
+    for fname in linkfrom:
+        try:
+            os.link(fname, fname_tmp)
+            return (fname_tmp, fname_new)
+        except OSError:
+            # Moved on, or on another file system
+            pass
 
     # Open file to write
     try:
@@ -338,42 +380,62 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0o600):
             f = safe_open(fname_tmp, 'bw', filemode)
         else:
             f = safe_open(fname_tmp, 'w', filemode)
-        f.write(data)
+        if isinstance(data, bytes):
+            data = (data, )
+        for chunk in data:
+            f.write(chunk)
         f.flush()
         os.fsync(f.fileno())
         f.close()
 
     except IOError as o:
-        signal.alarm(0)
         raise getmailDeliveryError('failure writing file %s (%s)'
                                    % (fname_tmp, o))
 
-    # Move message file from Maildir/tmp to Maildir/new
-    try:
-        # #https://pypi.org/project/getmail_shutils/#description
-        # #Version of getmail using shutil instead of os.link to allow it to be used with a shared destination folder in a VM.
-        # shutil.copyfile(fname_tmp, fname_new)
-        os.link(fname_tmp, fname_new)
-        os.unlink(fname_tmp)
-
-    except OSError:
-        signal.alarm(0)
+    return (fname_tmp, fname_new)
+
+#######################################
+def maildir_commit(files):
+    '''Move message files written by maildir_tmpfile() from Maildir/tmp to
+    Maildir/new, and fsync the new/ directories once, so the messages are
+    safely delivered when this returns.
+    '''
+    for (fname_tmp, fname_new) in files:
         try:
+            # #https://pypi.org/project/getmail_shutils/#description
+            # #Version of getmail using shutil instead of os.link to allow it to be used with a shared destination folder in a VM.
+            # shutil.copyfile(fname_tmp, fname_new)
+            os.link(fname_tmp, fname_new)
             os.unlink(fname_tmp)
-        except KeyboardInterrupt:
-            raise
-        except Exception:
-            pass
-        raise getmailDeliveryError('failure renaming "%s" to "%s"'
-                                   % (fname_tmp, fname_new))
 
-    # Delivery done
-
-    # Cancel alarm
-    signal.alarm(0)
-    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        except OSError:
+            try:
+                os.unlink(fname_tmp)
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                pass
+            raise getmailDeliveryError('failure renaming "%s" to "%s"'
+                                       % (fname_tmp, fname_new))
+
+    for dir_new in set(os.path.dirname(fname_new)
+                       for (unused, fname_new) in files):
+        try:
+            fsync_dir(dir_new)
+        except OSError as o:
+            raise getmailDeliveryError('failure syncing %s (%s)'
+                                       % (dir_new, o))
 
-    return filename
+#######################################
+def fsync_dir(path):
+    '''fsync a directory, so that files created in (or linked into) it
+    survive a crash.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 #######################################
 def mbox_from_escape(s):
@@ -416,6 +478,13 @@ def uid_of_user(user):
     except KeyError as o:
         raise getmailConfigurationError('no such specified user (%s)' % o)
 
+#######################################
+def gid_of_group(group):
+    try:
+        return grp.getgrnam(group).gr_gid
+    except KeyError as o:
+        raise getmailConfigurationError('no such specified group (%s)' % o)
+
 #######################################
 def change_usergroup(logger=None, user=None, group=None):
     '''
@@ -427,10 +496,7 @@ def change_usergroup(logger=None, user=None, group=None):
     if group:
         if logger:
             logger.debug('Getting GID for specified group %s\n' % group)
-        try:
-            gid = grp.getgrnam(group).gr_gid
-        except KeyError as o:
-            raise getmailConfigurationError('no such specified group (%s)' % o)
+        gid = gid_of_group(group)
     if user:
         if logger:
             logger.debug('Getting UID for specified user %s\n' % user)
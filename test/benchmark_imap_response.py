@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+'''Time parsing a synthetic 100k-line FETCH (UID RFC822.SIZE FLAGS)
+response, as for the message list of a large mailbox, with the old
+split()-based attribute parser and with parse_fetch_response().
+
+    python test/benchmark_imap_response.py [LINES]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from getmailcore import logging
+from getmailcore.imap_response import parse_fetch_response
+
+log = logging.Logger()
+
+def old_parse_imapattrresponse(line):
+    # IMAPRetrieverBase._parse_imapattrresponse() before it was replaced,
+    # without its error handling
+    log.trace('parsing attributes response line %s' % line + os.linesep)
+    r = {}
+    parts = line[line.index(b'(') + 1:line.rindex(b')')].split()
+    while parts:
+        if parts[0].lower() == b'flags' and parts[1].startswith(b'('):
+            while parts and not parts[0].endswith(b')'):
+                del parts[0]
+            if parts:
+                del parts[0]
+            continue
+        name = parts.pop(0).lower()
+        r[name.decode()] = parts.pop(0).decode()
+    log.trace('got %s' % r + os.linesep)
+    return r
+
+def timed(parse, response):
+    start = time.time()
+    parse(response)
+    return time.time() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # Without handlers, the logger prints everything
+    log.addhandler(sys.stderr, logging.WARNING)
+    response = [b'%d (UID %d RFC822.SIZE %d FLAGS (\\Seen $NotJunk))'
+                % (i, i + 7, 1000 + i) for i in range(1, count + 1)]
+    old = timed(lambda r: [old_parse_imapattrresponse(line) for line in r],
+                response)
+    new = timed(parse_fetch_response, response)
+    print('%d FETCH responses' % count)
+    print('_parse_imapattrresponse: %6.2fs' % old)
+    print('parse_fetch_response:    %6.2fs' % new)
+
+if __name__ == '__main__':
+    main()
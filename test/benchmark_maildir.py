@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''Messages per second delivered to a Maildir, with a child process per
+message (as when delivering as another user) and in-process.
+
+    python test/benchmark_maildir.py [COUNT]
+
+Must not be run as root, which is refused Maildir delivery.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from getmailcore import logging
+from getmailcore.destinations import Maildir
+from getmailcore.message import Message
+
+MESSAGE = (b'From: sender@example.org\r\nTo: recipient@example.org\r\n'
+           b'Subject: benchmark\r\n\r\nA small message.\r\n')
+
+def maildir(parent, name):
+    path = os.path.join(parent, name) + '/'
+    for sub in ('tmp', 'new', 'cur'):
+        os.makedirs(path + sub)
+    return Maildir(path=path)
+
+def rate(deliver, count):
+    start = time.time()
+    for unused in range(count):
+        deliver()
+    return count / (time.time() - start)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # Without handlers, the logger prints everything
+    logging.Logger().addhandler(sys.stderr, logging.WARNING)
+    msg = Message(fromstring=MESSAGE)
+    parent = tempfile.mkdtemp()
+    try:
+        forked = maildir(parent, 'forked')
+        inprocess = maildir(parent, 'inprocess')
+        before = rate(lambda: forked.forkchild(
+            lambda o, e: forked._Maildir__deliver_message_maildir(
+                None, None, msg, True, True, o, e)
+        ), count)
+        after = rate(lambda: inprocess.deliver_message(msg), count)
+        for (name, d) in (('forked', forked), ('inprocess', inprocess)):
+            delivered = len(os.listdir(os.path.join(d.conf['path'], 'new')))
+            assert delivered == count, (name, delivered)
+    finally:
+        shutil.rmtree(parent)
+    print('%d messages' % count)
+    print('child process per message: %8.0f msgs/s' % before)
+    print('in-process:                %8.0f msgs/s' % after)
+
+if __name__ == '__main__':
+    main()
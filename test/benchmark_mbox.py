@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''Messages per second delivered to an mbox file, with a child process per
+message (as when delivering as another user), in-process, and in-process
+in batches which keep the mbox open and locked.
+
+    python test/benchmark_mbox.py [COUNT] [BATCH]
+
+Must not be run as root, which is refused mbox delivery.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from getmailcore import logging
+from getmailcore.destinations import Mboxrd
+from getmailcore.message import Message
+
+MESSAGE = (b'From: sender@example.org\r\nTo: recipient@example.org\r\n'
+           b'Subject: benchmark\r\n\r\nA small message.\r\n')
+
+def mbox(parent, name):
+    path = os.path.join(parent, name)
+    open(path, 'w').close()
+    return Mboxrd(path=path)
+
+def rate(deliver, count):
+    start = time.time()
+    for unused in range(count):
+        deliver()
+    return count / (time.time() - start)
+
+def batched(destination, msg, batch):
+    destination.set_batching(True)
+    delivered = [0]
+    def deliver():
+        destination.deliver_message(msg)
+        delivered[0] += 1
+        if delivered[0] % batch == 0:
+            destination.commit()
+    return deliver
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    # Without handlers, the logger prints everything
+    logging.Logger().addhandler(sys.stderr, logging.WARNING)
+    msg = Message(fromstring=MESSAGE)
+    parent = tempfile.mkdtemp()
+    try:
+        forked = mbox(parent, 'forked')
+        inprocess = mbox(parent, 'inprocess')
+        batches = mbox(parent, 'batched')
+        before = rate(lambda: forked.forkchild(
+            lambda o, e: forked._Mboxrd__deliver_message_mbox(
+                None, None, msg, True, True, o, e)
+        ), count)
+        single = rate(lambda: inprocess.deliver_message(msg), count)
+        after = rate(batched(batches, msg, batch), count)
+        batches.commit()
+        for (name, d) in (('forked', forked), ('inprocess', inprocess),
+                          ('batched', batches)):
+            with open(d.conf['path'], 'rb') as f:
+                delivered = sum(1 for line in f if line.startswith(b'From '))
+            assert delivered == count, (name, delivered)
+    finally:
+        shutil.rmtree(parent)
+    print('%d messages' % count)
+    print('child process per message: %8.0f msgs/s' % before)
+    print('in-process:                %8.0f msgs/s' % single)
+    print('in-process, %4d per batch: %7.0f msgs/s' % (batch, after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''Addresses per second routed by MultiSorter "locals" patterns, searching
+with each pattern in turn and with the index MultiSorter uses, for 10000
+patterns (mostly plain addresses, some regular expressions).
+
+    python test/benchmark_router.py [COUNT]
+'''
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from getmailcore.destinations import _AddressRouter
+
+def patterns():
+    domains = ['example.org', 'example.net', 'mail.example.com']
+    result = ['user%d@%s' % (i, domains[i % 3]) for i in range(9000)]
+    result += ['first%d.last@example.org' % i for i in range(500)]
+    result += ['^(dept%d|team%d)(\\.[a-z]+)?@example\\.(org|net)$' % (i, i)
+               for i in range(400)]
+    result += ['^.*@(mail\\.)?host%d\\.example\\.org$' % i for i in range(100)]
+    return [re.compile(p, re.IGNORECASE) for p in result]
+
+def addresses(count):
+    rnd = random.Random(1)
+    result = []
+    for unused in range(count):
+        n = rnd.randrange(10000)
+        result.append(rnd.choice([
+            'user%d@example.org' % n,
+            'xuser%d@mail.example.com' % n,
+            'user%d@example.net.invalid' % n,
+            'First%d.Last@Example.org' % n,
+            'dept%d.sales@example.net' % n,
+            'someone@mail.host%d.example.org' % (n % 150),
+            'nobody@nowhere.invalid',
+        ]))
+    return result
+
+def rate(route, addrs):
+    start = time.time()
+    result = [route(addr) for addr in addrs]
+    return (len(addrs) / (time.time() - start), result)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    pats = patterns()
+    addrs = addresses(count)
+    start = time.time()
+    router = _AddressRouter(pats)
+    setup = time.time() - start
+    (before, expected) = rate(
+        lambda addr: [i for (i, p) in enumerate(pats) if p.search(addr)],
+        addrs
+    )
+    (after, found) = rate(router.matches, addrs)
+    assert found == expected
+    print('%d patterns, %d addresses, index built in %.2fs'
+          % (len(pats), count, setup))
+    print('each pattern in turn: %8.0f addresses/s' % before)
+    print('indexed:              %8.0f addresses/s' % after)
+
+if __name__ == '__main__':
+    main()
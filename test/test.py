@@ -1,11 +1,30 @@
 
+import getmailcore.message as message
+import getmailcore.utilities as utilities
 from getmailcore.message import Message
 from getmailcore.exceptions import *
 
-import os, smtplib, ssl
+import os, re, io, sys, time, smtplib, ssl, socket, threading, tempfile
+import imaplib
+import importlib.machinery, importlib.util
+from argparse import Namespace
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.message import EmailMessage
+from getmailcore.retrievers import SimplePOP3Retriever
+from getmailcore._retrieverbases import HEADER_BATCH_MESSAGES
+from getmailcore.syncstate import SyncList
+from getmailcore.logging import Logger
+from getmailcore.oldmail import OldmailJournal
+from getmailcore.filters import Filter_external, Filter_python
+from getmailcore.destinations import (MDA_lmtp, Maildir, Mboxrd,
+                                      _AddressRouter, _mbox_writers)
+from getmailcore.utilities import updatefile, maildir_tmpfile, maildir_commit
+from getmailcore.imap_response import (parse_fetch_response, fetch_body,
+                                       imap_sequence_sets, parse_sequence_set,
+                                       parse_search_response,
+                                       parse_status_responses,
+                                       _items, _parse_segments, _NOLITERAL)
 
 greetru = "привет"
 greetde = "Grüße"
@@ -83,9 +102,23 @@ def test_spam_1():
     with open(fl,'br') as f:
         spam_eml = f.read()
     gm = Message(fromstring=spam_eml)
+    # Corrupt-message recovery happens when the whole message is parsed,
+    # e.g. for SMTP delivery; flatten() alone parses only the header block
+    gm.content()
     gmfl = gm.flatten(None,None)
     assert b'corrupt' in gmfl # check recover
 
+def test_spam_raw_body():
+    fl = os.path.join(os.path.split(__file__)[0],'spam.eml')
+    with open(fl,'br') as f:
+        spam_eml = f.read()
+    gm = Message(fromstring=spam_eml.replace(b'\n', b'\r\n'))
+    gm.add_header('X-test','lazy')
+    gmfl = gm.flatten(None,None)
+    # only the header block is parsed, the body is written as it came
+    assert gmfl.endswith(spam_eml[spam_eml.index(b'\n\n'):])
+    assert b'\nX-test: lazy\n' in gmfl
+
 def test_spam_2():
     fl = os.path.join(os.path.split(__file__)[0],'spam.eml')
     gmm = Message(fromfile=open(fl,'rb'))
@@ -93,3 +126,721 @@ def test_spam_2():
         gmfl = gmm.flatten(None,None)
     except getmailDeliveryError as o:
         assert 'could not recover' in str(o) # noqa: PT017
+
+def test_parse_fetch_response():
+    response = [
+        (b'1 (UID 7 X-GM-LABELS ("\\\\Inbox" foo) BODY[] {3}', b'abc'), b')',
+        b'4 (FLAGS (\\Seen) UID 12)',
+        (b'2 (BODY[] {3}', b'def'), b' UID 9 X-GM-THRID 1410134259107225671)',
+    ]
+    fetched = parse_fetch_response(response)
+    assert [msgnum for (msgnum, unused) in fetched] == [1, 4, 2]
+    assert fetched[0][1]['X-GM-LABELS'] == ['\\Inbox', 'foo']
+    assert fetched[1][1] == {'FLAGS': ['\\Seen'], 'UID': 12}
+    assert fetched[2][1]['X-GM-THRID'] == 1410134259107225671
+    assert [fetch_body(items) for (unused, items) in fetched] == [b'abc', None, b'def']
+    # one-line responses take a shortcut, which must give the same results
+    lines = [b'5 (UID 12 MODSEQ (99) FLAGS () RFC822.SIZE 070)',
+             b'6 (FLAGS (\\Seen $Junk) UID 13 X NIL)']
+    simple = parse_fetch_response(lines)
+    assert simple == [(5, {'UID': 12, 'MODSEQ': [99], 'FLAGS': [], 'RFC822.SIZE': '070'}),
+                      (6, {'FLAGS': ['\\Seen', '$Junk'], 'UID': 13, 'X': None})]
+    assert simple == [_items(_parse_segments([(line, _NOLITERAL)])) for line in lines]
+
+def test_imap_sequence_sets():
+    uids = ['502'] + [str(i) for i in range(1, 501)] + ['510', '511', '512']
+    assert imap_sequence_sets(uids) == ['1:500,502,510:512']
+    assert imap_sequence_sets(uids, maxlen=10) == ['1:500,502', '510:512']
+
+def test_parse_sequence_set():
+    assert parse_sequence_set('1:500,502,512:510') == [(1, 500), (502, 502), (510, 512)]
+
+def test_parse_search_response():
+    assert parse_search_response([b'4 18 2', None]) == [4, 18, 2]
+    assert parse_search_response([b'(TAG "A1") UID ALL 4:6,21']) == [4, 5, 6, 21]
+    assert parse_search_response([b'(TAG "A1") UID']) == []
+    assert parse_search_response([b'UID ALL 4:5,18']) == [4, 5, 18]
+    assert parse_search_response([b'UID MIN 4 ALL 4:5']) == [4, 5]
+    assert parse_search_response([b' ', b'']) == []
+
+def test_parse_status_responses():
+    assert parse_status_responses([
+        b'"Sent Items" (MESSAGES 2 UIDNEXT 7 UIDVALIDITY 42)',
+        b'inbox (MESSAGES 0)',
+        (b'{4}', b'List'), b' (UIDNEXT 3)',
+        b'garbage',
+    ]) == {'Sent Items': {'MESSAGES': 2, 'UIDNEXT': 7, 'UIDVALIDITY': 42},
+           'INBOX': {'MESSAGES': 0}, 'List': {'UIDNEXT': 3}}
+
+def test_oldmail_journal(tmp_path):
+    filename = str(tmp_path / 'oldmail-x')
+    store = OldmailJournal(filename, Logger(), 'x')
+    store.load()
+    store.add(['1/1', '1/2'], 100)
+    assert store.commit() == 2
+    store = OldmailJournal(filename, Logger(), 'x')
+    store.load()
+    store.add(['1/2', '1/3'], 200)
+    assert store.commit() == 1
+    assert open(filename).read().count('\0') == 3
+    store = OldmailJournal(filename, Logger(), 'x')
+    store.load()
+    assert store == {'1/1': 100, '1/2': 100, '1/3': 200}
+    assert sorted(store.expired(150)) == ['1/1', '1/2']
+    del store['1/1']
+    assert store.commit() == 2
+    assert open(filename).read().count('\0') == 2
+
+def test_sync_list(tmp_path):
+    filename = str(tmp_path / 'syncstate-list-x')
+    synclist = SyncList(filename, Logger(), 'x')
+    synclist.reset('7', 10, [(1, 100), (2, 200)])
+    assert synclist.commit() == 4
+    synclist.add(3, 300)
+    synclist.add(3, 300)
+    synclist.remove(1)
+    synclist.set_modseq(12)
+    # Only the changes are appended
+    assert synclist.commit() == 3
+    assert not synclist.changed_on_disk()
+    reread = SyncList(filename, Logger(), 'x')
+    reread.load()
+    assert (reread.uidvalidity, reread.modseq) == ('7', 12)
+    assert reread.sizes == {2: 200, 3: 300}
+    # Changed by someone else: written again completely
+    reread.remove(2)
+    assert reread.commit() == 1
+    assert synclist.changed_on_disk()
+    synclist.add(4, None)
+    assert synclist.commit() == 5
+    assert synclist.unsized == 1
+    reread.load()
+    assert reread.sizes == {2: 200, 3: 300, 4: None}
+    # A torn last line is dropped and the file rewritten
+    with open(filename, 'a') as f:
+        f.write('+5 5')
+    reread.load()
+    assert 5 not in reread.sizes
+    reread.add(5, 500)
+    assert reread.commit() == 6
+
+def test_updatefile_threads(tmp_path):
+    filename = str(tmp_path / 'state')
+    files = [updatefile(filename) for i in range(2)]
+    assert files[0].tmpname != files[1].tmpname
+    def write(f, data):
+        f.write(data)
+        f.close()
+    threads = [threading.Thread(target=write, args=(f, str(i) * 10))
+               for (i, f) in enumerate(files)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert open(filename).read() in ('0' * 10, '1' * 10)
+    f = updatefile(filename)
+    f.write('partial')
+    f.abort()
+    assert os.listdir(str(tmp_path)) == ['state']
+
+def test_maildir_commit(tmp_path):
+    maildir = str(tmp_path) + '/'
+    for sub in ('tmp', 'new', 'cur'):
+        os.mkdir(maildir + sub)
+    files = [maildir_tmpfile(maildir, b'Subject: %d\n\n' % i, 'host', i)
+             for i in range(3)]
+    assert len(os.listdir(maildir + 'tmp')) == 3
+    assert os.listdir(maildir + 'new') == []
+    maildir_commit(files)
+    assert os.listdir(maildir + 'tmp') == []
+    assert sorted(os.listdir(maildir + 'new')) == sorted(
+        os.path.basename(new) for (unused, new) in files)
+
+def test_flatten_cached(tmp_path):
+    calls = []
+    generate = message._generate
+    message._generate = lambda *args: calls.append(args) or generate(*args)
+    try:
+        gm = Message(fromstring=b'Subject: s\r\n\r\nbody\r\n')
+        gm.content()
+        first = gm.flatten(False, False)
+        assert gm.flatten(False, False) == first
+        assert len(calls) == 1
+        gm.add_header('X-Tag', 'x')
+        assert gm.flatten(False, False) != first
+        assert len(calls) == 2
+    finally:
+        message._generate = generate
+    files = []
+    for name in ('a', 'b'):
+        maildir = str(tmp_path / name) + '/'
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(maildir + sub)
+        files.append(maildir_tmpfile(maildir, gm.flatten_iter(False, False),
+                                     'host', linkfrom=gm.copies('key')))
+        gm.add_copy('key', files[-1])
+    assert os.path.samefile(files[0][0], files[1][0])
+    gm.add_header('X-Tag', 'y')
+    assert gm.copies('key') == []
+
+def test_address_router():
+    patterns = [re.compile(p, re.IGNORECASE) for p in (
+        'bob@example.org', 'john.smith@x.org', '@z.org', r'(a)\1@x',
+        r'^.*@y\.org$', '(?P<n>c)@w', '(?P<n>d)@w')]
+    router = _AddressRouter(patterns)
+    for address in ('bob@example.org', 'JimBob@Example.org.uk',
+                    'bob@exampleXorg', 'x.smith@x.org', 'jo.smith@x.org',
+                    'john.smith@x.org', 'q@z.org', 'aa@x', 'u@y.org', 'c@w',
+                    'bob@ex@example.org', 'b\xf3b@example.org'):
+        assert router.matches(address) == [
+            i for (i, p) in enumerate(patterns) if p.search(address)]
+
+def test_message_fromspool():
+    raw = b'Subject: spooled\r\nFrom: a@b.org\r\n\r\nFrom the body\r\n'
+    spool = tempfile.SpooledTemporaryFile(16)
+    spool.write(raw)
+    gm = Message(fromspool=spool)
+    assert gm.get_all('subject') == ['spooled']
+    flat = gm.flatten(None, None, mangle_from=True)
+    assert flat == Message(fromstring=raw).flatten(None, None, mangle_from=True)
+    assert flat.endswith(b'\n\n>From the body\n')
+
+def test_mangle_from_chunked():
+    raw = b'Subject: s\n\n' + b'From a\nxFrom b\n>From c\n' * 20
+    expected = Message(fromstring=raw).flatten(None, None, mangle_from=True)
+    assert expected.count(b'\n>From a\n') == 20
+    assert expected.count(b'\n>>From c\n') == 20
+    size = message._BODY_CHUNK
+    try:
+        message._BODY_CHUNK = 5
+        for parsed in (False, True):
+            gm = Message(fromstring=raw)
+            if parsed:
+                gm.content()
+            chunks = list(gm.flatten_iter(None, None, mangle_from=True))
+            assert len(chunks) > 2
+            assert b''.join(chunks) == expected
+    finally:
+        message._BODY_CHUNK = size
+
+def test_filter_persistent(tmp_path):
+    script = tmp_path / 'filter'
+    script.write_text(
+        '#!%s\n'
+        'import os, sys\n'
+        'while True:\n'
+        '    line = sys.stdin.buffer.readline()\n'
+        '    if not line:\n'
+        '        break\n'
+        '    msg = sys.stdin.buffer.read(int(line))\n'
+        '    out = b"X-Pid: %%d\\n" %% os.getpid() + msg\n'
+        '    sys.stdout.buffer.write(b"0 %%d 0\\n" %% len(out) + out)\n'
+        '    sys.stdout.buffer.flush()\n' % sys.executable)
+    script.chmod(0o755)
+    f = Filter_external(path=str(script), persistent=True,
+                        allow_root_commands=True)
+    class retriever:
+        received_from = received_with = received_by = None
+    pids = set()
+    try:
+        for i in range(3):
+            msg = Message(fromstring=b'Subject: %d\r\n\r\nbody\r\n' % i)
+            newmsg = f.filter_message(msg, retriever)
+            assert newmsg.get_all('subject') == [str(i)]
+            pids.update(newmsg.get_all('x-pid'))
+    finally:
+        f.close()
+    assert len(pids) == 1
+    assert f.coprocesses == []
+
+def test_filter_python(tmp_path):
+    (tmp_path / 'rules.py').write_text(
+        'def rules(msg, tag):\n'
+        '    if msg.get_all("x-spam"):\n'
+        '        return 99\n'
+        '    msg.remove_header("x-noise")\n'
+        '    msg.add_header("X-Tag", tag)\n')
+    f = Filter_python(callable='%s:rules' % (tmp_path / 'rules.py'),
+                      arguments='("checked", )')
+    class retriever:
+        received_from = received_with = received_by = None
+    msg = Message(fromstring=b'Subject: s\r\nX-Noise: n\r\n\r\nbody\r\n')
+    newmsg = f.filter_message(msg, retriever)
+    assert newmsg.get_all('x-tag') == ['checked']
+    assert newmsg.get_all('x-noise') is None
+    msg = Message(fromstring=b'Subject: s\r\nX-Spam: yes\r\n\r\nbody\r\n')
+    assert f.filter_message(msg, retriever) is None
+    f = Filter_python(callable='%s:rules' % (tmp_path / 'rules.py'),
+                      arguments='("later", )', headers_only='true',
+                      exitcodes_skip='(75, )')
+    assert f.headers_only
+    msg = Message(fromlines=[b'Subject: s', b'X-Spam: yes', b''])
+    assert f.filter_headers(msg, retriever) == 'drop'
+    msg = Message(fromlines=[b'Subject: s', b''])
+    assert f.filter_headers(msg, retriever) is None
+
+def test_filter_python_headers(tmp_path):
+    (tmp_path / 'rules.py').write_text(
+        'def rules(msg):\n'
+        '    if msg.get_all("x-spam"):\n'
+        '        return 99\n'
+        '    if msg.get_all("x-later"):\n'
+        '        return 75\n'
+        '    return 0\n')
+    f = Filter_python(callable='%s:rules' % (tmp_path / 'rules.py'),
+                      headers_only='true', exitcodes_skip='(75, )')
+    class retriever:
+        received_from = received_with = received_by = None
+    msg = Message(fromlines=[b'Subject: s', b''])
+    assert f.filter_headers(msg, retriever) is None
+    msg = Message(fromlines=[b'Subject: s', b'X-Spam: yes', b''])
+    assert f.filter_headers(msg, retriever) == 'drop'
+    msg = Message(fromlines=[b'Subject: s', b'X-Later: yes', b''])
+    assert f.filter_headers(msg, retriever) == 'skip'
+
+def test_filter_python_bad_result(tmp_path):
+    (tmp_path / 'rules.py').write_text(
+        'def rules(msg):\n'
+        '    return (0, msg, "extra")\n')
+    f = Filter_python(callable='%s:rules' % (tmp_path / 'rules.py'))
+    class retriever:
+        received_from = received_with = received_by = None
+    msg = Message(fromstring=b'Subject: s\r\n\r\nbody\r\n')
+    error = None
+    try:
+        f.filter_message(msg, retriever)
+    except getmailFilterError as o:
+        error = str(o)
+    assert error is not None
+    assert 'returned' in error
+
+def test_lmtp_pipelined():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    connections = []
+    delivered = []
+    commands = []
+    def serve():
+        conn = listener.accept()[0]
+        connections.append(conn)
+        f = conn.makefile('rb')
+        conn.sendall(b'220 ready\r\n')
+        rcpts = []
+        transaction = False
+        while True:
+            line = f.readline().upper()
+            if not line:
+                break
+            commands.append(line.split()[0])
+            if line.startswith(b'LHLO'):
+                conn.sendall(b'250-x\r\n250-PIPELINING\r\n250 CHUNKING\r\n')
+            elif line.startswith(b'MAIL') and transaction:
+                conn.sendall(b'503 nested MAIL command\r\n')
+            elif line.startswith(b'MAIL'):
+                transaction = True
+                conn.sendall(b'250 ok\r\n')
+            elif line.startswith(b'RSET'):
+                transaction = False
+                rcpts = []
+                conn.sendall(b'250 ok\r\n')
+            elif line.startswith(b'RCPT') and b'NOBODY' in line:
+                conn.sendall(b'550 unknown\r\n')
+            elif line.startswith(b'RCPT'):
+                rcpts.append(line)
+                conn.sendall(b'250 ok\r\n')
+            elif line.startswith(b'BDAT'):
+                data = f.read(int(line.split()[1]))
+                if rcpts:
+                    delivered.append((rcpts[0], data))
+                    transaction = False
+                conn.sendall(b'250 ok\r\n' * len(rcpts) or b'554 no\r\n')
+                rcpts = []
+            else:
+                conn.sendall(b'250 ok\r\n')
+    threading.Thread(target=serve, daemon=True).start()
+    d = MDA_lmtp(host='127.0.0.1', port=listener.getsockname()[1],
+                 override='nobody', fallback='postmaster')
+    for i in range(2):
+        msg = Message(fromstring=b'Subject: %d\n\n.body\n' % i)
+        d.deliver_message(msg, False, False)
+    assert len(connections) == 1
+    assert len(delivered) == 2
+    assert delivered[1][0] == b'RCPT TO:<POSTMASTER>\r\n'
+    assert delivered[1][1].endswith(b'Subject: 1\r\n\r\n.body\r\n')
+    # The refused transaction was reset before the fallback's MAIL
+    assert commands.count(b'RSET') == 2
+    d.close()
+
+def _fake_pop3(messages, pipelining=True, refused=()):
+    """Serve messages over POP3 on a local port, from a thread.
+
+    Returns (port, commands); commands gets a list of the command lines
+    received with each read from the socket, so pipelined commands show up
+    together.  RETR of the message numbers in refused gets -ERR.
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    commands = []
+    def reply(conn, line):
+        words = line.split()
+        verb = words[0].upper()
+        if verb == b'CAPA':
+            return (b'+OK\r\nUIDL\r\nTOP\r\n'
+                    + (b'PIPELINING\r\n' if pipelining else b'') + b'.\r\n')
+        if verb == b'UIDL':
+            return b'+OK\r\n' + b''.join(b'%d uid%d\r\n' % (i, i)
+                for i in range(1, len(messages) + 1)) + b'.\r\n'
+        if verb == b'LIST':
+            return b'+OK\r\n' + b''.join(b'%d %d\r\n' % (i, len(msg))
+                for (i, msg) in enumerate(messages, 1)) + b'.\r\n'
+        if verb in (b'RETR', b'TOP'):
+            i = int(words[1])
+            if verb == b'RETR' and i in refused:
+                return b'-ERR refused\r\n'
+            msg = messages[i - 1]
+            if verb == b'TOP':
+                msg = msg[:msg.index(b'\r\n\r\n') + 4]
+            return b'+OK\r\n' + msg.replace(b'\r\n.', b'\r\n..') + b'.\r\n'
+        return b'+OK\r\n'
+    def serve():
+        conn = listener.accept()[0]
+        conn.sendall(b'+OK ready\r\n')
+        data = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            lines = data.split(b'\r\n')
+            data = lines.pop()
+            commands.append([line.decode() for line in lines])
+            for line in lines:
+                conn.sendall(reply(conn, line))
+                if line.upper() == b'QUIT':
+                    conn.close()
+                    return
+    threading.Thread(target=serve, daemon=True).start()
+    return (listener.getsockname()[1], commands)
+
+def _pop3_retriever(port, tmp_path, **options):
+    retriever = SimplePOP3Retriever(server='127.0.0.1', port=port,
+                                    username='u', password='p',
+                                    getmaildir=str(tmp_path))
+    retriever.initialize(options)
+    retriever.select_mailbox(None)
+    return retriever
+
+def test_pop3_header_batches(tmp_path):
+    nmsgs = HEADER_BATCH_MESSAGES * 2 + 50
+    messages = [b'Subject: %d\r\n\r\nbody\r\n' % i for i in range(nmsgs)]
+    port = _fake_pop3(messages)[0]
+    retriever = _pop3_retriever(port, tmp_path, read_all=True)
+    batches = []
+    getheadersbyid = retriever._getheadersbyid
+    def counted(msgids):
+        batches.append(len(msgids))
+        return getheadersbyid(msgids)
+    retriever._getheadersbyid = counted
+    # Like go(), asking again for the first message not in a batch
+    seen = set()
+    for msgid in retriever:
+        if msgid not in seen:
+            seen.update(headerid for (headerid, unused)
+                        in retriever.getheaders(msgid))
+    retriever.quit()
+    assert len(seen) == nmsgs
+    assert batches == [HEADER_BATCH_MESSAGES, HEADER_BATCH_MESSAGES, 50]
+
+def test_pop3_pipelining(tmp_path):
+    messages = [b'Subject: %d\r\n\r\nbody %d\r\n' % (i, i) for i in range(1, 6)]
+    (port, commands) = _fake_pop3(messages)
+    retriever = _pop3_retriever(port, tmp_path, fetch_batch_messages=2)
+    assert retriever.pipelining
+    msgids = [retriever[i] for i in range(5)]
+    retriever.getmsg(msgids[0])
+    assert commands[-1] == ['RETR 1', 'RETR 2']
+    retriever.delmsg(msgids[0])
+    assert b'body 2' in retriever.getmsg(msgids[1]).flatten(False, False)
+    retriever.delmsg(msgids[1])
+    # The DELE commands go out ahead of the next RETR commands, at once
+    retriever.getmsg(msgids[2])
+    assert commands[-1] == ['DELE 1', 'DELE 2', 'RETR 3', 'RETR 4']
+    retriever.delmsg(msgids[2])
+    retriever.quit()
+    assert commands[-2:] == [['DELE 3'], ['QUIT']]
+
+def test_pop3_pipelining_error(tmp_path):
+    messages = [b'Subject: %d\r\n\r\nbody %d\r\n' % (i, i) for i in range(1, 4)]
+    (port, commands) = _fake_pop3(messages, refused=(2,))
+    retriever = _pop3_retriever(port, tmp_path, fetch_batch_messages=3)
+    msgids = [retriever[i] for i in range(3)]
+    assert b'body 1' in retriever.getmsg(msgids[0]).flatten(False, False)
+    assert commands[-1] == ['RETR 1', 'RETR 2', 'RETR 3']
+    error = None
+    try:
+        retriever.getmsg(msgids[1])
+    except getmailRetrievalError as o:
+        error = str(o)
+    assert error is not None
+    assert 'refused' in error
+    # The responses after the error were read in order
+    assert b'body 3' in retriever.getmsg(msgids[2]).flatten(False, False)
+    assert commands[-1] == ['RETR 1', 'RETR 2', 'RETR 3']
+    retriever.quit()
+
+def test_pop3_no_pipelining(tmp_path):
+    messages = [b'Subject: %d\r\n\r\nbody %d\r\n' % (i, i) for i in range(1, 4)]
+    (port, commands) = _fake_pop3(messages, pipelining=False)
+    retriever = _pop3_retriever(port, tmp_path, fetch_batch_messages=3)
+    assert not retriever.pipelining
+    start = len(commands)
+    for i in range(3):
+        msg = retriever.getmsg(retriever[i])
+        assert b'body %d' % (i + 1) in msg.flatten(False, False)
+        retriever.delmsg(retriever[i])
+    retriever.quit()
+    # One command at a time, each after the response to the previous one
+    assert commands[start:] == [['RETR 1'], ['DELE 1'], ['RETR 2'], ['DELE 2'],
+                                ['RETR 3'], ['DELE 3'], ['QUIT']]
+
+def _fake_imap_literal(literal):
+    """Serve one message over IMAP on a local port, from a thread; any
+    FETCH returns it as a literal.  Returns the port."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    def serve():
+        conn = listener.accept()[0]
+        conn.sendall(b'* OK [CAPABILITY IMAP4rev1] ready\r\n')
+        f = conn.makefile('rb')
+        for line in f:
+            tag = line.split()[0]
+            if b' FETCH ' in line:
+                conn.sendall(b'* 1 FETCH (BODY[] {%d}\r\n' % len(literal)
+                             + literal + b')\r\n')
+            conn.sendall(tag + b' OK done\r\n')
+        conn.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def test_imap_literal_spooled():
+    body = b''.join(b'Line %d of the message\r\n' % i for i in range(1000))
+    for (spool_bytes, spooled) in ((1000, True), (len(body), False),
+                                   (0, False)):
+        conn = imaplib.IMAP4('127.0.0.1', _fake_imap_literal(body))
+        conn.spool_bytes = spool_bytes
+        conn.state = 'SELECTED'
+        data = conn.fetch('1', '(BODY[])')[1]
+        conn.shutdown()
+        literal = fetch_body(parse_fetch_response(data)[0][1])
+        if spooled:
+            # Written to a temporary file on disk by imap_read_spooled(),
+            # rewound
+            assert literal._rolled
+            assert literal.read() == body
+        else:
+            # Up to message_spool_bytes, and with 0, read into memory
+            assert literal == body
+
+class _FailingMessage(Message):
+    def flatten_iter(self, *args, **kwargs):
+        yield b'From partial\n'
+        raise IOError('disk full')
+
+def test_mbox_batch(tmp_path, monkeypatch):
+    if os.geteuid() == 0:
+        # The mbox is held open only when delivering without a user switch,
+        # which as root would be refused
+        monkeypatch.setattr(os, 'geteuid', lambda: 65534)
+        monkeypatch.setattr(os, 'getegid', lambda: 65534)
+    path = str(tmp_path / 'mbox')
+    open(path, 'w').close()
+    msgs = [Message(fromstring=b'Subject: %d\r\n\r\nbody %d\r\n' % (i, i))
+            for i in range(4)]
+    d = Mboxrd(path=path)
+    d.set_batching(True)
+    d.deliver_message(msgs[0], False, False)
+    mbox = d._mbox
+    d.deliver_message(msgs[1], False, False)
+    # One open and lock for the batch
+    assert d._mbox is mbox
+    assert _mbox_writers == {os.path.realpath(path): d}
+    size = os.path.getsize(path)
+    error = None
+    try:
+        d.deliver_message(_FailingMessage(fromstring=b'Subject: x\r\n\r\n'),
+                          False, False)
+    except getmailDeliveryError as o:
+        error = str(o)
+    assert 'disk full' in error
+    # Only the failed message is cut off again
+    assert os.path.getsize(path) == size
+    d.commit()
+    assert d._mbox is None
+    assert _mbox_writers == {}
+    d.deliver_message(msgs[2], False, False)
+    d.rollback()
+    # The whole batch is dropped
+    assert os.path.getsize(path) == size
+    d.deliver_message(msgs[2], False, False)
+    # Another destination for the same mbox commits the open batch first
+    d2 = Mboxrd(path=path)
+    d2.set_batching(True)
+    d2.deliver_message(msgs[3], False, False)
+    assert d._mbox is None
+    assert _mbox_writers == {os.path.realpath(path): d2}
+    d2.commit()
+    mboxdata = open(path, 'rb').read()
+    assert [int(line.split()[1]) for line in mboxdata.splitlines()
+            if line.startswith(b'body ')] == [0, 1, 2, 3]
+    assert b'partial' not in mboxdata
+
+def test_maildir_batch(tmp_path, monkeypatch):
+    if os.geteuid() == 0:
+        # Batches are written in-process only without a user switch, which
+        # as root would be refused
+        monkeypatch.setattr(os, 'geteuid', lambda: 65534)
+        monkeypatch.setattr(os, 'getegid', lambda: 65534)
+    synced = []
+    monkeypatch.setattr(utilities, 'fsync_dir', synced.append)
+    destinations = []
+    for name in ('a', 'b'):
+        maildir = str(tmp_path / name) + '/'
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(maildir + sub)
+        d = Maildir(path=maildir)
+        d.set_batching(True)
+        destinations.append(d)
+    msgs = [Message(fromstring=b'Subject: %d\r\n\r\nbody %d\r\n' % (i, i))
+            for i in range(3)]
+    for d in destinations:
+        for msg in msgs:
+            d.deliver_message(msg, False, False)
+    (a, b) = [str(tmp_path / name) for name in ('a', 'b')]
+    assert len(os.listdir(a + '/tmp')) == 3
+    assert synced == []
+    destinations[0].commit()
+    # One sync of new/ for the whole batch
+    assert synced == [a + '/new']
+    assert len(os.listdir(a + '/new')) == 3
+    destinations[1].commit()
+    assert synced == [a + '/new', b + '/new']
+    # The second Maildir got hard links to the files of the first
+    for name in os.listdir(b + '/new'):
+        assert os.stat(os.path.join(b, 'new', name)).st_nlink == 2
+
+def _getmail_script():
+    """Load the getmail script as a module."""
+    path = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'getmail')
+    loader = importlib.machinery.SourceFileLoader('getmail_script', path)
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+class _IdleRetriever(object):
+    """Stands in for an IMAP retriever in go_daemon().  Its connection is
+    one end of a socket pair; what is written to the other end is reported
+    by idle_done() as the changed folders."""
+    supports_idle = True
+    mailboxes = ('INBOX', 'Lists')
+    def __init__(self, name, events):
+        (self.peer, self.sock) = socket.socketpair()
+        self.sock.setblocking(False)
+        self.name = name
+        self.events = events
+        self.conn = None
+        self.failidle = False
+    def set_new_timestamp(self):
+        pass
+    def idle_start(self, folders):
+        self.events.append(('idle', self.name))
+        if len(self.events) > 12:
+            raise KeyboardInterrupt
+        if self.failidle:
+            self.failidle = False
+            raise socket.error('connection reset')
+        return []
+    def idle_done(self):
+        try:
+            return self.sock.recv(100).decode().split()
+        except (BlockingIOError, InterruptedError):
+            return []
+    def abort(self):
+        self.events.append(('abort', self.name))
+        self.conn = None
+    def quit(self):
+        self.events.append(('quit', self.name))
+
+def test_idle_daemon(monkeypatch):
+    getmail = _getmail_script()
+    monkeypatch.setattr(getmail, 'IDLE_TIMEOUT', 0.05)
+    events = []
+    def go_account(configfile, retriever, filters, destination, options,
+                   idle=False, idling=False, mailboxes=None):
+        assert idle == ['INBOX', 'Lists']
+        events.append(('run', retriever.name, idling, mailboxes))
+        retriever.conn = Namespace(sock=retriever.sock)
+        return (True, (retriever, 1, 10, 0))
+    monkeypatch.setattr(getmail, 'go_account', go_account)
+    (a, b) = [_IdleRetriever(name, events) for name in ('a', 'b')]
+    # The IDLE of a fails once; a message is waiting in Lists of b
+    a.failidle = True
+    b.peer.sendall(b'Lists')
+    results = getmail.go_daemon([('a', a, [], None, {}),
+                                 ('b', b, [], None, {})], ['INBOX', 'Lists'])
+    assert events[:8] == [
+        ('run', 'a', False, None), ('idle', 'a'), ('abort', 'a'),
+        ('run', 'b', False, None), ('idle', 'b'),
+        # Only the changed folder, over the connection kept open
+        ('run', 'b', True, ['Lists']), ('idle', 'b'),
+        # a reconnects right away after its first failure
+        ('run', 'a', False, None),
+    ]
+    # After an IDLE timeout, IDLE is just renewed
+    assert [e for e in events[8:] if e[0] == 'run'] == []
+    assert ('quit', 'a') in events
+    assert ('quit', 'b') in events
+    assert [result for (ok, result) in results] == [(a, 2, 20, 0),
+                                                    (b, 2, 20, 0)]
+
+def test_parallel(tmp_path, monkeypatch):
+    getmail = _getmail_script()
+    out = io.StringIO()
+    monkeypatch.setattr(getmail.log, 'handlers', [])
+    getmail.log.addhandler(out, getmail.logging.INFO)
+    retrievers = [
+        SimplePOP3Retriever(server='127.0.0.1', username='u', password='p',
+                            port=_fake_pop3([b'Subject: s\r\n\r\nbody\r\n'])[0],
+                            getmaildir=str(tmp_path), timeout=timeout)
+        for timeout in (5, 6, 7)
+    ]
+    timeouts = {}
+    def go_account(configfile, retriever, filters, destination, options):
+        retriever.initialize({})
+        timeouts[configfile] = (socket.getdefaulttimeout(),
+                                retriever.conn.sock.gettimeout())
+        for i in range(3):
+            getmail.log.info('%s %d\n' % (configfile, i))
+            time.sleep(0.01)
+        retriever.quit()
+        return (True, (retriever, 1, 10, 0))
+    monkeypatch.setattr(getmail, 'go_account', go_account)
+    try:
+        results = getmail.go_parallel(
+            [('rc%d' % i, retriever, [], None, {})
+             for (i, retriever) in enumerate(retrievers)], 2)
+    finally:
+        socket.setdefaulttimeout(None)
+    assert [result for (ok, result) in results] == [
+        (retriever, 1, 10, 0) for retriever in retrievers]
+    # The process-wide default is the largest timeout, set once by the main
+    # thread; each connection has its own
+    assert timeouts == {'rc0': (7, 5), 'rc1': (7, 6), 'rc2': (7, 7)}
+    # The output of each account comes in one piece
+    accounts = [line.split()[0] for line in out.getvalue().splitlines()]
+    assert sorted(accounts) == sorted(['rc0', 'rc1', 'rc2'] * 3)
+    assert all(len(set(accounts[i:i + 3])) == 1 for i in range(0, 9, 3))